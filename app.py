@@ -2,6 +2,7 @@ import os
 import logging
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware # For CORS if needed
+from fastapi.staticfiles import StaticFiles
 from config import Config
 from database_session import create_db_tables, get_db # Import from new file
 
@@ -24,14 +25,26 @@ def create_app():
         allow_headers=["*"],  # Allows all headers
     )
 
+    # Gravação opcional do tráfego do webhook para replay em testes de carga (replay_webhook.py)
+    traffic_recorder = None
+    if Config.TRAFFIC_RECORDER_PATH:
+        from services.traffic_recorder import TrafficRecorder, TrafficRecorderMiddleware
+        traffic_recorder = TrafficRecorder(Config.TRAFFIC_RECORDER_PATH)
+        app.add_middleware(TrafficRecorderMiddleware, recorder=traffic_recorder)
+        logging.info(f"Gravando o tráfego do webhook em {Config.TRAFFIC_RECORDER_PATH}")
+
     # Register routers here
     from routes.webhook import router as webhook_router
-    # from routes.dashboard import dashboard_bp # To be converted
-    # from routes.tasks import tasks_bp # To be converted
+    from routes.metrics import router as metrics_router
+    from routes.dashboard import router as dashboard_router
+    from routes.tasks import router as tasks_router
 
     app.include_router(webhook_router, prefix="/webhook")
-    # app.include_router(dashboard_router, prefix="/dashboard") # Once converted
-    # app.include_router(tasks_router, prefix="/tasks") # Once converted
+    app.include_router(metrics_router, prefix="/metrics")
+    app.include_router(dashboard_router, prefix="/dashboard")
+    app.include_router(tasks_router, prefix="/tasks")
+    # CSS e JS das páginas do dashboard (url_for('static', path=...) nos templates)
+    app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")), name="static")
 
     @app.on_event("startup")
     async def startup_event():
@@ -39,6 +52,35 @@ def create_app():
         create_db_tables()
         logging.info("Database tables checked/created.")
 
+        # Janelas de modo silencioso ativas, consultadas em memória pelo webhook
+        from database_session import SessionLocal
+        from services.silent_mode import silent_mode_registry
+        db = SessionLocal()
+        try:
+            silent_mode_registry.load(db)
+        finally:
+            db.close()
+
+        # Inicia os workers da fila de ingestão (retoma jobs pendentes de execuções anteriores)
+        if Config.ENABLE_ASYNC_PROCESSING:
+            from routes.webhook import ingest_queue, process_message_batch, process_message_batch_async, close_async_pipeline
+            if Config.ENABLE_ASYNC_PIPELINE:
+                ingest_queue.start(process_message_batch_async, on_loop_stop=close_async_pipeline)
+            else:
+                ingest_queue.start(process_message_batch)
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        """Stop the ingest workers; unfinished jobs stay in the database."""
+        from routes.webhook import ingest_queue
+        ingest_queue.stop()
+        if traffic_recorder:
+            traffic_recorder.close()
+        from database_session import async_engine, dispose_async_engine, replica_async_engine
+        await dispose_async_engine(async_engine)
+        if replica_async_engine:
+            await dispose_async_engine(replica_async_engine)
+
     return app
 
 app = create_app()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Arquiva as mensagens de conversas paradas: as conversas sem mensagens há mais de MESSAGE_ARCHIVE_AFTER_DAYS
+dias têm mensagens, respostas da IA e registros de mídia movidos para arquivos JSONL gzip mensais em
+MESSAGE_ARCHIVE_PATH (diretório local ou gs://bucket/prefixo), e o dashboard continua mostrando-as.
+Rode periodicamente (ex: cron diário), uma execução por vez.
+
+Uso:
+    python archive_messages.py
+    python archive_messages.py --days 180 --batch-size 200 --path gs://meu-bucket-privado/arquivo
+"""
+
+import argparse
+import sys
+import time
+
+from config import Config
+from database_session import SessionLocal, create_db_tables
+from services.message_archive import archive_idle_conversations, archive_storage
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Move as mensagens de conversas paradas para o arquivo comprimido.")
+    parser.add_argument('--days', type=int, default=Config.MESSAGE_ARCHIVE_AFTER_DAYS,
+                        help=f"Dias sem mensagens para a conversa ser arquivada (padrão: {Config.MESSAGE_ARCHIVE_AFTER_DAYS})")
+    parser.add_argument('--batch-size', type=int, default=100, help="Conversas por arquivo gravado/commit (padrão: 100)")
+    parser.add_argument('--path', default=Config.MESSAGE_ARCHIVE_PATH,
+                        help=f"Diretório local ou gs://bucket/prefixo (padrão: {Config.MESSAGE_ARCHIVE_PATH})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    create_db_tables()  # Garante a tabela message_archive_segments
+
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        run = archive_idle_conversations(db, archive_storage(args.path), idle_days=args.days, batch_size=max(1, args.batch_size))
+    finally:
+        db.close()
+    print(f"✅ {run.messages} mensagens de {run.conversations} conversas arquivadas em {run.segments} segmentos "
+          f"({run.bytes_written / 1024:.1f} KiB) em {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Preenche message_count, last_message_at e last_message_preview de todas as conversas a partir da
+tabela 'messages'. Rode uma vez depois do deploy que adicionou as colunas (a aplicação as cria na
+inicialização); daí em diante elas são mantidas na gravação de cada mensagem.
+
+Uso:
+    python backfill_conversation_stats.py
+    python backfill_conversation_stats.py --batch-size 1000
+"""
+
+import argparse
+import sys
+import time
+
+from database_session import SessionLocal, create_db_tables
+from services.conversation_stats import backfill_conversation_stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Recalcula as estatísticas por conversa usadas na listagem do dashboard.")
+    parser.add_argument('--batch-size', type=int, default=500, help="Conversas por UPDATE/commit (padrão: 500)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    create_db_tables()  # Garante as colunas e o índice em bancos criados antes delas
+
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        updated = backfill_conversation_stats(db, batch_size=max(1, args.batch_size))
+    finally:
+        db.close()
+    print(f"✅ Estatísticas recalculadas para {updated} conversas em {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,13 +14,36 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
     
     # Database configuration
+    # Sem DATABASE_URL, conecta ao Cloud SQL pelo conector (creator=getconn); ex. local: sqlite:///instance/whatsapp_ai.db
     SQLALCHEMY_DATABASE_URI = 'postgresql+pg8000://'
+    SQLALCHEMY_DATABASE_URL = os.environ.get('DATABASE_URL', SQLALCHEMY_DATABASE_URI)
+    # Instância e credenciais do Cloud SQL para o conector das engines asyncio (async_creator com asyncpg)
+    CLOUD_SQL_INSTANCE_CONNECTION_NAME = os.environ.get('INSTANCE_CONNECTION_NAME', '')
+    CLOUD_SQL_DB_USER = os.environ.get('DB_USER', '')
+    CLOUD_SQL_DB_PASS = os.environ.get('DB_PASS', '')
+    CLOUD_SQL_DB_NAME = os.environ.get('DB_NAME', '')
+    # Pool de conexões: configuração única para todas as engines (síncrona e asyncio). Cada engine abre até
+    # DB_POOL_SIZE + DB_MAX_OVERFLOW conexões; dimensione pelos workers (ver 'db_pools' em /metrics)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '2'))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', '30'))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'True').lower() == 'true'
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '30000'))  # Só Postgres; 0 desativa
+    # Réplica de leitura para as consultas do dashboard (vazio: tudo no primário). Uma leitura só vai para a réplica
+    # com atraso de replicação até DB_REPLICA_MAX_LAG_SECONDS (DB_REPLICA_FRESH_MAX_LAG_SECONDS nas telas que precisam
+    # de dados recentes), medido no máximo a cada DB_REPLICA_LAG_CHECK_SECONDS; acima disso, ou fora do ar, vai para o primário
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL', '')
+    DB_REPLICA_MAX_LAG_SECONDS = float(os.environ.get('DB_REPLICA_MAX_LAG_SECONDS', '30'))
+    DB_REPLICA_FRESH_MAX_LAG_SECONDS = float(os.environ.get('DB_REPLICA_FRESH_MAX_LAG_SECONDS', '2'))
+    DB_REPLICA_LAG_CHECK_SECONDS = float(os.environ.get('DB_REPLICA_LAG_CHECK_SECONDS', '5'))
     SQLALCHEMY_ENGINE_OPTIONS = {
         'creator': getconn,
-        'pool_size': 5,
-        'max_overflow': 2,
-        'pool_timeout': 30,
-        'pool_recycle': 1800,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
     }
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
@@ -89,7 +112,73 @@ class Config:
     ENABLE_ASYNC_PROCESSING = os.environ.get('ENABLE_ASYNC_PROCESSING', 'True').lower() == 'true'
     MAX_PROCESSING_THREADS = int(os.environ.get('MAX_PROCESSING_THREADS', '5'))
 
-    # Token for internal task processing
+    # Ingest queue configuration (jobs persistidos em 'ingest_jobs' e consumidos por MAX_PROCESSING_THREADS workers)
+    INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', '3'))
+    INGEST_POLL_INTERVAL_SECONDS = float(os.environ.get('INGEST_POLL_INTERVAL_SECONDS', '5'))
+    INGEST_STALE_JOB_SECONDS = int(os.environ.get('INGEST_STALE_JOB_SECONDS', '300'))
+
+    # Agrupamento de rajadas: mensagens de texto seguidas da mesma conversa, chegando com menos de
+    # MESSAGE_COALESCE_WINDOW_MS entre si, são respondidas como um único turno da IA (0 desativa)
+    MESSAGE_COALESCE_WINDOW_MS = int(os.environ.get('MESSAGE_COALESCE_WINDOW_MS', '2000'))
+    MESSAGE_COALESCE_MAX_MESSAGES = int(os.environ.get('MESSAGE_COALESCE_MAX_MESSAGES', '5'))
+
+    # Pipeline assíncrono (asyncio): os jobs da fila são processados em um event loop, com HTTP/IA/banco
+    # não bloqueantes. ASYNC_PIPELINE_CONCURRENCY é o número de lanes (conversas em andamento ao mesmo tempo).
+    ENABLE_ASYNC_PIPELINE = os.environ.get('ENABLE_ASYNC_PIPELINE', 'False').lower() == 'true'
+    ASYNC_PIPELINE_CONCURRENCY = int(os.environ.get('ASYNC_PIPELINE_CONCURRENCY', '200'))
+    HTTP_CLIENT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CLIENT_TIMEOUT_SECONDS', '30'))
+
+    # Controle de admissão (mensagens pendentes na fila local ou em processamento). Acima de cada marca:
+    # DEGRADED pula extração de perfil/pedido, BUSY responde BUSY_REPLY_MESSAGE sem IA e REJECT devolve 429
+    # (a Evolution API reenvia depois de LOAD_REJECT_RETRY_AFTER_SECONDS). 0 desativa o nível.
+    LOAD_DEGRADED_HIGH_WATER = int(os.environ.get('LOAD_DEGRADED_HIGH_WATER', '50'))
+    LOAD_BUSY_HIGH_WATER = int(os.environ.get('LOAD_BUSY_HIGH_WATER', '150'))
+    LOAD_REJECT_HIGH_WATER = int(os.environ.get('LOAD_REJECT_HIGH_WATER', '300'))
+    LOAD_REJECT_RETRY_AFTER_SECONDS = int(os.environ.get('LOAD_REJECT_RETRY_AFTER_SECONDS', '30'))
+    BUSY_REPLY_MESSAGE = os.environ.get('BUSY_REPLY_MESSAGE', 'Estamos com muitas mensagens agora 🙏 Já já respondemos você!')
+
+    # Cache telefone -> conversa (evita consultar 'conversations' a cada mensagem de clientes conhecidos)
+    CONVERSATION_CACHE_SIZE = int(os.environ.get('CONVERSATION_CACHE_SIZE', '10000'))
+    CONVERSATION_CACHE_TTL_SECONDS = float(os.environ.get('CONVERSATION_CACHE_TTL_SECONDS', '300'))
+
+    # Histórico usado no prompt da IA: últimas N mensagens de cada conversa ativa, mantidas em memória
+    CONVERSATION_HISTORY_WINDOW = int(os.environ.get('CONVERSATION_HISTORY_WINDOW', '20'))
+    HISTORY_BUFFER_MAX_CONVERSATIONS = int(os.environ.get('HISTORY_BUFFER_MAX_CONVERSATIONS', '2000'))
+    HISTORY_BUFFER_TTL_SECONDS = float(os.environ.get('HISTORY_BUFFER_TTL_SECONDS', '600'))
+
+    # Perfil do usuário em memória (conversa -> profile_data); as chaves extraídas num turno são gravadas em um único upsert
+    PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '10000'))
+    PROFILE_CACHE_TTL_SECONDS = float(os.environ.get('PROFILE_CACHE_TTL_SECONDS', '300'))
+
+    # Estatísticas do dashboard (/dashboard/api/stats, polling de cada aba aberta): recalculadas no máximo uma vez por TTL
+    DASHBOARD_STATS_TTL_SECONDS = float(os.environ.get('DASHBOARD_STATS_TTL_SECONDS', '15'))
+
+    # Modo silencioso: janelas ativas ficam em memória; recarregadas do banco a cada SILENT_MODE_REFRESH_SECONDS
+    # para refletir ativações/desativações feitas pelo dashboard de outras instâncias
+    SILENT_MODE_REFRESH_SECONDS = float(os.environ.get('SILENT_MODE_REFRESH_SECONDS', '60'))
+
+    # Arquivo de mensagens: as mensagens de conversas paradas há mais de MESSAGE_ARCHIVE_AFTER_DAYS dias saem das tabelas
+    # e vão para arquivos JSONL gzip mensais (archive_messages.py), lidos de volta pelo dashboard. MESSAGE_ARCHIVE_PATH é um
+    # diretório local ou gs://bucket/prefixo (use um bucket privado, não o de mídia, que é público)
+    MESSAGE_ARCHIVE_PATH = os.environ.get('MESSAGE_ARCHIVE_PATH', 'instance/message_archive')
+    MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', '90'))
+
+    # Retenção (LGPD): dias que cada tabela guarda (0 = para sempre). purge_expired_data.py ou POST /tasks/purge-expired-data
+    # apagam o que passou, com os objetos de mídia no bucket e o arquivo de mensagens, em lotes de RETENTION_BATCH_SIZE
+    # linhas por transação com RETENTION_BATCH_PAUSE_SECONDS de pausa entre eles
+    # No arquivo de mensagens, respostas da IA e mídias seguem RETENTION_MESSAGES_DAYS (saem com o mês inteiro)
+    RETENTION_MESSAGES_DAYS = int(os.environ.get('RETENTION_MESSAGES_DAYS', '0'))
+    RETENTION_AI_RESPONSES_DAYS = int(os.environ.get('RETENTION_AI_RESPONSES_DAYS', '0'))
+    RETENTION_MEDIA_FILES_DAYS = int(os.environ.get('RETENTION_MEDIA_FILES_DAYS', '0'))
+    RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '5000'))
+    RETENTION_BATCH_PAUSE_SECONDS = float(os.environ.get('RETENTION_BATCH_PAUSE_SECONDS', '0.5'))
+
+    # Gravação do tráfego do webhook para testes de carga (replay_webhook.py). Vazio desativa.
+    # Os blobs de mídia em base64 são removidos, a menos que TRAFFIC_RECORDER_CAPTURE_MEDIA seja True.
+    TRAFFIC_RECORDER_PATH = os.environ.get('TRAFFIC_RECORDER_PATH', '')
+    TRAFFIC_RECORDER_CAPTURE_MEDIA = os.environ.get('TRAFFIC_RECORDER_CAPTURE_MEDIA', 'False').lower() == 'true'
+
+    # Token for internal task processing (/tasks/*) and for reading /metrics (Authorization: Bearer <token>)
     INTERNAL_TASK_TOKEN = os.environ.get('INTERNAL_TASK_TOKEN', 'super-secret-dev-token')
 
     # Logging configuration
@@ -97,3 +186,6 @@ class Config:
 
     # List of phone numbers to ignore
     IGNORE_LIST_NUMBERS = get_list_from_env('IGNORE_LIST_NUMBERS', '5511999998888')
+
+    # Quantos IDs de mensagens recentes o webhook guarda em memória para descartar reentregas
+    WEBHOOK_DEDUPE_CACHE_SIZE = int(os.environ.get('WEBHOOK_DEDUPE_CACHE_SIZE', '10000'))
@@ -1,6 +1,12 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from fastapi import Depends
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from config import Config
+from services.pool_metrics import PoolMetrics
+from services.read_replica import ReplicaRouter
 
 # Assuming Base is defined in models.py or extensions.py
 # from models import Base # Or from extensions import Base
@@ -12,18 +18,144 @@ from extensions import Base # Import the Base from extensions.py
 # Configure the database URL from Config
 SQLALCHEMY_DATABASE_URL = Config.SQLALCHEMY_DATABASE_URL
 
+# Driver assíncrono equivalente a cada driver síncrono usado pela aplicação
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+pg8000': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+}
+
+# Instrumentação do pool de cada engine, por nome (exposta em /metrics)
+pool_metrics = {}
+
+class CloudSqlAsyncConnector:
+    """
+    async_creator das engines asyncio no Cloud SQL (asyncpg), o equivalente do creator=getconn da engine
+    síncrona. O Connector fica preso ao event loop em que foi criado: é criado na primeira conexão, no loop
+    da engine, e fechado por dispose_async_engine.
+    """
+
+    def __init__(self):
+        self._connector = None
+
+    async def __call__(self):
+        if self._connector is None:
+            from google.cloud.sql.connector import create_async_connector  # Só o deploy no Cloud SQL precisa do conector
+            self._connector = await create_async_connector()
+        return await self._connector.connect_async(
+            Config.CLOUD_SQL_INSTANCE_CONNECTION_NAME, "asyncpg",
+            user=Config.CLOUD_SQL_DB_USER, password=Config.CLOUD_SQL_DB_PASS, db=Config.CLOUD_SQL_DB_NAME,
+        )
+
+    async def close(self):
+        if self._connector is not None:
+            await self._connector.close_async()
+            self._connector = None
+
+# Connector do Cloud SQL de cada engine asyncio que conecta pelo conector
+_cloud_sql_connectors = {}
+
+def to_async_url(url: str) -> str:
+    """Converte a URL do banco para o driver asyncio correspondente (ex: pg8000 -> asyncpg)."""
+    parsed = make_url(url)
+    async_driver = ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)
+    return parsed.set(drivername=async_driver).render_as_string(hide_password=False)
+
+def engine_options(url: str, pool_class: type, metrics: PoolMetrics, is_async: bool = False) -> dict:
+    """
+    Opções de create_engine a partir de Config.SQLALCHEMY_ENGINE_OPTIONS, a única configuração de pool.
+    O creator do Cloud SQL só vale para a URI sem host do conector; as engines asyncio usam um async_creator
+    do mesmo conector, com INSTANCE_CONNECTION_NAME, DB_USER, DB_PASS e DB_NAME.
+    """
+    options = dict(Config.SQLALCHEMY_ENGINE_OPTIONS)
+    creator = options.pop('creator', None)
+    parsed = make_url(url)
+    if parsed.get_backend_name() == 'sqlite':
+        # connect_args={"check_same_thread": False} is needed for SQLite
+        # if multiple threads/requests might access the same connection.
+        options['connect_args'] = {"check_same_thread": False}
+        if parsed.database in (None, '', ':memory:'):
+            return options # Banco em memória: uma conexão por thread, sem pool dimensionável
+    elif url == Config.SQLALCHEMY_DATABASE_URI and is_async:
+        if not Config.CLOUD_SQL_INSTANCE_CONNECTION_NAME:
+            raise RuntimeError("Sem DATABASE_URL, as engines asyncio conectam ao Cloud SQL pelo conector: "
+                               "defina INSTANCE_CONNECTION_NAME, DB_USER, DB_PASS e DB_NAME (ou DATABASE_URL).")
+        options['async_creator'] = CloudSqlAsyncConnector()
+    elif creator and url == Config.SQLALCHEMY_DATABASE_URI:
+        options['creator'] = creator
+    options['poolclass'] = metrics.pool_class(pool_class)
+    return options
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL permite que os workers da fila de ingestão leiam enquanto o webhook grava novos jobs
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+def _set_statement_timeout(dbapi_connection, connection_record):
+    # Consultas presas não seguram a conexão do pool indefinidamente; commit para o SET valer na sessão
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET statement_timeout = {int(Config.DB_STATEMENT_TIMEOUT_MS)}")
+    cursor.close()
+    dbapi_connection.commit()
+
+def configure_engine(sync_engine, name: str, metrics: PoolMetrics):
+    """Pragmas/timeout por conexão e instrumentação do pool (recebe a sync_engine das engines asyncio)."""
+    backend = sync_engine.dialect.name
+    if backend == 'sqlite':
+        event.listen(sync_engine, "connect", _set_sqlite_pragmas)
+    elif backend == 'postgresql' and Config.DB_STATEMENT_TIMEOUT_MS > 0:
+        event.listen(sync_engine, "connect", _set_statement_timeout)
+    metrics.attach(sync_engine)
+    pool_metrics[name] = metrics
+
 # Create the SQLAlchemy engine
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    # connect_args={"check_same_thread": False} is needed for SQLite
-    # if multiple threads/requests might access the same connection.
-    # For other databases (PostgreSQL, MySQL), this is usually not needed.
-    connect_args={"check_same_thread": False} if "sqlite" in SQLALCHEMY_DATABASE_URL else {},
-)
+_engine_metrics = PoolMetrics('sync')
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL, QueuePool, _engine_metrics))
+configure_engine(engine, 'sync', _engine_metrics)
+
+def create_async_db_engine(name: str, url: str = SQLALCHEMY_DATABASE_URL):
+    """
+    Engine asyncio (asyncpg no Postgres, aiosqlite no SQLite). As conexões ficam presas ao event loop
+    em que foram abertas, então cada event loop (servidor, pipeline da IngestQueue) usa a sua engine.
+    """
+    metrics = PoolMetrics(name)
+    options = engine_options(url, AsyncAdaptedQueuePool, metrics, is_async=True)
+    new_engine = create_async_engine(to_async_url(url), **options)
+    configure_engine(new_engine.sync_engine, name, metrics)
+    if 'async_creator' in options:
+        _cloud_sql_connectors[new_engine] = options['async_creator']
+    return new_engine
+
+async def dispose_async_engine(async_db_engine):
+    """Fecha as conexões da engine asyncio e o Connector do Cloud SQL dela; chame no event loop da engine."""
+    await async_db_engine.dispose()
+    connector = _cloud_sql_connectors.get(async_db_engine)
+    if connector:
+        await connector.close()
+
+def make_async_sessionmaker(bind):
+    # expire_on_commit=False: com AsyncSession, recarregar atributos expirados exigiria I/O implícito fora do await
+    return async_sessionmaker(bind, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 # Create a SessionLocal class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Engine asyncio das rotas (event loop do servidor)
+async_engine = create_async_db_engine('async_routes')
+AsyncSessionLocal = make_async_sessionmaker(async_engine)
+
+# Réplica de leitura do dashboard (pool próprio, no event loop do servidor); sem DATABASE_REPLICA_URL tudo vai para o primário
+replica_async_engine = create_async_db_engine('async_replica', Config.DATABASE_REPLICA_URL) if Config.DATABASE_REPLICA_URL else None
+read_router = ReplicaRouter(
+    replica_async_engine,
+    make_async_sessionmaker(replica_async_engine) if replica_async_engine else None,
+    check_interval_seconds=Config.DB_REPLICA_LAG_CHECK_SECONDS,
+)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -31,6 +163,37 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """Dependência das rotas async: as consultas aguardam o banco sem bloquear o event loop."""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def route_read_session(primary: AsyncSession, max_lag_seconds: float):
+    # A sessão do primário só abre conexão na primeira consulta: não custa nada quando a leitura vai para a réplica
+    session_factory = await read_router.session_factory_for(max_lag_seconds)
+    if session_factory is None:
+        yield primary
+        return
+    async with session_factory() as db:
+        yield db
+
+async def get_async_read_db(primary: AsyncSession = Depends(get_async_db)):
+    """Dependência das rotas só de leitura (listas, busca, estatísticas): réplica se o atraso é tolerável, senão o primário."""
+    async for db in route_read_session(primary, Config.DB_REPLICA_MAX_LAG_SECONDS):
+        yield db
+
+async def get_async_fresh_read_db(primary: AsyncSession = Depends(get_async_db)):
+    """Como get_async_read_db, para telas que precisam de dados recentes (mensagens, atendimentos pendentes)."""
+    async for db in route_read_session(primary, Config.DB_REPLICA_FRESH_MAX_LAG_SECONDS):
+        yield db
+
 def create_db_tables():
     # This function can be called at application startup to create tables
-    Base.metadata.create_all(bind=engine) 
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    # Sem ferramenta de migração: colunas novas em tabelas existentes são adicionadas aqui
+    from services.conversation_stats import upgrade_conversation_stats_schema
+    upgrade_conversation_stats_schema(engine)
+    from services.ingest_queue import upgrade_ingest_jobs_schema
+    upgrade_ingest_jobs_schema(engine)
+    from services.full_text_search import setup_full_text_search
+    setup_full_text_search(engine)
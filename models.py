@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, UniqueConstraint, Index, JSON
-from sqlalchemy.sql import func
+from sqlalchemy import BigInteger, Column, Integer, String, Boolean, DateTime, ForeignKey, Text, UniqueConstraint, Index, JSON
+from sqlalchemy.sql import false, func, literal_column
+import sqlalchemy.dialects.postgresql  # noqa: F401 - Registra to_tsvector/ts_rank_cd (tipos da busca textual) antes das expressões abaixo
 from datetime import datetime, timezone
 from extensions import Base # Import Base from extensions.py
 from sqlalchemy.orm import relationship
@@ -25,6 +26,11 @@ class Conversation(BaseModel):
     user_phone = Column(String(20), nullable=False, unique=True, index=True)
     contact_name = Column(String(100))
     is_active = Column(Boolean, default=True)
+
+    # Mantidos na gravação das mensagens (services/conversation_stats.py), para a listagem não agregar 'messages'
+    message_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_message_at = Column(DateTime)
+    last_message_preview = Column(String(200))
     
     # Relationship with messages
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
@@ -140,6 +146,25 @@ class MediaFile(BaseModel):
     def __repr__(self):
         return f'<MediaFile {self.file_name}>'
 
+class MessageArchiveSegment(BaseModel):
+    __tablename__ = 'message_archive_segments'
+
+    # Mensagens de uma conversa em um mês, arquivadas (services/message_archive.py) como um membro gzip de
+    # `location`; o trecho [byte_offset, byte_offset + byte_length) é lido sozinho, sem o resto do arquivo
+    conversation_id = Column(Integer, ForeignKey(f'{SCHEMA_NAME}.conversations.id' if SCHEMA_NAME else 'conversations.id'), nullable=False)
+    partition = Column(String(7), nullable=False)  # Mês das mensagens, 'AAAA-MM'
+    location = Column(String(500), nullable=False)  # Arquivo local ou objeto no bucket
+    byte_offset = Column(BigInteger, nullable=False)
+    byte_length = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    first_message_at = Column(DateTime)
+    last_message_at = Column(DateTime)
+
+    conversation = relationship("Conversation")
+
+    def __repr__(self):
+        return f'<MessageArchiveSegment conversation={self.conversation_id} {self.partition} {self.message_count} messages>'
+
 class HumanAgentRequest(BaseModel):
     __tablename__ = 'human_agent_requests' # Nome da tabela corrigido para plural e snake_case
     conversation_id = Column(Integer, ForeignKey(f'{SCHEMA_NAME}.conversations.id' if SCHEMA_NAME else 'conversations.id'), nullable=False, index=True)
@@ -183,23 +208,39 @@ class SilentMode(BaseModel):
     
     @staticmethod
     def is_conversation_silent(conversation_id):
-        """Verifica se uma conversa está em modo silencioso"""
-        now = datetime.now(timezone.utc)
-        # Use SessionLocal for static method or pass db session
-        from database_session import SessionLocal
-        db_session = SessionLocal()
-        try:
-            silent = db_session.query(SilentMode).filter_by(
-                conversation_id=conversation_id,
-                is_active=True
-            ).filter(SilentMode.expires_at > now).first()
-            return bool(silent)
-        finally:
-            db_session.close()
+        """Verifica se uma conversa está em modo silencioso (registro em memória, ver services/silent_mode.py)"""
+        from services.silent_mode import silent_mode_registry
+        if silent_mode_registry.needs_refresh():
+            from database_session import SessionLocal
+            db_session = SessionLocal()
+            try:
+                silent_mode_registry.load(db_session)
+            finally:
+                db_session.close()
+        return silent_mode_registry.is_silent(conversation_id)
     
     def __repr__(self):
         return f'<SilentMode {self.conversation_id} expires={self.expires_at}>'
 
+class IngestJob(BaseModel):
+    __tablename__ = 'ingest_jobs'
+
+    # Telefone do remetente; define a lane do worker e garante a ordem por conversa
+    conversation_key = Column(String(30), nullable=True, index=True)
+    # Payload da mensagem como recebido no webhook, persistido antes de responder ao Evolution API
+    message_payload = Column(JSON, nullable=False)
+    # Contexto do webhook (ex: 'instance' no formato novo, 'contacts' no formato antigo)
+    context_payload = Column(JSON, nullable=True)
+    # Mensagem de texto (parse feito uma única vez no webhook): pode ser agrupada com as seguintes da conversa
+    is_text = Column(Boolean, nullable=False, default=False, server_default=false())
+    status = Column(String(20), nullable=False, default='pending', index=True)  # pending, processing, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    locked_at = Column(DateTime, nullable=True)  # Quando um worker reivindicou o job
+    last_error = Column(Text, nullable=True)
+
+    def __repr__(self):
+        return f'<IngestJob {self.id} status={self.status} attempts={self.attempts}>'
+
 class CompanyInfo(BaseModel):
     __tablename__ = 'company_info'
     # __table_args__ = BaseModel.__table_args__.copy()
@@ -222,12 +263,28 @@ class VectorEmbedding(BaseModel):
         return f'<VectorEmbedding for CompanyInfo {self.company_info_id}>'
 
 # Adicionar Índices (Opcional, mas bom para performance)
+Index('idx_conversations_last_message', Conversation.last_message_at, Conversation.id)
 Index('idx_messages_conversation_timestamp', Message.conversation_id, Message.timestamp)
 Index('idx_ai_responses_message_created', AIResponse.message_id, AIResponse.created_at)
 Index('idx_media_files_message', MediaFile.message_id)
+Index('idx_message_archive_segments_conversation', MessageArchiveSegment.conversation_id, MessageArchiveSegment.first_message_at)
 Index('idx_human_agent_requests_conversation_created', HumanAgentRequest.conversation_id, HumanAgentRequest.created_at)
 Index('idx_silent_mode_conversation_active_expires', SilentMode.conversation_id, SilentMode.is_active, SilentMode.expires_at)
 Index('idx_user_profiles_conversation', UserProfile.conversation_id)
 Index('idx_orders_conversation_status', Order.conversation_id, Order.status)
 Index('idx_company_info_type', CompanyInfo.info_type)
+Index('idx_ingest_jobs_status_created', IngestJob.status, IngestJob.created_at)
 Index('idx_vector_embeddings_company_info', VectorEmbedding.company_info_id)
+
+# Busca textual no Postgres: índices GIN de expressão, atualizados pelo próprio banco a cada INSERT/UPDATE.
+# As consultas precisam usar exatamente estas expressões (services/full_text_search.py); no SQLite a busca usa FTS5.
+MESSAGE_SEARCH_DOCUMENT = func.to_tsvector(literal_column("'portuguese'"), func.coalesce(Message.content, literal_column("''")))
+CONTACT_SEARCH_DOCUMENT = func.to_tsvector(
+    literal_column("'simple'"),
+    func.coalesce(Conversation.contact_name, literal_column("''")).op('||')(literal_column("' '")).op('||')(Conversation.user_phone)
+)
+MESSAGE_SEARCH_INDEX = Index('idx_messages_content_search', MESSAGE_SEARCH_DOCUMENT, postgresql_using='gin').ddl_if(dialect='postgresql')
+CONTACT_SEARCH_INDEX = Index('idx_conversations_contact_search', CONTACT_SEARCH_DOCUMENT, postgresql_using='gin').ddl_if(dialect='postgresql')
+# Índices só de expressão não se associam sozinhos à tabela (o primeiro argumento é a configuração, não uma coluna)
+Message.__table__.append_constraint(MESSAGE_SEARCH_INDEX)
+Conversation.__table__.append_constraint(CONTACT_SEARCH_INDEX)
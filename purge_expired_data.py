@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Aplica a política de retenção (LGPD): apaga mensagens, respostas da IA e mídias (com os objetos no bucket)
+mais antigas que RETENTION_MESSAGES_DAYS / RETENTION_AI_RESPONSES_DAYS / RETENTION_MEDIA_FILES_DAYS, e os
+meses do arquivo de mensagens (MESSAGE_ARCHIVE_PATH) que passaram da retenção de mensagens. Apaga em lotes
+curtos com pausa entre eles, então pode rodar com o sistema no ar. Rode periodicamente (ex: cron diário),
+depois de archive_messages.py.
+
+Uso:
+    python purge_expired_data.py
+    python purge_expired_data.py --messages-days 730 --media-days 180 --batch-size 2000 --pause 1
+"""
+
+import argparse
+import sys
+import time
+
+from config import Config
+from database_session import SessionLocal, create_db_tables
+from services.data_retention import DataRetention, RetentionPolicy
+from services.message_archive import archive_storage
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Apaga os dados que passaram da política de retenção.")
+    parser.add_argument('--messages-days', type=int, default=Config.RETENTION_MESSAGES_DAYS,
+                        help=f"Dias de retenção das mensagens; 0 mantém para sempre (padrão: {Config.RETENTION_MESSAGES_DAYS})")
+    parser.add_argument('--ai-responses-days', type=int, default=Config.RETENTION_AI_RESPONSES_DAYS,
+                        help=f"Dias de retenção das respostas da IA (padrão: {Config.RETENTION_AI_RESPONSES_DAYS})")
+    parser.add_argument('--media-days', type=int, default=Config.RETENTION_MEDIA_FILES_DAYS,
+                        help=f"Dias de retenção das mídias e seus objetos no bucket (padrão: {Config.RETENTION_MEDIA_FILES_DAYS})")
+    parser.add_argument('--batch-size', type=int, default=Config.RETENTION_BATCH_SIZE,
+                        help=f"Linhas por transação (padrão: {Config.RETENTION_BATCH_SIZE})")
+    parser.add_argument('--pause', type=float, default=Config.RETENTION_BATCH_PAUSE_SECONDS,
+                        help=f"Segundos de pausa entre lotes (padrão: {Config.RETENTION_BATCH_PAUSE_SECONDS})")
+    parser.add_argument('--archive-path', default=Config.MESSAGE_ARCHIVE_PATH,
+                        help=f"Arquivo de mensagens: diretório local ou gs://bucket/prefixo (padrão: {Config.MESSAGE_ARCHIVE_PATH})")
+    return parser.parse_args(argv)
+
+
+def print_progress(run):
+    print(f"  lote {run.batches}: {run.media_files} mídias, {run.ai_responses} respostas da IA, {run.messages} mensagens, "
+          f"{run.archive_segments} segmentos do arquivo apagados", flush=True)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    policy = RetentionPolicy(messages_days=args.messages_days, ai_responses_days=args.ai_responses_days,
+                             media_files_days=args.media_days)
+    if not (policy.messages_days or policy.ai_responses_days or policy.media_files_days):
+        print("Nenhuma política de retenção configurada (RETENTION_*_DAYS); nada a apagar.")
+        return 0
+    create_db_tables()  # Garante a tabela message_archive_segments
+
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        run = DataRetention(db, policy, archive=archive_storage(args.archive_path), batch_size=args.batch_size,
+                            pause_seconds=args.pause, progress=print_progress).purge()
+    finally:
+        db.close()
+    print(f"✅ {run.messages} mensagens, {run.ai_responses} respostas da IA, {run.media_files} mídias "
+          f"({run.blobs_deleted} objetos) e {run.archive_partitions} meses do arquivo apagados "
+          f"em {time.perf_counter() - started:.1f}s")
+    if run.blob_failures:
+        print(f"⚠️ {run.blob_failures} mídias mantidas: o objeto no bucket não pôde ser apagado (tente de novo)")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Reproduz uma captura do TrafficRecorder (TRAFFIC_RECORDER_PATH) contra a aplicação, em processo,
+com WhatsAppService, AIService e CloudStorageService substituídos por stubs (nenhuma chamada externa).
+
+Mede a latência ponta a ponta de cada mensagem (do POST no webhook até o envio da resposta para o
+mesmo número) e o throughput, com os mesmos workers, fila e banco usados em produção.
+
+Uso:
+    python replay_webhook.py captura.jsonl.gz --speed 10
+    python replay_webhook.py captura.jsonl.gz --speed max --concurrency 100 --ai-latency-ms 800
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from typing import Dict, List, Optional
+
+import httpx
+
+from config import Config
+from services.webhook_filter import WebhookFilter
+
+REPLAY_API_KEY = 'replay-api-key'
+
+
+class LatencyTracker:
+    """Associa cada resposta enviada às mensagens pendentes do mesmo número."""
+
+    def __init__(self):
+        self.latencies_ms: List[float] = []
+        self.replies = 0
+        self._pending: Dict[str, deque] = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def message_sent(self, phone: str, started_at: float):
+        with self._lock:
+            self._pending[phone].append(started_at)
+
+    def message_rejected(self, phone: str, started_at: float):
+        with self._lock:
+            pending = self._pending.get(phone)
+            if pending and started_at in pending:
+                pending.remove(started_at)
+                if not pending:
+                    del self._pending[phone]
+
+    def reply_sent(self, phone: str):
+        now = time.perf_counter()
+        with self._lock:
+            self.replies += 1
+            # Uma resposta pode cobrir várias mensagens (rajadas agrupadas em um turno)
+            pending = self._pending.pop(phone, deque())
+            self.latencies_ms.extend((now - started_at) * 1000 for started_at in pending)
+
+    def unanswered(self) -> int:
+        with self._lock:
+            return sum(len(pending) for pending in self._pending.values())
+
+
+class StubWhatsAppService:
+    def __init__(self, tracker: LatencyTracker):
+        self.tracker = tracker
+
+    def send_text_message(self, to_number: str, text: str):
+        self.tracker.reply_sent(to_number)
+        return {'success': True}
+
+    async def send_text_message_async(self, to_number: str, text: str):
+        return self.send_text_message(to_number, text)
+
+    def mark_message_as_read(self, *args, **kwargs):
+        return True
+
+    def download_media(self, *args, **kwargs):
+        return b'replay-media'
+
+    async def download_media_async(self, *args, **kwargs):
+        return b'replay-media'
+
+    async def aclose(self):
+        pass
+
+
+class StubGeolocationService:
+    def get_distance_and_duration(self, origin, destination):
+        return (5.0, '5 km', 600, '10 min')
+
+    async def get_distance_and_duration_async(self, origin, destination):
+        return self.get_distance_and_duration(origin, destination)
+
+    def calculate_shipping_fee(self, distance_km):
+        return 10.0
+
+    async def aclose(self):
+        pass
+
+
+class StubAIService:
+    """Responde depois de ai_latency_ms, simulando o tempo de resposta do Gemini."""
+
+    def __init__(self, ai_latency_ms: int):
+        self.ai_latency = ai_latency_ms / 1000.0
+        self.geolocation_service = StubGeolocationService()
+
+    def _reply(self):
+        time.sleep(self.ai_latency)
+        return {'success': True, 'response': 'ok', 'metadata': {'agent_name': 'Replay Stub', 'processing_time_ms': int(self.ai_latency * 1000)}}
+
+    async def _reply_async(self):
+        await asyncio.sleep(self.ai_latency)
+        return {'success': True, 'response': 'ok', 'metadata': {'agent_name': 'Replay Stub', 'processing_time_ms': int(self.ai_latency * 1000)}}
+
+    def process_text_message(self, *args, **kwargs):
+        return self._reply()
+
+    process_image_message = process_video_message = process_audio_message = process_location_message = process_text_message
+
+    async def process_text_message_async(self, *args, **kwargs):
+        return await self._reply_async()
+
+    process_image_message_async = process_video_message_async = process_audio_message_async = process_location_message_async = process_text_message_async
+
+    def extract_profile_info(self, text):
+        return None
+
+    async def extract_profile_info_async(self, text):
+        return None
+
+    def extract_order_info(self, text, conversation_history):
+        return None
+
+    async def extract_order_info_async(self, text, conversation_history):
+        return None
+
+
+class StubCloudStorageService:
+    def upload_file(self, file_data, filename, content_type=None):
+        blob_name = f"whatsapp_media/{filename}"
+        return blob_name, f"https://storage.replay.local/{blob_name}"
+
+    def delete_file(self, blob_name):
+        return True
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil pelo método nearest-rank."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def parse_speed(value: str) -> Optional[float]:
+    """'1', '10', '10x' ou 'max' (sem esperas entre as requisições -> None)."""
+    value = value.lower()
+    if value == 'max':
+        return None
+    speed = float(value[:-1] if value.endswith('x') else value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed deve ser maior que zero ou 'max'")
+    return speed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reproduz uma captura de tráfego do webhook e mede latência/throughput.")
+    parser.add_argument('capture', help="Arquivo .jsonl.gz gravado com TRAFFIC_RECORDER_PATH")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help="1x, 10x, ... ou 'max' (padrão: 1)")
+    parser.add_argument('--concurrency', type=int, default=50, help="Máximo de POSTs simultâneos (padrão: 50)")
+    parser.add_argument('--ai-latency-ms', type=int, default=200, help="Latência simulada da IA (padrão: 200)")
+    parser.add_argument('--database-url', default=None, help="Banco usado no replay (padrão: SQLite temporário)")
+    parser.add_argument('--drain-timeout', type=float, default=120.0, help="Tempo máximo esperando as respostas pendentes")
+    parser.add_argument('--json', action='store_true', help="Imprime o relatório em JSON")
+    return parser.parse_args(argv)
+
+
+def install_stubs(webhook_module, tracker: LatencyTracker, ai_latency_ms: int):
+    webhook_module.whatsapp_service = StubWhatsAppService(tracker)
+    webhook_module.ai_service = StubAIService(ai_latency_ms)
+    webhook_module.cloud_storage = StubCloudStorageService()
+
+
+async def replay(records: List[dict], app, webhook_module, tracker: LatencyTracker, speed: Optional[float],
+                 concurrency: int, drain_timeout: float) -> dict:
+    statuses: Counter = Counter()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    # Filtro próprio, na ordem da captura: não altera os contadores nem os IDs vistos pelo filtro do webhook
+    message_filter = WebhookFilter()
+
+    async def post(client, record, phones):
+        payload = dict(record['payload'])
+        payload['apikey'] = REPLAY_API_KEY
+        async with semaphore:
+            # Registrado antes do POST: sem ENABLE_ASYNC_PROCESSING a resposta é enviada durante a requisição
+            started_at = time.perf_counter()
+            for phone in phones:
+                tracker.message_sent(phone, started_at)
+            response = await client.post(record['path'], json=payload)
+        statuses[response.status_code] += 1
+        if response.status_code != 200 or response.json().get('status') != 'success':
+            for phone in phones:
+                tracker.message_rejected(phone, started_at)
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://replay') as client:
+            start = time.perf_counter()
+            first_t = records[0]['t'] if records else 0
+            tasks = []
+            for record in records:
+                if speed:
+                    delay = (record['t'] - first_t) / speed - (time.perf_counter() - start)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                phones = accepted_phones(record['payload'], message_filter, webhook_module.extract_sender_phone)
+                tasks.append(asyncio.create_task(post(client, record, phones)))
+            await asyncio.gather(*tasks)
+            sent_at = time.perf_counter()
+
+            deadline = sent_at + drain_timeout
+            while time.perf_counter() < deadline and (tracker.unanswered() or webhook_module.ingest_queue.backlog()):
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - start
+
+    latencies = tracker.latencies_ms
+    return {
+        'requests': len(records),
+        'status_codes': {str(code): count for code, count in sorted(statuses.items())},
+        'messages_answered': len(latencies),
+        'messages_unanswered': tracker.unanswered(),
+        'replies_sent': tracker.replies,
+        'elapsed_seconds': round(elapsed, 3),
+        'send_seconds': round(sent_at - start, 3),
+        'throughput_rps': round(len(records) / elapsed, 2) if elapsed else None,
+        'throughput_messages_per_second': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            name: (round(value, 1) if value is not None else None)
+            for name, value in (
+                ('p50', percentile(latencies, 50)),
+                ('p95', percentile(latencies, 95)),
+                ('p99', percentile(latencies, 99)),
+                ('max', max(latencies) if latencies else None),
+            )
+        },
+    }
+
+
+def messages_of(payload: dict) -> List[dict]:
+    """Mensagens contidas no payload (formato novo 'messages.upsert' ou antigo 'entry/changes')."""
+    if payload.get('event') == 'messages.upsert':
+        return [payload['data']] if payload.get('data') else []
+    return [
+        message
+        for entry in payload.get('entry', [])
+        for change in entry.get('changes', [])
+        for message in change.get('value', {}).get('messages', [])
+    ]
+
+
+def accepted_phones(payload: dict, message_filter: WebhookFilter, extract_sender_phone) -> List[str]:
+    """Números das mensagens que o webhook processa: fromMe, status, números ignorados e reentregas não recebem resposta."""
+    phones = []
+    for message in messages_of(payload):
+        if message_filter.rejection_reason(message):
+            continue
+        message_filter.remember([WebhookFilter.message_id_of(message)])
+        phone = extract_sender_phone(message)
+        if phone:
+            phones.append(phone)
+    return phones
+
+
+def print_report(report: dict):
+    latency = report['latency_ms']
+    print(f"\n📊 Replay de {report['requests']} requisições em {report['elapsed_seconds']}s "
+          f"(envio: {report['send_seconds']}s)")
+    print(f"   Status HTTP: {report['status_codes']}")
+    print(f"   Mensagens respondidas: {report['messages_answered']} | sem resposta: {report['messages_unanswered']} "
+          f"| respostas enviadas: {report['replies_sent']}")
+    print(f"   Throughput: {report['throughput_rps']} req/s, {report['throughput_messages_per_second']} msg/s")
+    print(f"   Latência ponta a ponta (ms): p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # O banco e a chave da Evolution API precisam ser definidos antes de importar a aplicação
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='replay-'), 'replay.db')}"
+    Config.SQLALCHEMY_DATABASE_URL = database_url
+    Config.EVOLUTION_API_KEY = REPLAY_API_KEY
+    Config.TRAFFIC_RECORDER_PATH = ''  # Não regrava o próprio replay
+
+    from services.traffic_recorder import read_capture
+    records = [record for record in read_capture(args.capture) if record.get('path') == '/webhook/whatsapp']
+    if not records:
+        print("❌ Nenhuma requisição do webhook encontrada na captura.")
+        return 1
+
+    import logging
+    from app import app
+    import routes.webhook as webhook_module
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tracker = LatencyTracker()
+    install_stubs(webhook_module, tracker, args.ai_latency_ms)
+    print(f"▶️  Reproduzindo {len(records)} requisições de {args.capture} "
+          f"(velocidade: {'max' if args.speed is None else f'{args.speed:g}x'}, banco: {database_url})")
+    report = asyncio.run(replay(records, app, webhook_module, tracker, args.speed, args.concurrency, args.drain_timeout))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,26 +1,42 @@
 from fastapi import APIRouter, Request, HTTPException, Depends, Query, Path, BackgroundTasks
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates # For rendering HTML templates
-from sqlalchemy import desc, func
-from sqlalchemy.orm import Session
+from sqlalchemy import desc, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from pydantic import BaseModel # Import BaseModel
 
-from database_session import get_db # Import the get_db dependency
-from models import Conversation, Message, AIResponse, MediaFile, HumanAgentRequest, SilentMode, Order, UserProfile # Add Order and UserProfile if they are used
+# Dependências async: as consultas não bloqueiam o event loop; as rotas só de leitura podem ir para a réplica
+from database_session import get_async_db, get_async_fresh_read_db, get_async_read_db
+from models import Conversation, Message, MediaFile, HumanAgentRequest, SilentMode, Order, UserProfile # Add Order and UserProfile if they are used
+from services.dashboard_stats import DashboardStatsCache
+from services.full_text_search import FullTextSearchUnavailable, search_conversations
+from services.keyset_pagination import InvalidCursorError, KeysetPage, approximate_count, fetch_keyset_page
+from services.message_archive import (archive_storage, archived_segments, load_archived_messages, message_sort_key,
+                                      read_archived_messages, with_archived_messages)
 from services.ai_service import AIService
+from services.silent_mode import silent_mode_registry
 # from services.whatsapp_service import WhatsAppService
 import logging
+import os
 from datetime import datetime, timedelta
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 # Configure Jinja2Templates
-templates = Jinja2Templates(directory="templates") # Assumes templates are in a 'templates' directory
+templates = Jinja2Templates(directory=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates"))
 
 # whatsapp_service_instance = WhatsAppService()
 
+# Estatísticas compartilhadas pelo index e pelo polling de /api/stats (ver DASHBOARD_STATS_TTL_SECONDS)
+dashboard_stats = DashboardStatsCache()
+
+# Mensagens de conversas arquivadas (archive_messages.py), lidas de volta nas telas da conversa
+message_archive = archive_storage()
+
 class AssignRequest(BaseModel):
     agent_id: str
 
@@ -28,40 +44,73 @@ class SilentModeEnable(BaseModel):
     duration_hours: int = 24
     admin_name: str = "admin"
 
+async def count_rows(db: AsyncSession, model, *criteria) -> int:
+    """SELECT COUNT(*) de `model`, com filtros opcionais."""
+    return await db.scalar(select(func.count()).select_from(model).where(*criteria))
+
+async def count_query_rows(db: AsyncSession, query) -> int:
+    """Total de linhas de uma consulta (ex: agrupada), antes da paginação."""
+    return await db.scalar(select(func.count()).select_from(query.order_by(None).subquery()))
+
+def conversation_listing():
+    """Conversas com as estatísticas mantidas na gravação, da mais recente para a mais antiga (idx_conversations_last_message)."""
+    return select(
+        Conversation,
+        Conversation.message_count,
+        Conversation.last_message_at.label('last_message_time')
+    ).order_by(Conversation.last_message_at.desc(), Conversation.id.desc())
+
+async def conversation_keyset_page(db: AsyncSession, cursor: Optional[str], per_page: int, *filters) -> KeysetPage:
+    """Página da listagem de conversas a partir do cursor (busca por faixa em idx_conversations_last_message)."""
+    return await fetch_keyset_page(db, conversation_listing().where(*filters), Conversation.last_message_at, Conversation.id,
+                                   cursor, per_page, row_key=lambda row: (row.last_message_time, row.Conversation.id))
+
+def keyset_pagination(keyset_page: KeysetPage, cursor: Optional[str], per_page: int) -> dict:
+    return {
+        'per_page': per_page,
+        'cursor': cursor,
+        'next_cursor': keyset_page.next_cursor,
+        'has_next': keyset_page.has_next,
+    }
+
+def with_replies_and_media(messages_query):
+    """Respostas da IA e mídias das mensagens em uma consulta IN cada (selectinload), em vez de duas por mensagem."""
+    return messages_query.options(selectinload(Message.ai_responses), selectinload(Message.media_files))
+
+def first_media_file(message: Message) -> Optional[MediaFile]:
+    if message.message_type in ['image', 'audio', 'video', 'document'] and message.media_files:
+        return message.media_files[0]
+    return None
+
+def is_page_request(page: Optional[int], cursor: Optional[str]) -> bool:
+    # Compatibilidade: quem ainda envia ?page= recebe a paginação por OFFSET, com total exato
+    return page is not None and not cursor
+
 @router.get("/", response_class=HTMLResponse)
-async def index(request: Request, db: Session = Depends(get_db)):
+async def index(request: Request, db: AsyncSession = Depends(get_async_read_db)):
     """Main dashboard page"""
     try:
         # Get statistics
-        total_conversations = db.query(Conversation).count()
-        total_messages = db.query(Message).count()
-        total_media_files = db.query(MediaFile).count()
-        active_conversations = db.query(Conversation).filter_by(is_active=True).count()
+        totals = (await dashboard_stats.get(db))['totals']
         
         # Get recent conversations with message counts
-        recent_conversations = db.query(
-            Conversation,
-            func.count(Message.id).label('message_count'),
-            func.max(Message.timestamp).label('last_message_time')
-        ).outerjoin(Message).group_by(Conversation.id).order_by(
-            desc('last_message_time')
-        ).limit(10).all()
+        recent_conversations = (await db.execute(conversation_listing().limit(10))).all()
         
         # Get recent media files
-        recent_media = db.query(MediaFile, Message, Conversation).join(
+        recent_media = (await db.execute(select(MediaFile, Message, Conversation).join(
             Message, MediaFile.message_id == Message.id
         ).join(
             Conversation, Message.conversation_id == Conversation.id
-        ).order_by(desc(MediaFile.uploaded_at)).limit(10).all()
+        ).order_by(desc(MediaFile.uploaded_at)).limit(10))).all()
         
         stats = {
-            'total_conversations': total_conversations,
-            'total_messages': total_messages,
-            'total_media_files': total_media_files,
-            'active_conversations': active_conversations
+            'total_conversations': totals['conversations'],
+            'total_messages': totals['messages'],
+            'total_media_files': totals['media_files'],
+            'active_conversations': totals['active_conversations']
         }
         
-        return templates.TemplateResponse("dashboard.html", 
+        return templates.TemplateResponse(request, "dashboard.html", 
                                       {"request": request,
                                        "stats": stats,
                                        "recent_conversations": recent_conversations,
@@ -69,81 +118,75 @@ async def index(request: Request, db: Session = Depends(get_db)):
         
     except Exception as e:
         logger.error(f"Dashboard error: {str(e)}")
-        return templates.TemplateResponse("dashboard.html", 
+        return templates.TemplateResponse(request, "dashboard.html", 
                                       {"request": request,
                                        "stats": {'error': str(e)},
                                        "recent_conversations": [],
                                        "recent_media": []})
 
 @router.get("/conversations", response_class=HTMLResponse)
-async def conversations(request: Request, db: Session = Depends(get_db),
-                        page: int = Query(1, alias="page"), per_page: int = Query(20, alias="per_page")):
+async def conversations(request: Request, db: AsyncSession = Depends(get_async_read_db),
+                        page: Optional[int] = Query(None, alias="page"), per_page: int = Query(20, alias="per_page"),
+                        cursor: Optional[str] = Query(None, alias="cursor")):
     """List all conversations"""
     try:
-        # Get conversations with message counts and last message time
-        conversations_query = db.query(
-            Conversation,
-            func.count(Message.id).label('message_count'),
-            func.max(Message.timestamp).label('last_message_time')
-        ).outerjoin(Message).group_by(Conversation.id).order_by(
-            desc('last_message_time')
-        )
-        
-        # Manual pagination
-        total_items = conversations_query.count() # Count before slicing
-        conversations_data = conversations_query.offset((page - 1) * per_page).limit(per_page).all()
-        
-        total_pages = (total_items + per_page - 1) // per_page
+        if is_page_request(page, cursor):
+            # Manual pagination
+            total_items = await count_rows(db, Conversation) # Count before slicing
+            conversations_data = (await db.execute(conversation_listing().offset((page - 1) * per_page).limit(per_page))).all()
 
-        pagination = {
-            "page": page,
-            "pages": total_pages,
-            "per_page": per_page,
-            "total": total_items,
-            "has_next": page < total_pages,
-            "has_prev": page > 1,
-        }
+            total_pages = (total_items + per_page - 1) // per_page
+
+            pagination = {
+                "page": page,
+                "pages": total_pages,
+                "per_page": per_page,
+                "total": total_items,
+                "has_next": page < total_pages,
+                "has_prev": page > 1,
+            }
+        else:
+            keyset_page = await conversation_keyset_page(db, cursor, per_page)
+            conversations_data = keyset_page.rows
+            pagination = keyset_pagination(keyset_page, cursor, per_page)
 
-        return templates.TemplateResponse("conversations.html", 
+        return templates.TemplateResponse(request, "conversations.html", 
                                       {"request": request,
                                        "conversations": conversations_data,
                                        "pagination": pagination})
         
     except Exception as e:
         logger.error(f"Conversations listing error: {str(e)}")
-        return templates.TemplateResponse("conversations.html", 
+        return templates.TemplateResponse(request, "conversations.html", 
                                       {"request": request,
                                        "conversations": [], 
                                        "pagination": {},
                                        "error": str(e)})
 
 @router.get("/conversation/{conversation_id}", response_class=HTMLResponse)
-async def conversation_detail(request: Request, conversation_id: int = Path(...), db: Session = Depends(get_db)):
+async def conversation_detail(request: Request, conversation_id: int = Path(...), db: AsyncSession = Depends(get_async_fresh_read_db)):
     """View detailed conversation with messages"""
     try:
-        conversation = db.query(Conversation).get(conversation_id)
+        conversation = await db.get(Conversation, conversation_id)
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
         # Get all messages for this conversation
-        messages = db.query(Message).filter_by(
+        messages = (await db.scalars(with_replies_and_media(select(Message).filter_by(
             conversation_id=conversation_id
-        ).order_by(Message.timestamp.asc()).all()
-        
-        # Get AI responses for messages
-        message_responses = {}
-        for message in messages:
-            responses = db.query(AIResponse).filter_by(message_id=message.id).all()
-            message_responses[message.id] = responses
-        
-        # Get media files for messages
-        message_media = {}
-        for message in messages:
-            if message.message_type in ['image', 'audio', 'video', 'document']:
-                media = db.query(MediaFile).filter_by(message_id=message.id).first()
-                message_media[message.id] = media
-        
-        return templates.TemplateResponse("conversation.html",
+        ).order_by(Message.timestamp.asc())))).all()
+        archived = await load_archived_messages(db, message_archive, conversation_id)
+        if archived:
+            messages = sorted([*archived, *messages], key=lambda message: message_sort_key(message.timestamp, message.id))
+        
+        # AI responses and media files for messages (already loaded with the messages)
+        message_responses = {message.id: message.ai_responses for message in messages}
+        message_media = {
+            message.id: first_media_file(message)
+            for message in messages if message.message_type in ['image', 'audio', 'video', 'document']
+        }
+        
+        return templates.TemplateResponse(request, "conversation.html",
                                       {"request": request,
                                        "conversation": conversation,
                                        "messages": messages,
@@ -154,43 +197,37 @@ async def conversation_detail(request: Request, conversation_id: int = Path(...)
         raise he # Re-raise HTTPException to be caught by FastAPI's exception handler
     except Exception as e:
         logger.error(f"Conversation detail error: {str(e)}")
-        return templates.TemplateResponse("conversation.html",
+        return templates.TemplateResponse(request, "conversation.html",
                                       {"request": request,
                                        "conversation": None,
                                        "messages": [],
                                        "error": str(e)})
 
 @router.get("/api/conversations")
-async def api_conversations(db: Session = Depends(get_db),
-                          page: int = Query(1, alias="page"),
+async def api_conversations(db: AsyncSession = Depends(get_async_read_db),
+                          page: Optional[int] = Query(None, alias="page"),
                           per_page: int = Query(20, alias="per_page"),
-                          search: str = Query('', alias="search")):
-    """API endpoint for conversations list"""
+                          search: str = Query('', alias="search"),
+                          cursor: Optional[str] = Query(None, alias="cursor"),
+                          include_total: bool = Query(False, alias="include_total")):
+    """API endpoint for conversations list (cursor pagination; ?page= keeps the offset pagination)"""
     try:
-        query = db.query(
-            Conversation,
-            func.count(Message.id).label('message_count'),
-            func.max(Message.timestamp).label('last_message_time')
-        ).outerjoin(Message).group_by(Conversation.id)
-        
+        filters = []
         if search:
             # Assuming 'phone_number' and 'contact_name' are attributes of Conversation
-            query = query.filter(
+            filters.append(
                 Conversation.user_phone.contains(search) |
                 Conversation.contact_name.contains(search)
             )
         
-        # Manual pagination for API
-        total_items = query.count()
-        conversations_data = query.order_by(
-            desc('last_message_time')
-        ).offset((page - 1) * per_page).limit(per_page).all()
-        
-        total_pages = (total_items + per_page - 1) // per_page
+        if is_page_request(page, cursor):
+            # Manual pagination for API
+            total_items = await count_rows(db, Conversation, *filters)
+            conversations_data = (await db.execute(conversation_listing().where(*filters)
+                                                   .offset((page - 1) * per_page).limit(per_page))).all()
 
-        result = {
-            'conversations': [],
-            'pagination': {
+            total_pages = (total_items + per_page - 1) // per_page
+            pagination = {
                 'page': page,
                 'pages': total_pages,
                 'per_page': per_page,
@@ -198,6 +235,16 @@ async def api_conversations(db: Session = Depends(get_db),
                 'has_next': page < total_pages,
                 'has_prev': page > 1
             }
+        else:
+            keyset_page = await conversation_keyset_page(db, cursor, per_page, *filters)
+            conversations_data = keyset_page.rows
+            pagination = keyset_pagination(keyset_page, cursor, per_page)
+            if include_total:
+                pagination['total'], pagination['total_is_approximate'] = await approximate_count(db, Conversation, *filters)
+
+        result = {
+            'conversations': [],
+            'pagination': pagination
         }
         
         for conv, msg_count, last_time in conversations_data:
@@ -207,6 +254,7 @@ async def api_conversations(db: Session = Depends(get_db),
                 'contact_name': conv.contact_name,
                 'message_count': msg_count or 0,
                 'last_message_time': last_time.isoformat() if last_time else None,
+                'last_message_preview': conv.last_message_preview,
                 'is_active': conv.is_active,
                 'created_at': conv.created_at.isoformat(),
                 'url': f"/dashboard/conversation/{conv.id}" # Manual URL construction
@@ -214,27 +262,78 @@ async def api_conversations(db: Session = Depends(get_db),
         
         return JSONResponse(content=result)
         
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"API conversations error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/api/search")
+async def api_search(db: AsyncSession = Depends(get_async_read_db),
+                     q: str = Query('', alias="q"),
+                     limit: int = Query(20, alias="limit", ge=1, le=100)):
+    """Busca textual nas mensagens e nos contatos: conversas por relevância, com o trecho que casou destacado"""
+    try:
+        hits = await search_conversations(db, q, limit)
+        conversations = {}
+        if hits:
+            conversations = {conv.id: conv for conv in (await db.execute(
+                select(Conversation).where(Conversation.id.in_([hit.conversation_id for hit in hits]))
+            )).scalars()}
+
+        result = {'query': q, 'conversations': []}
+        for hit in hits:
+            conv = conversations.get(hit.conversation_id)
+            if conv is None:  # Removida entre a busca e a leitura
+                continue
+            result['conversations'].append({
+                'id': conv.id,
+                'user_phone': conv.user_phone,
+                'contact_name': conv.contact_name,
+                'message_count': conv.message_count,
+                'last_message_time': conv.last_message_at.isoformat() if conv.last_message_at else None,
+                'last_message_preview': conv.last_message_preview,
+                'url': f"/dashboard/conversation/{conv.id}",
+                'rank': hit.rank,
+                'matched_contact': hit.matched_contact,
+                'message_id': hit.message_id,
+                'snippet_html': hit.snippet_html
+            })
+
+        return JSONResponse(content=result)
+
+    except FullTextSearchUnavailable as e:
+        logger.warning(f"API search unavailable: {str(e)}")
+        raise HTTPException(status_code=503, detail="Full-text search is not available on this database")
+    except Exception as e:
+        logger.error(f"API search error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/api/conversation/{conversation_id}/messages")
-async def api_conversation_messages(conversation_id: int = Path(...), db: Session = Depends(get_db),
-                                  page: int = Query(1, alias="page"), per_page: int = Query(50, alias="per_page")):
-    """API endpoint for conversation messages"""
+async def api_conversation_messages(conversation_id: int = Path(...), db: AsyncSession = Depends(get_async_fresh_read_db),
+                                  page: Optional[int] = Query(None, alias="page"), per_page: int = Query(50, alias="per_page"),
+                                  cursor: Optional[str] = Query(None, alias="cursor"),
+                                  include_total: bool = Query(False, alias="include_total")):
+    """API endpoint for conversation messages, newest first (cursor pagination; ?page= keeps the offset pagination)"""
     try:
-        messages_query = db.query(Message).filter_by(
+        messages_query = with_replies_and_media(select(Message).filter_by(
             conversation_id=conversation_id
-        ).order_by(Message.timestamp.desc())
-        
-        total_items = messages_query.count()
-        messages_data = messages_query.offset((page - 1) * per_page).limit(per_page).all()
-        
-        total_pages = (total_items + per_page - 1) // per_page
-        
-        result = {
-            'messages': [],
-            'pagination': {
+        ).order_by(Message.timestamp.desc(), Message.id.desc()))
+        
+        if is_page_request(page, cursor):
+            offset = (page - 1) * per_page
+            hot_items = await count_query_rows(db, messages_query)
+            messages_data = list((await db.scalars(messages_query.offset(offset).limit(per_page))).all())
+            # As arquivadas são de antes da conversa parar, então vêm depois de todas as do banco
+            segments = await archived_segments(db, conversation_id)
+            total_items = hot_items + sum(segment.message_count for segment in segments)
+            if segments and len(messages_data) < per_page:
+                archived = (await read_archived_messages(message_archive, segments))[::-1]
+                archived_offset = max(0, offset - hot_items)
+                messages_data += archived[archived_offset:archived_offset + per_page - len(messages_data)]
+
+            total_pages = (total_items + per_page - 1) // per_page
+            pagination = {
                 'page': page,
                 'pages': total_pages,
                 'per_page': per_page,
@@ -242,16 +341,28 @@ async def api_conversation_messages(conversation_id: int = Path(...), db: Sessio
                 'has_next': page < total_pages,
                 'has_prev': page > 1
             }
+        else:
+            # Busca por faixa em idx_messages_conversation_timestamp
+            keyset_page = await fetch_keyset_page(db, messages_query, Message.timestamp, Message.id, cursor, per_page,
+                                                  row_key=lambda row: (row.Message.timestamp, row.Message.id))
+            keyset_page = await with_archived_messages(db, message_archive, conversation_id,
+                                                       KeysetPage([row.Message for row in keyset_page.rows], keyset_page.next_cursor),
+                                                       cursor, per_page)
+            messages_data = keyset_page.rows
+            pagination = keyset_pagination(keyset_page, cursor, per_page)
+            if include_total:
+                # Contador mantido na gravação das mensagens (ver services/conversation_stats.py)
+                pagination['total'] = await db.scalar(select(Conversation.message_count).where(Conversation.id == conversation_id)) or 0
+                pagination['total_is_approximate'] = False
+        
+        result = {
+            'messages': [],
+            'pagination': pagination
         }
         
         for message in messages_data:
-            # Get AI responses
-            ai_responses = db.query(AIResponse).filter_by(message_id=message.id).all()
-            
-            # Get media file if exists
-            media_file = None
-            if message.message_type in ['image', 'audio', 'video', 'document']:
-                media_file = db.query(MediaFile).filter_by(message_id=message.id).first()
+            ai_responses = message.ai_responses
+            media_file = first_media_file(message)
             
             message_data = {
                 'id': message.id,
@@ -293,53 +404,17 @@ async def api_conversation_messages(conversation_id: int = Path(...), db: Sessio
         
         return JSONResponse(content=result)
         
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"API conversation messages error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/api/stats")
-async def api_stats(db: Session = Depends(get_db)):
+async def api_stats(db: AsyncSession = Depends(get_async_read_db)):
     """API endpoint for dashboard statistics"""
     try:
-        # Basic counts
-        total_conversations = db.query(Conversation).count()
-        total_messages = db.query(Message).count()
-        total_media_files = db.query(MediaFile).count()
-        active_conversations = db.query(Conversation).filter_by(is_active=True).count()
-        
-        # Message type distribution
-        message_types = db.query(
-            Message.message_type,
-            func.count(Message.id).label('count')
-        ).group_by(Message.message_type).all()
-        
-        # AI response statistics
-        ai_responses_count = db.query(AIResponse).count()
-        successful_responses = db.query(AIResponse).filter_by(sent_to_whatsapp=True).count()
-        
-        # Processing statistics
-        processed_messages = db.query(Message).filter_by(processed=True).count()
-        failed_messages = db.query(Message).filter(Message.processing_error.isnot(None)).count()
-        
-        stats = {
-            'totals': {
-                'conversations': total_conversations,
-                'messages': total_messages,
-                'media_files': total_media_files,
-                'active_conversations': active_conversations,
-                'ai_responses': ai_responses_count,
-                'successful_responses': successful_responses,
-                'processed_messages': processed_messages,
-                'failed_messages': failed_messages
-            },
-            'message_types': {
-                msg_type: count for msg_type, count in message_types
-            },
-            'success_rates': {
-                'processing': (processed_messages / total_messages * 100) if total_messages > 0 else 0,
-                'ai_responses': (successful_responses / ai_responses_count * 100) if ai_responses_count > 0 else 0
-            }
-        }
+        stats = await dashboard_stats.get(db)
         
         return JSONResponse(content=stats)
         
@@ -348,17 +423,17 @@ async def api_stats(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/api/conversation/{conversation_id}/summary")
-async def api_conversation_summary(conversation_id: int = Path(...), db: Session = Depends(get_db)):
+async def api_conversation_summary(conversation_id: int = Path(...), db: AsyncSession = Depends(get_async_read_db)):
     """Generate AI summary of a conversation"""
     try:
-        conversation = db.query(Conversation).get(conversation_id)
+        conversation = await db.get(Conversation, conversation_id)
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
         # Get conversation messages
-        messages = db.query(Message).filter_by(
+        messages = (await db.scalars(select(Message).filter_by(
             conversation_id=conversation_id
-        ).order_by(Message.timestamp.asc()).all()
+        ).order_by(Message.timestamp.asc()))).all()
         
         if not messages:
             return JSONResponse(content={'summary': 'No messages in this conversation yet.'})
@@ -388,33 +463,36 @@ async def api_conversation_summary(conversation_id: int = Path(...), db: Session
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/api/human-handoff-requests", response_class=HTMLResponse)
-async def api_get_human_handoff_requests(request: Request, db: Session = Depends(get_db),
+async def api_get_human_handoff_requests(request: Request, db: AsyncSession = Depends(get_async_fresh_read_db),
                                          page: int = Query(1, alias="page"),
                                          per_page: int = Query(20, alias="per_page"),
                                          status_filter: str = Query(default="pending")):
     """API endpoint para listar solicitações de atendimento humano."""
     try:
-        query = db.query(HumanAgentRequest)
+        query = select(HumanAgentRequest)
         if status_filter != 'all':
             query = query.filter(HumanAgentRequest.status == status_filter)
         
-        requests_page = query.order_by(desc(HumanAgentRequest.request_time)).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        # Manual pagination
+        total_items = await count_query_rows(db, query)
+        requests_data = (await db.scalars(query.order_by(desc(HumanAgentRequest.request_time)).offset(
+            (page - 1) * per_page
+        ).limit(per_page))).all()
+        total_pages = (total_items + per_page - 1) // per_page
 
         result = {
             'requests': [],
             'pagination': {
-                'page': requests_page.page,
-                'pages': requests_page.pages,
-                'per_page': requests_page.per_page,
-                'total': requests_page.total,
-                'has_next': requests_page.has_next,
-                'has_prev': requests_page.has_prev
+                'page': page,
+                'pages': total_pages,
+                'per_page': per_page,
+                'total': total_items,
+                'has_next': page < total_pages,
+                'has_prev': page > 1
             }
         }
 
-        for req in requests_page.items:
+        for req in requests_data:
             result['requests'].append({
                 'id': req.id,
                 'conversation_id': req.conversation_id,
@@ -430,18 +508,20 @@ async def api_get_human_handoff_requests(request: Request, db: Session = Depends
                 'conversation_url': f"/dashboard/conversation/{req.conversation_id}"
             })
         
-        return templates.TemplateResponse("human_handoff.html", {"request": request, "requests": result['requests']})
+        return templates.TemplateResponse(request, "human_handoff.html", {"request": request, "requests": result['requests']})
 
     except Exception as e:
         logger.error(f"API human handoff requests error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/api/human-handoff-requests/{request_id}", response_class=HTMLResponse)
-async def api_get_human_handoff_request_detail(request_id: int = Path(...), *, request: Request, db: Session = Depends(get_db)):
+async def api_get_human_handoff_request_detail(request_id: int = Path(...), *, request: Request, db: AsyncSession = Depends(get_async_fresh_read_db)):
     """API endpoint para obter detalhes de uma solicitação de atendimento humano, incluindo histórico completo."""
     try:
-        req = db.query(HumanAgentRequest).get_or_404(request_id)
-        return templates.TemplateResponse("human_handoff_detail.html", {
+        req = await db.get(HumanAgentRequest, request_id)
+        if not req:
+            raise HTTPException(status_code=404, detail="Human agent request not found")
+        return templates.TemplateResponse(request, "human_handoff_detail.html", {
             "request": request,
             "id": req.id,
             "conversation_id": req.conversation_id,
@@ -458,12 +538,14 @@ async def api_get_human_handoff_request_detail(request_id: int = Path(...), *, r
             "closed_time": req.closed_time.isoformat() if req.closed_time else None,
             "conversation_url": f"/dashboard/conversation/{req.conversation_id}"
         })
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"API human handoff request detail error for ID {request_id}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=404 if isinstance(e, Exception) and "404 Not Found" in str(e) else 500, detail=str(e))
 
 @router.post("/api/human-handoff-requests/{request_id}/assign", response_class=JSONResponse)
-async def api_assign_human_handoff_request(request_id: int = Path(...), *, assign_request: AssignRequest, db: Session = Depends(get_db)):
+async def api_assign_human_handoff_request(request_id: int = Path(...), *, assign_request: AssignRequest, db: AsyncSession = Depends(get_async_db)):
     """API endpoint para um agente se atribuir a uma solicitação."""
     try:
         agent_id = assign_request.agent_id
@@ -471,7 +553,9 @@ async def api_assign_human_handoff_request(request_id: int = Path(...), *, assig
         if not agent_id:
             return JSONResponse(content={'error': 'agent_id é obrigatório'}, status_code=400)
 
-        req = db.query(HumanAgentRequest).get_or_404(request_id)
+        req = await db.get(HumanAgentRequest, request_id)
+        if not req:
+            return JSONResponse(content={'error': f'Solicitação {request_id} não encontrada'}, status_code=404)
         
         if req.status != 'pending':
             return JSONResponse(content={'error': f'Solicitação {request_id} não está pendente (status atual: {req.status})'}, status_code=400)
@@ -479,7 +563,7 @@ async def api_assign_human_handoff_request(request_id: int = Path(...), *, assig
         req.status = 'assigned'
         req.assigned_agent_id = agent_id
         req.assigned_time = datetime.utcnow()
-        db.commit()
+        await db.commit()
 
         logger.info(f"HumanAgentRequest {request_id} atribuído ao agente {agent_id}")
         return JSONResponse(content={
@@ -494,7 +578,7 @@ async def api_assign_human_handoff_request(request_id: int = Path(...), *, assig
 
     except Exception as e:
         logger.error(f"Erro ao atribuir HumanAgentRequest {request_id}: {str(e)}", exc_info=True)
-        db.rollback()
+        await db.rollback()
         return JSONResponse(content={'error': str(e)}, status_code=500)
 
 @router.get("/human-handoff", response_class=HTMLResponse)
@@ -507,19 +591,21 @@ async def human_handoff_page(request: Request):
     return HTMLResponse(content="Página de Atendimento Humano (template HTML a ser criado)")
 
 @router.post("/api/conversation/{conversation_id}/silent_mode", response_class=JSONResponse)
-async def enable_silent_mode(conversation_id: int = Path(...), *, silent_mode_data: SilentModeEnable, db: Session = Depends(get_db)):
+async def enable_silent_mode(conversation_id: int = Path(...), *, silent_mode_data: SilentModeEnable, db: AsyncSession = Depends(get_async_db)):
     """Ativa o modo silencioso para uma conversa"""
     try:
         duration_hours = silent_mode_data.duration_hours  # Padrão de 24 horas
         admin_name = silent_mode_data.admin_name
         
-        conversation = db.query(Conversation).get_or_404(conversation_id)
+        conversation = await db.get(Conversation, conversation_id)
+        if not conversation:
+            return JSONResponse(content={'error': 'Conversation not found'}, status_code=404)
         
         # Desativa qualquer modo silencioso existente
-        existing_silent = db.query(SilentMode).filter_by(
+        existing_silent = (await db.scalars(select(SilentMode).filter_by(
             conversation_id=conversation_id,
             is_active=True
-        ).all()
+        ))).all()
         for silent in existing_silent:
             silent.is_active = False
         
@@ -531,7 +617,8 @@ async def enable_silent_mode(conversation_id: int = Path(...), *, silent_mode_da
         )
         
         db.add(silent_mode)
-        db.commit()
+        await db.commit()
+        silent_mode_registry.enable(conversation_id, silent_mode.expires_at) # O webhook consulta só o registro em memória
         
         return JSONResponse(content={
             'status': 'success',
@@ -544,18 +631,21 @@ async def enable_silent_mode(conversation_id: int = Path(...), *, silent_mode_da
         return JSONResponse(content={'error': str(e)}, status_code=500)
 
 @router.delete("/api/conversation/{conversation_id}/silent_mode", response_class=JSONResponse)
-async def disable_silent_mode(conversation_id: int = Path(...), db: Session = Depends(get_db)):
+async def disable_silent_mode(conversation_id: int = Path(...), db: AsyncSession = Depends(get_async_db)):
     """Desativa o modo silencioso para uma conversa"""
     try:
-        conversation = db.query(Conversation).get_or_404(conversation_id)
+        conversation = await db.get(Conversation, conversation_id)
+        if not conversation:
+            return JSONResponse(content={'error': 'Conversation not found'}, status_code=404)
         
         # Desativa todos os modos silenciosos ativos
-        silent_modes = db.query(SilentMode).filter_by(
+        silent_modes = (await db.scalars(select(SilentMode).filter_by(
             conversation_id=conversation_id,
             is_active=True
-        ).all()
+        ))).all()
         
         if not silent_modes:
+            silent_mode_registry.disable(conversation_id) # Pode ter sido desativado por outra instância
             return JSONResponse(content={
                 'status': 'warning',
                 'message': 'Silent mode was not active'
@@ -564,7 +654,8 @@ async def disable_silent_mode(conversation_id: int = Path(...), db: Session = De
         for silent in silent_modes:
             silent.is_active = False
         
-        db.commit()
+        await db.commit()
+        silent_mode_registry.disable(conversation_id)
         
         return JSONResponse(content={
             'status': 'success',
@@ -0,0 +1,30 @@
+import logging
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+from database_session import pool_metrics, read_router
+from routes.webhook import ingest_queue, admission_controller, webhook_filter, conversation_cache, history_buffer, profile_cache
+from routes.tasks import verify_task_token
+from services.silent_mode import silent_mode_registry
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+@router.get("")
+async def get_metrics(request: Request):
+    """
+    Profundidade da fila de ingestão, nível de carga, contadores do filtro do webhook e pools do banco.
+    Mesma autenticação das tarefas internas (Bearer INTERNAL_TASK_TOKEN): o webhook é público e as métricas não.
+    """
+    verify_task_token(request, "ler as métricas")
+    return JSONResponse(content={
+        'ingest_queue': ingest_queue.stats(),
+        'admission': admission_controller.stats(),
+        'webhook_filter': webhook_filter.stats(),
+        'conversation_cache': conversation_cache.stats(),
+        'history_buffer': history_buffer.stats(),
+        'profile_cache': profile_cache.stats(),
+        'silent_mode': silent_mode_registry.stats(),
+        'read_replica': read_router.stats(),
+        'db_pools': {name: metrics.stats() for name, metrics in pool_metrics.items()},
+    })
@@ -1,29 +1,35 @@
 import logging
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
 from database_session import get_db # Import the get_db dependency
 from models import HumanAgentRequest
 from config import Config
+from services.data_retention import DataRetention
+from services.message_archive import archive_storage
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-@router.post("/reset-human-agent-queue")
-async def reset_human_agent_queue(request: Request, db: Session = Depends(get_db)):
-    """Endpoint para ser chamado pelo Cloud Scheduler para resetar a fila de solicitações de agente humano."""
+def verify_task_token(request: Request, action: str):
+    """Só o Cloud Scheduler (Bearer INTERNAL_TASK_TOKEN) chama as tarefas internas."""
     auth_header = request.headers.get('Authorization')
     expected_token = f"Bearer {Config.INTERNAL_TASK_TOKEN}"
 
     if not Config.INTERNAL_TASK_TOKEN:
-        logger.error("INTERNAL_TASK_TOKEN não está configurado no servidor. Endpoint de reset não pode ser executado com segurança.")
+        logger.error(f"INTERNAL_TASK_TOKEN não está configurado no servidor. Não é seguro {action}.")
         raise HTTPException(status_code=500, detail="Configuration error: Task token not set.")
 
     if not auth_header or auth_header != expected_token:
-        logger.warning(f"Tentativa não autorizada de resetar a fila de agentes humanos. Header: {auth_header}")
+        logger.warning(f"Tentativa não autorizada de {action}. Header: {auth_header}")
         raise HTTPException(status_code=403, detail="Unauthorized")
 
+@router.post("/reset-human-agent-queue")
+async def reset_human_agent_queue(request: Request, db: Session = Depends(get_db)):
+    """Endpoint para ser chamado pelo Cloud Scheduler para resetar a fila de solicitações de agente humano."""
+    verify_task_token(request, "resetar a fila de agentes humanos")
+
     try:
         num_rows_deleted = db.query(HumanAgentRequest).delete()
         db.commit()
@@ -32,4 +38,22 @@ async def reset_human_agent_queue(request: Request, db: Session = Depends(get_db
     except Exception as e:
         db.rollback()
         logger.error(f"Erro ao resetar fila de solicitações de agente humano: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Failed to reset queue: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to reset queue: {str(e)}")
+
+@router.post("/purge-expired-data")
+def purge_expired_data(request: Request, max_batches: int = Query(20, ge=1), db: Session = Depends(get_db)):
+    """
+    Aplica a retenção de dados (RETENTION_*_DAYS) para o Cloud Scheduler: no máximo `max_batches` lotes por
+    chamada; enquanto a resposta tiver "complete": false, ainda há o que apagar. Rota síncrona: roda numa
+    thread do servidor, e as pausas entre lotes não bloqueiam o event loop.
+    """
+    verify_task_token(request, "aplicar a retenção de dados")
+
+    try:
+        run = DataRetention(db, archive=archive_storage(), max_batches=max_batches).purge()
+        logger.info(f"Retenção aplicada: {run.as_dict()}")
+        return JSONResponse(content={"status": "success", **run.as_dict()}, status_code=200)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Erro ao aplicar a retenção de dados: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Failed to purge expired data: {str(e)}")
@@ -1,29 +1,76 @@
+import asyncio
 import json
 import logging
-import threading
-from fastapi import APIRouter, Request, HTTPException, BackgroundTasks, Depends
+import weakref
+from dataclasses import dataclass, replace
+from datetime import datetime
+from fastapi import APIRouter, Request, HTTPException, Depends
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
 
-from app import get_db # Assuming get_db provides a DB session, adjust if needed
-from models import Conversation, Message, AIResponse, MediaFile, HumanAgentRequest, UserProfile, Order
+from database_session import SessionLocal, get_async_db, create_async_db_engine, dispose_async_engine, make_async_sessionmaker
+from models import Conversation, Message, AIResponse, MediaFile, HumanAgentRequest, Order
 from services.whatsapp_service import WhatsAppService
 from services.media_processor import MediaProcessor
 from services.ai_service import AIService
 from services.cloud_storage import CloudStorageService
+from services.ingest_queue import IngestQueue
+from services.admission_control import AdmissionController, LoadLevel
+from services.webhook_filter import WebhookFilter
+from services.inbound_message import InboundMessage, InvalidPayloadError, parse_inbound_message
+from services.conversation_cache import CachedConversation, ConversationCache
+from services.conversation_history import ConversationHistoryBuffer, HistoryEntry
+from services.conversation_context import ConversationContext, load_conversation_context
+from services.conversation_stats import record_conversation_messages, refresh_message_preview
+from services.profile_cache import ProfileCache
+from services.silent_mode import silent_mode_registry
 from config import Config
 from typing import Optional, Dict, Any, List
+import httpx
 import requests # Adicionado para Pushover
 
 logger = logging.getLogger(__name__)
 
+PUSHOVER_API_URL = "https://api.pushover.net/1/messages.json"
+
 router = APIRouter()
 
+# Dialetos com INSERT ... ON CONFLICT DO NOTHING RETURNING, usados para reservar mensagens sem ler antes
+UPSERT_INSERTS = {'postgresql': postgresql_insert, 'sqlite': sqlite_insert}
+
 # Initialize services
 whatsapp_service = WhatsAppService()
 media_processor = MediaProcessor()
 ai_service = AIService()
 cloud_storage = CloudStorageService()
+# O pipeline asyncio roda no event loop da IngestQueue, separado do loop do servidor: engine própria
+pipeline_async_engine = create_async_db_engine('async_pipeline')
+# Fila persistente de mensagens; os workers são iniciados no startup da aplicação (ver app.py)
+# No pipeline asyncio cada lane é uma tarefa no event loop da fila, então cabem muito mais lanes que threads
+ingest_queue = IngestQueue(
+    SessionLocal,
+    num_workers=Config.ASYNC_PIPELINE_CONCURRENCY if Config.ENABLE_ASYNC_PIPELINE else Config.MAX_PROCESSING_THREADS,
+    async_session_factory=make_async_sessionmaker(pipeline_async_engine),
+)
+# Descarta eventos irrelevantes e reentregas antes de qualquer acesso ao banco
+webhook_filter = WebhookFilter()
+
+conversation_cache = ConversationCache()
+
+# Processamento na requisição (sem IngestQueue): um lock por número, liberado quando ninguém mais o usa
+inline_sender_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Últimas mensagens de cada conversa ativa, para montar o histórico da IA sem consultar o banco
+history_buffer = ConversationHistoryBuffer()
+
+# Perfil de cada conversa ativa em memória; as chaves extraídas num turno vão para o banco em um único upsert
+profile_cache = ProfileCache()
+
+# Decide, pelo backlog da fila, quanto trabalho cada turno faz e quando recusar mensagens (429)
+admission_controller = AdmissionController(ingest_queue.backlog)
 
 @router.get("/whatsapp")
 async def verify_webhook(request: Request):
@@ -49,7 +96,7 @@ async def verify_webhook(request: Request):
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 @router.post("/whatsapp")
-async def handle_webhook(request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def handle_webhook(request: Request, db: AsyncSession = Depends(get_async_db)):
     """Handle incoming WhatsApp messages"""
     try:
         data = await request.json()
@@ -64,19 +111,28 @@ async def handle_webhook(request: Request, background_tasks: BackgroundTasks, db
             logger.warning(f"Webhook authentication failed. Received API Key: {received_api_key}")
             raise HTTPException(status_code=403, detail='Forbidden')
         
-        logger.info(f"Received webhook data: {json.dumps(data, indent=2)}")
+        # Eventos que não são mensagens (presence, connection, messages.update...) são descartados de imediato
+        if not webhook_filter.is_message_event(data):
+            logger.debug(f"Ignoring webhook event: {data.get('event')}")
+            return JSONResponse(content={'status': 'ignored'}, status_code=200)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Received webhook data: {json.dumps(data, indent=2)}")
         
+        # Coleta as mensagens do payload como (telefone do remetente, message_data, webhook_context_data, is_text)
+        items = []
+
         # Check for the new event type
         if data.get('event') == 'messages.upsert':
             message_payload = data.get('data')
             if message_payload:
-                try:
-                    if Config.ENABLE_ASYNC_PROCESSING:
-                        background_tasks.add_task(process_message_sync, message_payload, data, db) # Pass db session
-                    else:
-                        process_message_sync(message_payload, data, db) # Pass full data as second arg for context
-                except Exception as e:
-                    logger.error(f"Error processing 'messages.upsert' event: {str(e)}")
+                # O contexto não precisa repetir o payload da mensagem, que é persistido separadamente
+                webhook_context = {key: value for key, value in data.items() if key != 'data'}
+                rejection_reason = webhook_filter.rejection_reason(message_payload)
+                if rejection_reason:
+                    logger.debug(f"Dropping message {WebhookFilter.message_id_of(message_payload)}: {rejection_reason}")
+                else:
+                    items.extend(queue_items(message_payload, webhook_context))
             else:
                 logger.warning("Event 'messages.upsert' received but no 'data' payload found.")
 
@@ -88,364 +144,471 @@ async def handle_webhook(request: Request, background_tasks: BackgroundTasks, db
                 for change in changes:
                     value = change.get('value', {})
                     messages = value.get('messages', [])
+                    value_context = {key: val for key, val in value.items() if key != 'messages'}
                     for message_data_old_format in messages:
-                        try:
-                            if Config.ENABLE_ASYNC_PROCESSING:
-                                background_tasks.add_task(process_message_sync, message_data_old_format, value, db) # Pass db session
-                            else:
-                                process_message_sync(message_data_old_format, value, db)
-                        except Exception as e:
-                            logger.error(f"Error processing message (old format): {str(e)}")
+                        rejection_reason = webhook_filter.rejection_reason(message_data_old_format)
+                        if rejection_reason:
+                            logger.debug(f"Dropping message {WebhookFilter.message_id_of(message_data_old_format)}: {rejection_reason}")
                             continue
-        else:
-            logger.warning(f"Received webhook data with unknown structure or event type: {data.get('event')}")
+                        items.extend(queue_items(message_data_old_format, value_context))
+
+        if items:
+            if Config.ENABLE_ASYNC_PROCESSING:
+                # Sobrecarga: recusa antes de gravar/lembrar os IDs, para que a reentrega da Evolution API seja aceita
+                if not admission_controller.admit(len(items)):
+                    logger.warning(f"Backlog acima do limite; {len(items)} mensagens recusadas com 429.")
+                    return JSONResponse(
+                        content={'status': 'busy'},
+                        status_code=429,
+                        headers={'Retry-After': str(Config.LOAD_REJECT_RETRY_AFTER_SECONDS)}
+                    )
+                # Mensagens de texto seguidas da mesma conversa podem ser agrupadas em um único turno da IA
+                # Persiste os jobs e responde imediatamente; os workers da IngestQueue fazem o processamento
+                job_ids = await ingest_queue.enqueue_async(db, items)
+                logger.info(f"{len(job_ids)} mensagens enfileiradas para processamento (jobs: {job_ids})")
+            else:
+                for sender_phone, message_data, webhook_context_data, _ in items:
+                    try:
+                        await process_message_inline(message_data, webhook_context_data, db, sender_phone)
+                    except Exception as e:
+                        logger.error(f"Error processing message: {str(e)}")
+                        continue
+            # Só agora as mensagens contam como vistas: se a gravação falhar, a reentrega não é descartada
+            webhook_filter.remember([WebhookFilter.message_id_of(message_data) for _, message_data, _, _ in items])
 
         return JSONResponse(content={'status': 'success'}, status_code=200)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Webhook handling error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def queue_items(message_data: Dict[str, Any], webhook_context_data: Dict[str, Any]) -> List[tuple]:
+    """
+    Único parse do payload no webhook: o telefone define a lane (ordem por conversa) e is_text diz se a
+    mensagem pode ser agrupada; ambos vão para o job. Payloads inválidos são descartados aqui mesmo.
+    """
+    try:
+        inbound = parse_inbound_message(message_data, webhook_context_data)
+    except InvalidPayloadError as e:
+        logger.warning(f"Descartando payload inválido: {e}")
+        return []
+    return [(inbound.sender_phone, message_data, webhook_context_data, inbound.is_text)]
+
+def extract_sender_phone(message_data: Dict[str, Any]) -> Optional[str]:
+    """Returns the sender phone for both payload formats (used by replay_webhook.py to match replies)."""
+    try:
+        return parse_inbound_message(message_data).sender_phone
+    except InvalidPayloadError:
+        return None
+
 def process_message_async(app, message_data, webhook_context_data):
-    """This function is no longer needed with FastAPI's BackgroundTasks. Remove if not used elsewhere."""
-    pass # The logic moved to background_tasks.add_task(process_message_sync, ...)
+    """This function is no longer needed; messages are processed by the IngestQueue workers."""
+    pass # The logic moved to ingest_queue (services/ingest_queue.py)
 
 def process_message_sync(message_data, webhook_context_data, db: Session): # Added db as parameter
     """Process a single WhatsApp message (handles both old and new formats via duck-typing in extraction)"""
-    processed_media_bytes_for_ai: Optional[bytes] = None
-    conversation_id_for_logging = None
-    
-    is_new_format = 'key' in message_data and 'messageTimestamp' in message_data # Heuristic for new format
+    process_message_batch([(message_data, webhook_context_data)], db)
+
+async def process_message_inline(message_data, webhook_context_data, db: AsyncSession, sender_phone: str):
+    """Processamento na própria requisição (ENABLE_ASYNC_PROCESSING desativado), sem bloquear o event loop."""
+    # Sem as lanes da IngestQueue, as mensagens de um mesmo número são serializadas aqui
+    lock = inline_sender_locks.get(sender_phone)
+    if lock is None:
+        lock = inline_sender_locks[sender_phone] = asyncio.Lock()
+
+    async with lock:
+        if Config.ENABLE_ASYNC_PIPELINE:
+            await process_message_batch_async([(message_data, webhook_context_data)], db)
+            return
 
+        # O pipeline síncrono faz chamadas bloqueantes (IA, WhatsApp): roda em uma thread, com sessão própria
+        def process_in_thread():
+            thread_db = SessionLocal()
+            try:
+                process_message_sync(message_data, webhook_context_data, thread_db)
+            finally:
+                thread_db.close()
+        await asyncio.to_thread(process_in_thread)
+
+def process_message_batch(items: List[tuple], db: Session):
+    """
+    Processa uma ou mais mensagens consecutivas da mesma conversa (rajada agrupada pela IngestQueue).
+    Cada mensagem é salva individualmente, mas a IA responde uma única vez ao turno inteiro.
+    Unidade de trabalho: um commit para a ingestão de todo o lote e outro para o resultado da IA.
+    """
+    turn = []
+    read_receipts = []
+    inbound_messages = parse_batch(items)
+    # Download e upload das mídias antes da transação de ingestão: nenhuma conexão ou lock fica preso ao I/O externo
+    stored_media = [prepare_media(inbound) for inbound in inbound_messages]
     try:
-        if is_new_format:
-            message_id = message_data.get('key', {}).get('id')
-            from_number = message_data.get('key', {}).get('remoteJid')
-            # Ensure from_number is stripped of any server details if present (e.g. @s.whatsapp.net)
-            if from_number and '@' in from_number:
-                from_number = from_number.split('@')[0]
-            
-            # ---> VERIFICAÇÃO DA LISTA DE IGNORADOS <---
-            if from_number in Config.IGNORE_LIST_NUMBERS:
-                logger.info(f"Mensagem de um número na lista de ignorados ({from_number}). Ignorando.")
-                return # Para o processamento aqui
+        for inbound, media in zip(inbound_messages, stored_media):
+            ingested = ingest_message(inbound, db, media)
+            if ingested:
+                turn.append(ingested)
+                if not inbound.is_new_format:
+                    read_receipts.append(inbound.message_id)
+        record_conversation_messages(db, [message for _, message, _ in turn])
+        cache_entries = conversation_cache_entries(turn)
+        history_entries = turn_history_entries(turn)
+        db.commit()
+    except Exception:
+        # Nada do lote fica pela metade; a IngestQueue tenta o lote novamente
+        db.rollback()
+        invalidate_cached_conversations(inbound_messages)
+        for blob_name in unclaimed_media_blobs(stored_media, rolled_back=True):
+            cloud_storage.delete_file(blob_name)
+        raise
+    conversation_cache.put_many(cache_entries)
+    history_buffer.append_many(history_entries)
+
+    # Chamadas externas só depois do commit, para não segurar a transação aberta
+    for blob_name in unclaimed_media_blobs(stored_media):
+        cloud_storage.delete_file(blob_name)
+    # Mark as read usa o message_id da API antiga; a API nova ainda não tem mecanismo equivalente.
+    for whatsapp_message_id in read_receipts:
+        whatsapp_service.mark_message_as_read(whatsapp_message_id)
+
+    if turn:
+        if silent_mode_registry.needs_refresh():
+            silent_mode_registry.load(db)
+        if is_silenced(turn[-1][0]):
+            return
+        respond_to_turn(db, turn)
 
-            timestamp_val = message_data.get('messageTimestamp') # This is a Unix timestamp
-            message_type_raw = message_data.get('messageType') # e.g., "conversation", "imageMessage"
-            
-            # Normalize message_type to existing categories if possible
-            if message_type_raw == 'conversation':
-                message_type = 'text'
-            elif message_type_raw == 'imageMessage':
-                message_type = 'image'
-            elif message_type_raw == 'audioMessage': # Assuming 'audioMessage' based on 'imageMessage'
-                message_type = 'audio'
-            elif message_type_raw == 'videoMessage': # Assuming 'videoMessage'
-                message_type = 'video'
-            elif message_type_raw == 'documentMessage': # Assuming 'documentMessage'
-                 message_type = 'document'
-            elif message_type_raw == 'locationMessage': # Novo tipo de mensagem
-                 message_type = 'location'
-            else:
-                message_type = message_type_raw # Keep original if no direct mapping
-            
-            contact_name = message_data.get('pushName')
-            
-            # For logging, use the instanceId from the new format if available
-            instance_id_for_logging = webhook_context_data.get('instance') 
-            logger.info(f"Processing message (new format): {message_id}, type: {message_type_raw} (normalized to {message_type}), from: {from_number}, instance: {instance_id_for_logging}")
+def find_conversation(db: Session, user_phone: str) -> Optional[Conversation]:
+    """
+    Conversa do telefone, consultando o conversation_cache antes do banco. Num acerto não há SELECT:
+    a conversa entra na sessão como persistente e as colunas fora do cache carregam sob demanda.
+    """
+    cached = conversation_cache.get(user_phone)
+    if cached:
+        conversation = Conversation(id=cached.conversation_id, user_phone=user_phone,
+                                    contact_name=cached.contact_name, is_active=cached.is_active)
+        make_transient_to_detached(conversation)
+        return db.merge(conversation, load=False)
+
+    conversation = db.query(Conversation).filter_by(user_phone=user_phone).first()
+    if conversation:
+        conversation_cache.put(user_phone, CachedConversation(conversation.id, conversation.contact_name, conversation.is_active))
+    return conversation
+
+def conversation_cache_entries(turn: List[tuple]) -> List[tuple]:
+    """Valores a gravar no cache depois do commit (conversas novas ou com nome alterado no lote)."""
+    return [
+        (conversation.user_phone, CachedConversation(conversation.id, conversation.contact_name, conversation.is_active))
+        for conversation, _, _ in turn
+    ]
+
+def turn_history_entries(turn: List[tuple]) -> List[tuple]:
+    """Mensagens do lote para o history_buffer, registradas só depois do commit."""
+    return [
+        (message.conversation_id, HistoryEntry(message.id, message.timestamp, message.is_from_user, message.content))
+        for _, message, _ in turn
+    ]
+
+def invalidate_cached_conversations(inbound_messages: List[InboundMessage]):
+    # Um lote que falhou pode ter usado uma entrada defasada (ex: conversa removida); a próxima tentativa vai ao banco
+    for inbound in inbound_messages:
+        conversation_cache.invalidate(inbound.sender_phone)
+
+@dataclass(slots=True)
+class StoredMedia:
+    """Mídia baixada e enviada ao Cloud Storage por prepare_media, antes da transação de ingestão."""
+    mime_type: Optional[str]
+    media_bytes_for_ai: Optional[bytes] = None
+    media_file: Optional[MediaFile] = None
+    cloud_storage_url: Optional[str] = None
+    processing_error: Optional[str] = None
+    claimed: bool = False  # False depois do commit: reentrega que perdeu a reserva, o objeto no bucket é apagado
+
+def prepare_media(inbound: InboundMessage) -> Optional[StoredMedia]:
+    """
+    Baixa a mídia da mensagem e faz o upload, sem sessão aberta. Uma reentrega que chega até aqui
+    (o webhook_filter descarta as recentes) custa um download e um upload desfeitos depois do commit.
+    """
+    if not inbound.media or inbound.sender_phone in Config.IGNORE_LIST_NUMBERS:
+        return None
+    return store_media(inbound, download_media_bytes(inbound))
 
-        else: # Old format extraction
-            message_id = message_data.get('id')
-            from_number = message_data.get('from')
-            
-            # ---> VERIFICAÇÃO DA LISTA DE IGNORADOS (também para o formato antigo) <---
-            if from_number in Config.IGNORE_LIST_NUMBERS:
-                logger.info(f"Mensagem de um número na lista de ignorados ({from_number}). Ignorando.")
-                return # Para o processamento aqui
-
-            timestamp_val = message_data.get('timestamp') # Already a string timestamp for old format?
-            message_type = message_data.get('type')
-            logger.info(f"Processing message (old format): {message_id}, type: {message_type}, from: {from_number}")
-            # Contact name extraction for old format
-            contacts = webhook_context_data.get('contacts', []) # webhook_context_data is 'value' for old fmt
-            contact_name = None
-            for contact in contacts:
-                if contact.get('wa_id') == from_number:
-                    profile = contact.get('profile', {})
-                    contact_name = profile.get('name')
-                    break
+async def prepare_media_async(inbound: InboundMessage) -> Optional[StoredMedia]:
+    """Versão assíncrona de prepare_media: download via httpx, processamento/upload (CPU e cliente síncrono do GCS) em uma thread."""
+    if not inbound.media or inbound.sender_phone in Config.IGNORE_LIST_NUMBERS:
+        return None
+    media_data_bytes = await download_media_bytes_async(inbound)
+    return await asyncio.to_thread(store_media, inbound, media_data_bytes)
+
+def unclaimed_media_blobs(stored_media: List[Optional[StoredMedia]], rolled_back: bool = False) -> List[str]:
+    """
+    Objetos enviados ao bucket sem mensagem gravada: reentrega que perdeu a reserva ou, com rolled_back,
+    todos os do lote desfeito (a nova tentativa da IngestQueue envia as mídias de novo).
+    """
+    return [media.media_file.cloud_storage_path for media in stored_media
+            if media and media.media_file and (rolled_back or not media.claimed)]
+
+def download_media_bytes(inbound: InboundMessage) -> Optional[bytes]:
+    """Baixa (e descriptografa) a mídia da mensagem. Retorna None em caso de falha."""
+    media = inbound.media
+    try:
+        if inbound.is_new_format:
+            logger.info(f"Attempting to download media for new format: url={bool(media.download_url)}, media_key={media.media_key}")
+            return whatsapp_service.download_media(
+                media_url=media.download_url,
+                media_key_b64=media.media_key,
+                original_message_type=inbound.message_type_raw # ex: "audioMessage"
+            )
+        # This download_media is for the OLD API. It might need adjustment or a new method for new API.
+        return whatsapp_service.download_media(media.media_id)
+    except Exception as e:
+        logger.error(f"Error downloading media {media.filename}: {e}", exc_info=True)
+        return None
+
+async def download_media_bytes_async(inbound: InboundMessage) -> Optional[bytes]:
+    """Versão assíncrona de download_media_bytes; o formato antigo (legado) só tem cliente síncrono."""
+    if not inbound.is_new_format:
+        return await asyncio.to_thread(download_media_bytes, inbound)
+    media = inbound.media
+    logger.info(f"Attempting to download media for new format: url={bool(media.download_url)}, media_key={media.media_key}")
+    return await whatsapp_service.download_media_async(
+        media_url=media.download_url,
+        media_key_b64=media.media_key,
+        original_message_type=inbound.message_type_raw
+    )
+
+def parse_batch(items: List[tuple]) -> List[InboundMessage]:
+    """Normaliza os payloads do lote uma única vez; payloads inválidos são descartados (não adianta tentar de novo)."""
+    inbound_messages = []
+    for message_data, webhook_context_data in items:
+        try:
+            inbound_messages.append(parse_inbound_message(message_data, webhook_context_data))
+        except InvalidPayloadError as e:
+            logger.warning(f"Descartando payload inválido: {e}")
+    return inbound_messages
+
+def ingest_message(inbound: InboundMessage, db: Session, stored_media: Optional[StoredMedia] = None) -> Optional[tuple]:
+    """
+    Adiciona a mensagem recebida (e a mídia já enviada por prepare_media) à sessão, com um único flush
+    e sem commit; quem chama faz o commit do lote inteiro.
+    Retorna (conversation, message, media_bytes_for_ai), ou None se a mensagem foi ignorada ou já processada.
+    Erros inesperados são propagados para que o lote seja desfeito por completo.
+    """
+    staged = stage_inbound_message(db, inbound)
+    if not staged:
+        return None
+    conversation, message = staged
+    finish_inbound_message(db, message, stored_media)
+    if stored_media:
+        stored_media.claimed = True
+    return conversation, message, stored_media.media_bytes_for_ai if stored_media else None
+
+async def ingest_message_async(inbound: InboundMessage, db: AsyncSession, stored_media: Optional[StoredMedia] = None) -> Optional[tuple]:
+    """Versão assíncrona de ingest_message: a etapa de banco roda via run_sync na AsyncSession."""
+    return await db.run_sync(lambda session: ingest_message(inbound, session, stored_media))
+
+def stage_inbound_message(db: Session, inbound: InboundMessage) -> Optional[tuple]:
+    """
+    Etapa de banco da ingestão: conversa, reserva da mensagem e conteúdo, sem nenhuma chamada externa.
+    Retorna (conversation, message), ou None se a mensagem foi ignorada ou já processada.
+    """
+    from_number = inbound.sender_phone
+    # ---> VERIFICAÇÃO DA LISTA DE IGNORADOS <---
+    if from_number in Config.IGNORE_LIST_NUMBERS:
+        logger.info(f"Mensagem de um número na lista de ignorados ({from_number}). Ignorando.")
+        return None
+
+    logger.info(f"Processing message ({'new' if inbound.is_new_format else 'old'} format): {inbound.message_id}, type: {inbound.message_type_raw} (normalized to {inbound.message_type}), from: {from_number}, instance: {inbound.instance}")
 
+    try:
         # Find or create conversation
-        conversation = db.query(Conversation).filter_by(user_phone=from_number).first()
+        conversation = find_conversation(db, from_number)
         if not conversation:
-            conversation = Conversation(
-                user_phone=from_number,
-                contact_name=contact_name,
-                # whatsapp_business_account_id for new format might come from webhook_context_data.get('sender') if it represents the business account ID
-                # or from a fixed config if the instance implies the business account.
-                # For old format: webhook_context_data.get('metadata', {}).get('phone_number_id')
-            )
+            conversation = Conversation(user_phone=from_number, contact_name=inbound.contact_name)
             db.add(conversation)
-            db.commit()
-            db.refresh(conversation) # Refresh to get the generated ID
-            logger.info(f"Created new conversation for {from_number} (Name: {contact_name}), ID: {conversation.id}")
-        elif not conversation.contact_name and contact_name: # Update contact name if it was missing
-            conversation.contact_name = contact_name
-            db.commit()
-            db.refresh(conversation)
-            logger.info(f"Updated contact name for {from_number} to {contact_name}")
-
-        conversation_id_for_logging = conversation.id
-
-        existing_message = db.query(Message).filter_by(whatsapp_message_id=message_id).first()
-        if existing_message:
-            logger.info(f"Message {message_id} already processed")
-            return
-        
-        message = Message(
-            conversation_id=conversation.id,
-            whatsapp_message_id=message_id,
-            sender_phone=from_number,
-            message_type=message_type, # Normalized type
-            is_from_user=True,
-            # timestamp field in Message model needs to handle Unix timestamp or string
-            # Assuming it can handle it, or needs conversion here.
-            # For now, passing as is. If timestamp_val is Unix, and DB expects datetime:
-            # timestamp=datetime.fromtimestamp(int(timestamp_val)) if is_new_format and timestamp_val else timestamp_val
+            logger.info(f"Created new conversation for {from_number} (Name: {inbound.contact_name})")
+        elif not conversation.contact_name and inbound.contact_name: # Update contact name if it was missing
+            conversation.contact_name = inbound.contact_name
+            conversation_cache.invalidate(from_number) # Volta ao cache, com o nome novo, depois do commit
+            logger.info(f"Updated contact name for {from_number} to {inbound.contact_name}")
+
+        # Reserva a mensagem antes de qualquer download ou chamada à IA: uma reentrega custa um único INSERT
+        message = claim_message(db, conversation, inbound.message_id, from_number, inbound.message_type, inbound.timestamp)
+        if message is None:
+            logger.info(f"Message {inbound.message_id} already processed")
+            return None
+
+        # Só os metadados aqui; o download e o upload da mídia foram feitos antes da transação (ver prepare_media)
+        message.content = inbound.content
+        message.processing_error = inbound.processing_error
+        if inbound.media:
+            message.mime_type = inbound.media.mime_type
+            message.file_name = inbound.media.filename
+        if inbound.processing_error:
+            logger.warning(f"Message {inbound.message_id}: {inbound.processing_error}")
+
+        return conversation, message
+
+    except Exception as e:
+        logger.error(f"Error processing message {inbound.message_id} for conversation {from_number}: {str(e)}", exc_info=True)
+        raise
+
+def finish_inbound_message(db: Session, message: Message, stored_media: Optional[StoredMedia] = None):
+    """Aplica a mídia enviada à mensagem e faz o único flush da ingestão (conversa, mensagem e mídia)."""
+    if stored_media:
+        message.mime_type = stored_media.mime_type
+        if stored_media.cloud_storage_url:
+            message.cloud_storage_url = stored_media.cloud_storage_url
+        if stored_media.processing_error:
+            message.processing_error = stored_media.processing_error
+        if stored_media.media_file:
+            # Pela chave estrangeira: anexar à coleção media_files carregaria a coleção com um SELECT
+            stored_media.media_file.message_id = message.id
+            db.add(stored_media.media_file)
+    db.flush()
+    if stored_media and stored_media.media_file:
+        logger.info(f"MediaFile record staged for message {message.id}")
+
+def store_media(inbound: InboundMessage, media_data_bytes: Optional[bytes]) -> StoredMedia:
+    """
+    Processa a mídia baixada e faz o upload para o Cloud Storage. Não acessa o banco (pode rodar em
+    outra thread); os campos da mensagem são aplicados por finish_inbound_message.
+    """
+    message_id = inbound.message_id
+    message_type = inbound.message_type
+    media = inbound.media
+    filename = media.filename
+
+    if not media_data_bytes:
+        logger.error(f"Failed to download media for message {message_id} ({'new' if inbound.is_new_format else 'old'} format)")
+        return StoredMedia(mime_type=media.mime_type, processing_error="Failed to download media from WhatsApp")
+
+    stored = StoredMedia(mime_type=media.mime_type, media_bytes_for_ai=media_data_bytes)
+    try:
+        # A IA sempre recebe os bytes originais (já descriptografados); o upload usa a versão padronizada
+        upload_data_bytes = media_data_bytes
+        upload_mime_type = media.mime_type
+        processor = {'image': media_processor.process_image, 'audio': media_processor.process_audio}.get(message_type)
+        if processor:
+            processed_for_upload, metadata = processor(media_data_bytes, filename)
+            if processed_for_upload:
+                upload_data_bytes = processed_for_upload
+                if metadata and metadata.get('output_format'):
+                    upload_mime_type = f"{message_type}/{metadata['output_format'].lower()}"
+
+        # O mime_type da mensagem no banco deve refletir o que foi salvo na nuvem.
+        stored.mime_type = upload_mime_type
+
+        blob_name, public_url = cloud_storage.upload_file(
+            upload_data_bytes, 
+            filename, 
+            upload_mime_type
         )
-        if timestamp_val: # Add timestamp if available
-            try:
-                # If new format, timestamp is Unix epoch. If old, it might be different.
-                # Assuming Message.timestamp can handle datetime objects.
-                from datetime import datetime
-                if isinstance(timestamp_val, (int, float, str)) and str(timestamp_val).isdigit():
-                     message.timestamp = datetime.fromtimestamp(int(str(timestamp_val)))
-                # else: # Potentially handle other old formats if they exist
-                #    message.timestamp = parse_some_other_format(timestamp_val)
-            except ValueError as ve:
-                logger.warning(f"Could not parse timestamp {timestamp_val}: {ve}")
-
-
-        if message_type == 'text':
-            if is_new_format:
-                text_content = message_data.get('message', {}).get('conversation', '')
-            else: # Old format
-                text_content = message_data.get('text', {}).get('body', '')
-            message.content = text_content
-            
-        elif message_type == 'location':
-            if is_new_format:
-                location_payload = message_data.get('message', {}).get('locationMessage', {})
-                latitude = location_payload.get('degreesLatitude')
-                longitude = location_payload.get('degreesLongitude')
-                if latitude is not None and longitude is not None:
-                    # Salvar as coordenadas como um JSON no conteúdo da mensagem para o histórico.
-                    message.content = json.dumps({'latitude': latitude, 'longitude': longitude})
-                    logger.info(f"Received location: lat={latitude}, lon={longitude}")
-                else:
-                    message.content = "Received a location message with missing coordinates."
-                    message.processing_error = "Missing coordinates in locationMessage"
-            else:
-                # Adicionar lógica para o formato antigo se ele também puder enviar localizações.
-                # Por agora, assumimos que não é suportado ou é igual.
-                logger.warning("Location message processing not implemented for old format.")
-                message.content = "Location message from old format not supported."
-                message.processing_error = "Unsupported location message format"
-            
-        elif message_type in ['image', 'audio', 'video', 'document']:
-            if is_new_format:
-                media_object_key = message_type_raw # e.g., "audioMessage", "imageMessage"
-                media_specific_payload = message_data.get('message', {}).get(media_object_key, {})
-                
-                download_url = media_specific_payload.get('url')
-                media_key = media_specific_payload.get('mediaKey') # Pode ser usado como fallback ou ID alternativo
-                mime_type = media_specific_payload.get('mimetype')
-                
-                # Caption pode estar em lugares diferentes dependendo da API ou tipo de mídia.
-                # Tentativa 1: Dentro do objeto específico da mídia (ex: imageMessage.caption)
-                caption = media_specific_payload.get('caption')
-                # Tentativa 2: Diretamente no objeto 'message' (comum para alguns tipos de mídia)
-                if not caption:
-                    caption = message_data.get('message', {}).get('caption')
-                # Tentativa 3: Para "text" dentro de "extendedTextMessage" que acompanha mídia (se aplicável à Evolution)
-                if not caption and message_data.get('message', {}).get('extendedTextMessage', {}).get('text'):
-                    caption = message_data.get('message', {}).get('extendedTextMessage', {}).get('text')
-
-
-                message.content = caption if caption else f"Received {message_type_raw}"
-                message.mime_type = mime_type
-                
-                # Gerar um nome de arquivo se não estiver disponível
-                # A Evolution API pode fornecer 'fileName' em media_specific_payload para alguns tipos.
-                filename = media_specific_payload.get('fileName')
-                if not filename:
-                    extension_from_mime = mime_type.split('/')[-1].split(';')[0] if mime_type else message_type
-                    filename = f"{message_type}_{message_id}.{extension_from_mime}"
-                message.file_name = filename
-
-                if download_url or media_key:
-                    logger.info(f"Attempting to download media for new format: url={bool(download_url)}, media_key={media_key}")
-                    # Passar message_type_raw (ex: "audioMessage") para que o serviço possa determinar o app_info correto para HKDF.
-                    media_data_bytes = whatsapp_service.download_media(
-                        media_url=download_url, 
-                        media_key_b64=media_key, 
-                        original_message_type=message_type_raw # ex: "audioMessage"
-                    )
-                    
-                    if media_data_bytes: # Agora media_data_bytes são os bytes descriptografados
-                        # A IA deve sempre receber os bytes originais e descriptografados para melhor análise.
-                        processed_media_bytes_for_ai = media_data_bytes
-                        
-                        # Para o upload na nuvem, podemos usar uma versão processada e padronizada.
-                        upload_data_bytes = media_data_bytes
-                        upload_mime_type = mime_type
-                        
-                        if message_type == 'image':
-                            processed_for_upload, metadata = media_processor.process_image(media_data_bytes, filename)
-                            if processed_for_upload:
-                                upload_data_bytes = processed_for_upload
-                                if metadata and metadata.get('output_format'):
-                                    upload_mime_type = f"image/{metadata['output_format'].lower()}"
-                        elif message_type == 'audio':
-                            processed_for_upload, metadata = media_processor.process_audio(media_data_bytes, filename)
-                            if processed_for_upload:
-                                upload_data_bytes = processed_for_upload
-                                if metadata and metadata.get('output_format'):
-                                   upload_mime_type = f"audio/{metadata['output_format'].lower()}"
-                        
-                        # O mime_type da mensagem no banco deve refletir o que foi salvo na nuvem.
-                        message.mime_type = upload_mime_type
-                        
-                        blob_name, public_url = cloud_storage.upload_file(
-                            upload_data_bytes, 
-                            filename, 
-                            upload_mime_type
-                        )
-                        
-                        if blob_name and public_url:
-                            message.cloud_storage_url = public_url
-                            media_file_obj = MediaFile(
-                                original_url=download_url, # Salvar o URL original de onde baixamos
-                                cloud_storage_bucket=Config.GOOGLE_CLOUD_BUCKET_NAME,
-                                cloud_storage_path=blob_name,
-                                public_url=public_url,
-                                file_name=filename,
-                                file_size=len(upload_data_bytes),
-                                mime_type=mime_type, # Mime type original da Evolution API
-                                processing_status='processed'
-                            )
-                        else:
-                            logger.error(f"Failed to upload media for message {message_id} (new format)")
-                            message.processing_error = "Failed to upload media to cloud storage (new format)"
-                    else:
-                        logger.error(f"Failed to download media for message {message_id} (new format) using url/media_key")
-                        message.processing_error = "Failed to download media from WhatsApp (new format)"
-                else:
-                    logger.warning(f"No download_url or media_key found for media message {message_id} (new format)")
-                    message.processing_error = "No download information for media (new format)"
-            
-            else: # Old format media processing (existing logic)
-                media_info = message_data.get(message_type, {}) # e.g. message_data.get('image', {})
-                media_id = media_info.get('id') # This is the Meta media ID
-                caption = media_info.get('caption', '')
-                # Use a more specific filename if available from the message, else default
-                base_filename = media_info.get('filename', f'{message_type}_{message_id}')
-                # Ensure filename has an extension based on mime_type if not present
-                # This is a simplified example; a proper mime-to-extension mapping might be needed
-                if '.' not in base_filename and media_info.get('mime_type'):
-                    extension = media_info.get('mime_type').split('/')[-1]
-                    if extension:
-                         base_filename = f"{base_filename}.{extension}"
-                
-                filename = base_filename
-
-                message.content = caption # Caption for the message
-                message.mime_type = media_info.get('mime_type') # Original mime_type
-                message.file_name = filename
-
-                # This download_media is for the OLD API. It might need adjustment or a new method for new API.
-                media_data_bytes = whatsapp_service.download_media(media_id) 
-                if media_data_bytes:
-                    processed_data_bytes, processing_metadata = None, None
-                    actual_mime_type_for_ai = message.mime_type # Start with original
-                    
-                    if message_type == 'image':
-                        processed_data_bytes, processing_metadata = media_processor.process_image(media_data_bytes, filename)
-                        if processing_metadata and processing_metadata.get('output_format'):
-                            actual_mime_type_for_ai = f"image/{processing_metadata['output_format'].lower()}"
-                    elif message_type == 'audio':
-                        # Assuming process_audio also returns (data, metadata)
-                        processed_data_bytes, processing_metadata = media_processor.process_audio(media_data_bytes, filename) 
-                        if processing_metadata and processing_metadata.get('output_format'):
-                           actual_mime_type_for_ai = f"audio/{processing_metadata['output_format'].lower()}"
-                    
-                    upload_data_bytes = processed_data_bytes if processed_data_bytes else media_data_bytes
-                    processed_media_bytes_for_ai = upload_data_bytes # This is what AI service gets
-                    message.mime_type = actual_mime_type_for_ai # Store the potentially converted mime type for AI
-                    
-                    blob_name, public_url = cloud_storage.upload_file(
-                        upload_data_bytes, 
-                        filename, # Use the derived filename
-                        actual_mime_type_for_ai # Use the mime type for AI
-                    )
-                    
-                    if blob_name and public_url:
-                        message.cloud_storage_url = public_url
-                        # Prepare MediaFile object, will be committed after message has an ID
-                        media_file_obj = MediaFile(
-                            # message_id will be set after message is committed
-                            original_url=media_info.get('url', ''), # If available from original payload
-                            cloud_storage_bucket=Config.GOOGLE_CLOUD_BUCKET_NAME,
-                            cloud_storage_path=blob_name,
-                            public_url=public_url,
-                            file_name=filename, # Store the derived filename
-                            file_size=len(upload_data_bytes),
-                            mime_type=media_info.get('mime_type'), # Original mime_type from provider
-                            processing_status='processed'
-                        )
-                    else:
-                        logger.error(f"Failed to upload media for message {message_id}")
-                        message.processing_error = "Failed to upload media to cloud storage"
-                else:
-                    logger.error(f"Failed to download media for message {message_id} (old format)")
-                    message.processing_error = "Failed to download media from WhatsApp"
         
-        else: # Other message types not explicitly handled yet
-            logger.warning(f"Received unhandled message_type: {message_type_raw if is_new_format else message_type} for message {message_id}")
-            message.content = f"Received {message_type_raw if is_new_format else message_type} (type not fully supported)"
-            message.processing_error = "Unsupported message type by current logic"
+        if blob_name and public_url:
+            stored.cloud_storage_url = public_url
+            stored.media_file = MediaFile(
+                original_url=media.original_url,
+                cloud_storage_bucket=Config.GOOGLE_CLOUD_BUCKET_NAME,
+                cloud_storage_path=blob_name,
+                public_url=public_url,
+                file_name=filename,
+                file_size=len(upload_data_bytes),
+                mime_type=media.mime_type, # Mime type original do provedor
+                processing_status='processed'
+            )
+        else:
+            logger.error(f"Failed to upload media for message {message_id}")
+            stored.processing_error = "Failed to upload media to cloud storage"
+    except Exception as e:
+        # Uma falha na mídia não deve impedir que a mensagem (e a resposta da IA) sejam salvas
+        logger.error(f"Error processing media for message {message_id}: {e}", exc_info=True)
+        stored.processing_error = f"Failed to process media: {e}"
 
+    return stored
 
+def claim_message(db: Session, conversation: Conversation, whatsapp_message_id: str, sender_phone: str,
+                  message_type: str, timestamp: Optional[datetime] = None) -> Optional[Message]:
+    """
+    Insere a linha da mensagem com INSERT ... ON CONFLICT (whatsapp_message_id) DO NOTHING RETURNING.
+    Retorna a Message reservada (já na sessão) ou None se outra entrega já a inseriu.
+    A reserva faz parte da transação de ingestão: se o lote for desfeito, a mensagem volta a ficar livre.
+    """
+    if conversation.id is None:
+        db.flush() # A conversa nova precisa de ID para a chave estrangeira
+
+    values = {
+        'conversation_id': conversation.id,
+        'whatsapp_message_id': whatsapp_message_id,
+        'sender_phone': sender_phone,
+        'message_type': message_type,
+        'is_from_user': True,
+    }
+    if timestamp:
+        values['timestamp'] = timestamp
+
+    dialect_insert = UPSERT_INSERTS.get(db.get_bind().dialect.name)
+    if dialect_insert is None:
+        # Bancos sem ON CONFLICT: volta para a verificação antes do insert
+        if db.query(Message.id).filter_by(whatsapp_message_id=whatsapp_message_id).first():
+            return None
+        message = Message(**values)
         db.add(message)
-        db.commit() # Commit for message to get an ID
-        db.refresh(message)
-
-        #---> ATUALIZAÇÃO DO PERFIL DO USUÁRIO <---
-        # Após salvar a mensagem, tentamos extrair e salvar informações de perfil do texto.
-        # Isso é feito independentemente do tipo de mensagem, pois mesmo uma imagem pode ter uma legenda com informações.
-        if message.content and isinstance(message.content, str) and message.content.strip():
-            update_user_profile(db, conversation, message.content)
+        db.flush()
+        return message
+
+    stmt = dialect_insert(Message).values(**values).on_conflict_do_nothing(
+        index_elements=['whatsapp_message_id']
+    ).returning(Message)
+    return db.scalars(stmt).first()
+
+def is_silenced(conversation: Conversation) -> bool:
+    """Modo silencioso ativado no dashboard: as mensagens são gravadas, mas a IA não responde (sem ida ao banco)."""
+    if silent_mode_registry.is_silent(conversation.id):
+        logger.info(f"Conversa {conversation.id} em modo silencioso; turno gravado sem resposta da IA.")
+        return True
+    return False
+
+def get_turn_text(messages: List[Message]) -> str:
+    """Junta o conteúdo textual das mensagens de um turno (uma mensagem ou uma rajada agrupada)."""
+    return "\n".join(msg.content.strip() for msg in messages if msg.content and isinstance(msg.content, str) and msg.content.strip())
+
+def respond_to_turn(db: Session, turn: List[tuple]):
+    """
+    Gera e envia uma única resposta da IA para as mensagens salvas por ingest_message.
+    Perfil, AIResponse, solicitação de atendente e pedido são apenas adicionados à sessão
+    pelas funções auxiliares e gravados juntos em um único commit no final.
+    """
+    conversation, message, processed_media_bytes_for_ai = turn[-1]
+    turn_messages = [msg for _, msg, _ in turn]
+    if len(turn_messages) > 1:
+        logger.info(f"Respondendo {len(turn_messages)} mensagens agrupadas da conversa {conversation.id} como um único turno.")
 
+    try:
+        load_level = admission_controller.level()
+        if load_level >= LoadLevel.BUSY:
+            send_busy_reply(conversation)
+            return
+        full_turn = load_level < LoadLevel.DEGRADED
+        if not full_turn:
+            admission_controller.record('degraded_turns')
 
-        if 'media_file_obj' in locals() and media_file_obj: # Check if media_file_obj was created (old format media)
-            media_file_obj.message_id = message.id
-            db.add(media_file_obj)
-            db.commit()
-            logger.info(f"MediaFile record created for message {message.id}")
+        turn_text = get_turn_text(turn_messages)
+        context = load_turn_context(db, message, turn_messages)
+        # Encerra a transação de leitura: a conexão volta ao pool enquanto a IA responde
+        end_read_transaction(db)
 
-        # Mark message as read - This uses OLD API message_id. 
-        # If new API has a different way or doesn't need explicit read marking, this needs change.
-        # For now, it will try with the message_id we have.
-        if not is_new_format: # Assuming new API might not need/support this or has different mechanism
-            whatsapp_service.mark_message_as_read(message_id) 
-        else:
-            logger.info(f"Mark as read skipped for new format message {message_id} (mechanism TBD).")
+        #---> ATUALIZAÇÃO DO PERFIL DO USUÁRIO <---
+        # Tentamos extrair e salvar informações de perfil do texto do turno.
+        # Isso é feito independentemente do tipo de mensagem, pois mesmo uma imagem pode ter uma legenda com informações.
+        if turn_text and full_turn:
+            update_user_profile(db, conversation, turn_text)
+            context = with_pending_profile(context, conversation.id)
         
         # Generate AI response
         # Ensure message.content and message.mime_type are correctly set before this call.
         # For new format media, message.content might be a placeholder and mime_type might be missing.
-        ai_response_text, ai_metadata = generate_ai_response(db, message, media_bytes=processed_media_bytes_for_ai)
+        ai_response_text, ai_metadata = generate_ai_response(db, message, media_bytes=processed_media_bytes_for_ai, turn_messages=turn_messages, context=context)
 
         # Enviar a resposta da IA para o usuário se houver uma
         if ai_response_text:
@@ -456,57 +619,246 @@ def process_message_sync(message_data, webhook_context_data, db: Session): # Add
         else:
             logger.warning(f"Nenhuma resposta de texto da IA foi gerada para a mensagem {message.id}. Nenhuma mensagem enviada.")
 
-        # Checar se um HumanAgentRequest foi criado e notificar
+        # Checar se a IA pediu um atendente humano; a notificação só é enviada depois do commit
+        human_request = None
+        reason_for_request = None
         if ai_metadata and ai_metadata.get("action") == "REQUEST_HUMAN_AGENT":
-            # Aqui, criamos o HumanAgentRequest e obtemos seu ID.
             reason_for_request = ai_metadata.get("reason", "AI requested assistance") # Obtenha a razão do metadata se houver
-            human_request_id = create_human_agent_request(
-                db,
-                conversation_id=conversation.id,
-                reason=reason_for_request
-            )
-            
-            if human_request_id:
-                logger.info(f"Human agent requested (ID: {human_request_id}) for conversation {conversation.id}. Sending Pushover notification.")
-                
-                # Determinar a Pushover User Key
-                pushover_user_key = Config.DEFAULT_PUSHOVER_USER_KEY
-
-                if pushover_user_key:
-                    dashboard_url = f"http://localhost:5000/dashboard/human-handoff?conversation_id={conversation.id}" # Usando um URL de exemplo
-                    notification_message = f"Nova solicitação para ID conversa: {conversation.id}. Usuário: {conversation.user_phone}. Razão: {reason_for_request}"
-                    
-                    send_pushover_notification(
-                        title="Solicitação de Atendimento Humano",
-                        message=notification_message,
-                        user_key=pushover_user_key,
-                        url=dashboard_url,
-                        url_title="Abrir no Dashboard"
-                    )
-                else:
-                    logger.warning(f"Pushover USER_KEY não encontrada para notificar sobre HumanAgentRequest {human_request_id}")
+            human_request = create_human_agent_request(db, conversation, reason=reason_for_request)
         
         # ---> DETECÇÃO E CRIAÇÃO DE PEDIDO <---
         # Após a resposta ser gerada, verificamos se a interação resultou em um pedido.
-        # Usamos a mensagem original do usuário e o histórico para dar contexto ao Order Manager.
-        if message.content and isinstance(message.content, str) and message.content.strip():
+        # Usamos o texto do turno e o histórico para dar contexto ao Order Manager.
+        if turn_text and full_turn:
             # Precisamos do histórico mais recente para que o Order Manager possa extrair os itens
-            full_history_for_order = get_conversation_history(db, message.conversation_id, limit=20) # Pega um histórico maior
-            create_order_from_interaction(db, message.conversation, message.content, full_history_for_order)
+            full_history_for_order = context.order_history
+            if message.message_type == 'audio':
+                # A transcrição atualizou o history_buffer depois do carregamento do contexto (sem ida ao banco)
+                full_history_for_order = get_conversation_history(db, message.conversation_id, limit=20)
+            create_order_from_interaction(db, message.conversation, turn_text, full_history_for_order)
+
+        # Único commit do resultado da IA (perfil, resposta, transcrição, atendente e pedido)
+        profile_cache.write_pending(db, conversation.id)
+        db.commit()
+        profile_cache.committed(conversation.id)
+
+        if human_request:
+            notification = build_human_request_notification(conversation, human_request, reason_for_request)
+            if notification:
+                send_pushover_notification(**notification)
         
-        logger.info(f"Message {message_id} (DB ID: {message.id}) processed successfully for conversation {conversation.id}")
+        logger.info(f"Message {message.whatsapp_message_id} (DB ID: {message.id}) processed successfully for conversation {conversation.id}")
         
     except Exception as e:
-        logger.error(f"Error processing message {message_data.get('id', 'unknown')} for conversation {conversation_id_for_logging if conversation_id_for_logging else 'unknown'}: {str(e)}", exc_info=True)
-        db.rollback()
+        db.rollback() # Antes do log: depois de um commit falho a sessão só aceita rollback
+        history_buffer.invalidate(conversation.id) # Pode conter uma transcrição que não foi gravada
+        profile_cache.discard(conversation.id)
+        logger.error(f"Error responding to message {message.id} for conversation {conversation.id}: {str(e)}", exc_info=True)
+
+def send_busy_reply(conversation: Conversation):
+    """Modo BUSY: responde sem IA; as mensagens já foram gravadas e continuam no histórico."""
+    admission_controller.record('busy_replies')
+    logger.warning(f"Sobrecarga: conversa {conversation.id} recebe a resposta de ocupado em vez da IA.")
+    whatsapp_service.send_text_message(to_number=conversation.user_phone, text=Config.BUSY_REPLY_MESSAGE)
+
+async def send_busy_reply_async(conversation: Conversation):
+    admission_controller.record('busy_replies')
+    logger.warning(f"Sobrecarga: conversa {conversation.id} recebe a resposta de ocupado em vez da IA.")
+    await whatsapp_service.send_text_message_async(to_number=conversation.user_phone, text=Config.BUSY_REPLY_MESSAGE)
+
+def build_human_request_notification(conversation: Conversation, human_request: HumanAgentRequest, reason: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Monta os parâmetros da notificação Pushover de um HumanAgentRequest já gravado (precisa do ID)."""
+    human_request_id = human_request.id
+    logger.info(f"Human agent requested (ID: {human_request_id}) for conversation {conversation.id}. Sending Pushover notification.")
+    
+    # Determinar a Pushover User Key
+    pushover_user_key = Config.DEFAULT_PUSHOVER_USER_KEY
+    if not pushover_user_key:
+        logger.warning(f"Pushover USER_KEY não encontrada para notificar sobre HumanAgentRequest {human_request_id}")
+        return None
+
+    dashboard_url = f"http://localhost:5000/dashboard/human-handoff?conversation_id={conversation.id}" # Usando um URL de exemplo
+    return {
+        'title': "Solicitação de Atendimento Humano",
+        'message': f"Nova solicitação para ID conversa: {conversation.id}. Usuário: {conversation.user_phone}. Razão: {reason}",
+        'user_key': pushover_user_key,
+        'url': dashboard_url,
+        'url_title': "Abrir no Dashboard",
+    }
+
+async def process_message_batch_async(items: List[tuple], db: AsyncSession):
+    """
+    Versão asyncio de process_message_batch, usada pela IngestQueue quando ENABLE_ASYNC_PIPELINE está ativo.
+    Mesma unidade de trabalho (um commit para a ingestão, outro para o resultado da IA), mas nenhuma
+    etapa bloqueia o event loop: banco via AsyncSession, HTTP via httpx e agentes via arun.
+    """
+    turn = []
+    read_receipts = []
+    inbound_messages = parse_batch(items)
+    stored_media = await asyncio.gather(*(prepare_media_async(inbound) for inbound in inbound_messages))
+    try:
+        for inbound, media in zip(inbound_messages, stored_media):
+            ingested = await ingest_message_async(inbound, db, media)
+            if ingested:
+                turn.append(ingested)
+                if not inbound.is_new_format:
+                    read_receipts.append(inbound.message_id)
+        await db.run_sync(record_conversation_messages, [message for _, message, _ in turn])
+        cache_entries = conversation_cache_entries(turn)
+        history_entries = turn_history_entries(turn)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        invalidate_cached_conversations(inbound_messages)
+        for blob_name in unclaimed_media_blobs(stored_media, rolled_back=True):
+            await asyncio.to_thread(cloud_storage.delete_file, blob_name)
+        raise
+    conversation_cache.put_many(cache_entries)
+    history_buffer.append_many(history_entries)
+
+    for blob_name in unclaimed_media_blobs(stored_media):
+        await asyncio.to_thread(cloud_storage.delete_file, blob_name)
+
+    # Formato antigo (legado): o mark as read só existe no cliente síncrono
+    for whatsapp_message_id in read_receipts:
+        await asyncio.to_thread(whatsapp_service.mark_message_as_read, whatsapp_message_id)
+
+    if turn:
+        if silent_mode_registry.needs_refresh():
+            await db.run_sync(silent_mode_registry.load)
+        if is_silenced(turn[-1][0]):
+            return
+        await respond_to_turn_async(db, turn)
+
+async def close_async_pipeline():
+    """Fecha, no event loop da IngestQueue, os clientes HTTP e as conexões do pipeline asyncio."""
+    await whatsapp_service.aclose()
+    await ai_service.geolocation_service.aclose()
+    await dispose_async_engine(pipeline_async_engine)
+
+async def skip_step() -> None:
+    """Etapa omitida no modo degradado (mantém a forma do asyncio.gather)."""
+    return None
+
+def load_turn_context(db: Session, message: Message, turn_messages: List[Message]) -> ConversationContext:
+    """
+    Faz de uma vez as leituras de banco de que a IA precisa para responder ao turno: o histórico vem do
+    history_buffer e o restante de uma única consulta.
+    """
+    conversation_id = message.conversation_id
+    order_history = get_conversation_history(db, conversation_id, limit=20)
+    profile_data = profile_cache.get(conversation_id)
+    context = load_conversation_context(db, conversation_id, turn_messages[0].timestamp, order_history, load_profile=profile_data is None)
+    if profile_data is None:
+        profile_data = context.profile_data or {}
+        profile_cache.put(conversation_id, profile_data)
+    return with_pending_profile(replace(context, profile_data=profile_data), conversation_id)
+
+def with_pending_profile(context: ConversationContext, conversation_id: int) -> ConversationContext:
+    # Chaves extraídas neste turno e ainda não gravadas já valem para a resposta
+    profile_data = {**(context.profile_data or {}), **profile_cache.pending(conversation_id)}
+    return replace(context, profile_data=profile_data or None)
+
+def end_read_transaction(db: Session):
+    """
+    Encerra a transação só de leitura sem expirar os objetos carregados (como expire_on_commit=False das
+    sessões asyncio): expirados, o próximo acesso a um atributo abriria outra transação durante a chamada à IA.
+    """
+    expire_on_commit = db.expire_on_commit
+    db.expire_on_commit = False
+    try:
+        db.commit()
+    finally:
+        db.expire_on_commit = expire_on_commit
+
+async def respond_to_turn_async(db: AsyncSession, turn: List[tuple]):
+    """
+    Versão asyncio de respond_to_turn. As leituras são feitas antes, em uma única etapa de banco;
+    extração de perfil, resposta e detecção de pedido rodam em paralelo (o perfil extraído neste turno
+    vale a partir do próximo, mas o texto do turno já está no prompt); tudo é gravado em um único commit.
+    """
+    conversation, message, processed_media_bytes_for_ai = turn[-1]
+    turn_messages = [msg for _, msg, _ in turn]
+    if len(turn_messages) > 1:
+        logger.info(f"Respondendo {len(turn_messages)} mensagens agrupadas da conversa {conversation.id} como um único turno.")
+
+    try:
+        load_level = admission_controller.level()
+        if load_level >= LoadLevel.BUSY:
+            await send_busy_reply_async(conversation)
+            return
+        full_turn = load_level < LoadLevel.DEGRADED
+        if not full_turn:
+            admission_controller.record('degraded_turns')
+
+        turn_text = get_turn_text(turn_messages)
+        context = await db.run_sync(load_turn_context, message, turn_messages)
+        # Encerra a transação de leitura: a conexão volta ao pool enquanto a IA responde
+        await db.commit()
+
+        profile_action, (ai_response_text, ai_metadata), order_action = await asyncio.gather(
+            ai_service.extract_profile_info_async(turn_text) if full_turn else skip_step(),
+            generate_ai_response_async(message, context, media_bytes=processed_media_bytes_for_ai, turn_messages=turn_messages),
+            extract_order_action_async(turn_text, context.order_history) if full_turn else skip_step(),
+        )
+
+        if ai_response_text:
+            await whatsapp_service.send_text_message_async(to_number=conversation.user_phone, text=ai_response_text)
+        else:
+            logger.warning(f"Nenhuma resposta de texto da IA foi gerada para a mensagem {message.id}. Nenhuma mensagem enviada.")
+
+        # Áudio: o texto transcrito substitui o conteúdo da mensagem e também alimenta o perfil
+        transcribed_text = ai_metadata.get('transcribed_text') if ai_metadata and message.message_type == 'audio' else None
+        transcription_profile_action = await ai_service.extract_profile_info_async(transcribed_text) if transcribed_text and full_turn else None
+
+        reason_for_request = ai_metadata.get("reason", "AI requested assistance") if ai_metadata else None
+
+        def stage_turn_result(session: Session) -> Optional[HumanAgentRequest]:
+            apply_profile_action(conversation, profile_action)
+            if transcribed_text:
+                message.content = transcribed_text
+                refresh_message_preview(session, message)
+                history_buffer.update_content(message.conversation_id, message.id, transcribed_text)
+                apply_profile_action(conversation, transcription_profile_action)
+            if ai_metadata is not None:
+                stage_ai_response(session, message, ai_response_text, ai_metadata)
+            human_request = None
+            if ai_metadata and ai_metadata.get("action") == "REQUEST_HUMAN_AGENT":
+                human_request = create_human_agent_request(session, conversation, reason=reason_for_request)
+            stage_order(session, conversation, order_action)
+            profile_cache.write_pending(session, conversation.id)
+            return human_request
+
+        human_request = await db.run_sync(stage_turn_result)
+        await db.commit()
+        profile_cache.committed(conversation.id)
+
+        if human_request:
+            notification = build_human_request_notification(conversation, human_request, reason_for_request)
+            if notification:
+                await send_pushover_notification_async(**notification)
+
+        logger.info(f"Message {message.whatsapp_message_id} (DB ID: {message.id}) processed successfully for conversation {conversation.id}")
+
+    except Exception as e:
+        await db.rollback()
+        history_buffer.invalidate(conversation.id)
+        profile_cache.discard(conversation.id)
+        logger.error(f"Error responding to message {message.id} for conversation {conversation.id}: {str(e)}", exc_info=True)
 
 def update_user_profile(db: Session, conversation: Conversation, message_text: str):
     """
-    Chama o AI Service para extrair informações de perfil e as salva no banco de dados.
+    Chama o AI Service para extrair informações de perfil e as adiciona à sessão (o commit fica com quem chama).
     """
     try:
-        profile_action = ai_service.extract_profile_info(message_text)
-        
+        apply_profile_action(conversation, ai_service.extract_profile_info(message_text))
+    except Exception as e:
+        # Nada foi gravado ainda; não há o que desfazer na sessão compartilhada
+        logger.error(f"Falha ao atualizar o perfil do usuário para a conversa {conversation.id}: {e}", exc_info=True)
+
+def apply_profile_action(conversation: Conversation, profile_action: Optional[Dict[str, Any]]):
+    """Aplica a ação retornada pelo Profile Manager ao perfil da conversa (pendente no profile_cache, sem commit)."""
+    try:
         if not profile_action or profile_action.get('action') != 'SAVE':
             return # Nenhuma ação de salvamento necessária
 
@@ -522,34 +874,17 @@ def update_user_profile(db: Session, conversation: Conversation, message_text: s
             logger.warning(f"Chave ou valor ausente nos dados do perfil: {profile_data}")
             return
 
-        # Busca ou cria o perfil do usuário
-        user_profile = conversation.profile
-        if not user_profile:
-            user_profile = UserProfile(conversation_id=conversation.id, profile_data={})
-            db.add(user_profile)
-        
-        # Atualiza os dados do perfil.
-        # Usar .copy() para garantir que o SQLAlchemy detecte a mudança no JSON.
-        updated_data = user_profile.profile_data.copy()
-        updated_data[key] = value
-        user_profile.profile_data = updated_data
-        
-        db.commit()
-        db.refresh(user_profile)
+        # Sem ler o perfil: a chave fica pendente e é gravada junto com as demais no commit do turno
+        profile_cache.stage(conversation.id, key, value)
         logger.info(f"Perfil do usuário para a conversa {conversation.id} atualizado. Chave: '{key}', Valor: '{value}'")
 
     except Exception as e:
-        db.rollback()
         logger.error(f"Falha ao atualizar o perfil do usuário para a conversa {conversation.id}: {e}", exc_info=True)
 
-def create_human_agent_request(db: Session, conversation_id: int, reason: str):
-    """Creates a request for a human agent and saves it to the database."""
+def create_human_agent_request(db: Session, conversation: Conversation, reason: str) -> Optional[HumanAgentRequest]:
+    """Stages a request for a human agent in the session; the caller commits it with the rest of the turn."""
+    conversation_id = conversation.id
     try:
-        conversation = db.query(Conversation).get(conversation_id)
-        if not conversation:
-            logger.error(f"Cannot create human agent request: Conversation {conversation_id} not found.")
-            return
-
         # Check for an existing active request
         existing_request = db.query(HumanAgentRequest).filter_by(
             conversation_id=conversation_id,
@@ -568,80 +903,69 @@ def create_human_agent_request(db: Session, conversation_id: int, reason: str):
             status='pending'
         )
         db.add(human_request)
-        db.commit()
-        db.refresh(human_request)
         logger.info(f"Human agent request created for conversation {conversation_id} with reason: {reason}")
-        return human_request.id  # Retornar o ID da solicitação criada
+        return human_request  # O ID é atribuído no commit do turno
     
     except Exception as e:
-        db.rollback()
         logger.error(f"Failed to create human agent request for conversation {conversation_id}: {e}", exc_info=True)
         return None
 
 def get_conversation_history(db: Session, conversation_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-    """Fetches and formats the recent conversation history for the AI service."""
-    # Fetches messages in ascending order to get the latest ones at the end
-    recent_messages = db.query(Message).filter_by(
-        conversation_id=conversation_id
-    ).order_by(Message.timestamp.asc()).all()
-
-    # Get the last 'limit' messages
-    limited_messages = recent_messages[-limit:]
-
-    history_for_ai = []
-    for msg in limited_messages:
-        history_for_ai.append({
-            'sender_type': 'user' if msg.is_from_user else 'assistant',
-            'message_text': msg.content or '[conteúdo não textual]',
-        })
-    return history_for_ai
-
-def generate_ai_response(db: Session, message: Message, media_bytes: Optional[bytes] = None) -> tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Fetches and formats the recent conversation history for the AI service.
+    Servido pelo history_buffer; num miss, carrega só a janela mais recente do banco.
+    """
+    if limit > history_buffer.window:
+        entries = load_history_entries(db, conversation_id, limit)
+    else:
+        entries = history_buffer.get(conversation_id)
+        if entries is None:
+            entries = load_history_entries(db, conversation_id, history_buffer.window)
+            history_buffer.put(conversation_id, entries)
+    return [entry.as_prompt_item() for entry in entries[-limit:]]
+
+def load_history_entries(db: Session, conversation_id: int, limit: int) -> List[HistoryEntry]:
+    """Últimas `limit` mensagens em ordem cronológica (ORDER BY ... DESC LIMIT usa idx_messages_conversation_timestamp)."""
+    rows = db.query(Message.id, Message.timestamp, Message.is_from_user, Message.content).filter(
+        Message.conversation_id == conversation_id
+    ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    return [HistoryEntry(row.id, row.timestamp, row.is_from_user, row.content) for row in reversed(rows)]
+
+def generate_ai_response(db: Session, message: Message, media_bytes: Optional[bytes] = None, turn_messages: Optional[List[Message]] = None,
+                         context: Optional[ConversationContext] = None) -> tuple[Optional[str], Optional[Dict[str, Any]]]:
     """
     Generates a response from the AI service based on the message and conversation history.
     Also handles creating a HumanAgentRequest if the AI signals it.
+    turn_messages: mensagens agrupadas no mesmo turno (a última é `message`); o texto de todas vira o prompt.
+    context: leituras do turno feitas por load_turn_context (carregadas aqui se não forem informadas).
     """
+    turn_messages = turn_messages or [message]
     try:
+        context = context or load_turn_context(db, message, turn_messages)
+
+        # O text_prompt é o conteúdo do turno atual (uma mensagem ou a rajada agrupada)
+        text_prompt = get_turn_text(turn_messages) if len(turn_messages) > 1 else (message.content or "")
+
         # ---> VERIFICAÇÃO DE FRETE PROATIVO <---
         # Se a mensagem atual for um texto e a anterior for uma localização, calcula o frete automaticamente.
-        if message.message_type == 'text' and message.content and message.content.strip():
-            previous_message = db.query(Message).filter(
-                Message.conversation_id == message.conversation_id,
-                Message.timestamp < message.timestamp
-            ).order_by(Message.timestamp.desc()).first()
-
-            if previous_message and previous_message.message_type == 'location':
+        if message.message_type == 'text' and text_prompt.strip():
+            if context.previous_message_type == 'location':
                 logger.info(f"Sequência de localização -> texto detectada. Tentando cálculo de frete proativo.")
                 try:
-                    location_data = json.loads(previous_message.content)
+                    location_data = json.loads(context.previous_message_content)
                     origin_coords = f"{location_data.get('latitude')},{location_data.get('longitude')}"
-                    destination_address = message.content.strip()
+                    destination_address = text_prompt.strip()
 
                     # Usar diretamente o serviço de geolocalização do ai_service
                     geo_service = ai_service.geolocation_service
                     result = geo_service.get_distance_and_duration(origin_coords, destination_address)
                     
                     if result:
-                        distance_km, _, _, duration_text = result
-                        shipping_fee = geo_service.calculate_shipping_fee(distance_km)
-                        
-                        response_text = f"Cálculo de frete automático da sua localização para '{destination_address}':\n\n" \
-                                      f"📍 *Distância:* {distance_km:.2f} km\n" \
-                                      f"⏳ *Duração Estimada:* {duration_text}\n" \
-                                      f"💰 *Custo do Frete:* R$ {shipping_fee:.2f}"
-
-                        ai_metadata = {'agent_name': 'Proactive Shipping Calculator', 'proactive': True}
-                        
+                        response_text, ai_metadata = build_proactive_shipping_reply(geo_service, destination_address, result)
+
                         # Salvar a resposta da IA no banco de dados
-                        ai_response = AIResponse(
-                            message_id=message.id,
-                            response_content=response_text,
-                            agent_name=ai_metadata.get('agent_name')
-                        )
-                        db.add(ai_response)
-                        db.commit()
-                        db.refresh(ai_response)
-                        logger.info(f"Resposta de frete proativo para mensagem {message.id} salva no DB.")
+                        stage_ai_response(db, message, response_text, ai_metadata)
+                        logger.info(f"Resposta de frete proativo para mensagem {message.id} adicionada à sessão.")
 
                         return response_text, ai_metadata
                     else:
@@ -651,21 +975,10 @@ def generate_ai_response(db: Session, message: Message, media_bytes: Optional[by
                     logger.error(f"Erro ao tentar o cálculo de frete proativo: {e}. Seguindo fluxo normal.")
                     # Em caso de erro, simplesmente segue para o processamento normal da IA.
 
-        conversation_history = get_conversation_history(db, message.conversation_id)
-        
-        # ---> CARREGAR DADOS DO PERFIL DO USUÁRIO <---
-        user_profile = db.query(UserProfile).filter_by(conversation_id=message.conversation_id).first()
-        profile_data = user_profile.profile_data if user_profile else None
-
-        # ---> CARREGAR ÚLTIMO PEDIDO DO USUÁRIO <---
-        last_order = db.query(Order).filter_by(
-            conversation_id=message.conversation_id,
-            status='completed'
-        ).order_by(Order.created_at.desc()).first()
-        last_order_data = last_order.order_details if last_order else None
-        
-        # O text_prompt inicial é o conteúdo da mensagem atual
-        text_prompt = message.content or ""
+        conversation_history = context.conversation_history
+        # Perfil (inclui um perfil criado neste mesmo turno e ainda não gravado) e último pedido do usuário
+        profile_data = context.profile_data
+        last_order_data = context.last_order_data
         
         ai_result = None
         
@@ -717,31 +1030,17 @@ def generate_ai_response(db: Session, message: Message, media_bytes: Optional[by
             # ele se torne parte permanente do histórico da conversa.
             message.content = transcribed_text
             db.add(message) # Adiciona a mudança à sessão do DB
+            refresh_message_preview(db, message)
+            history_buffer.update_content(message.conversation_id, message.id, transcribed_text)
             logger.info(f"Conteúdo da mensagem de áudio (ID: {message.id}) atualizado com o texto transcrito.")
 
             logger.info(f"Texto transcrito do áudio ('{transcribed_text}') será usado para atualização de perfil.")
             # A função `update_user_profile` já existe e faz o que precisamos.
             update_user_profile(db, message.conversation, transcribed_text)
-        
-        # ---> DETECÇÃO E CRIAÇÃO DE PEDIDO <---
-        # Após a resposta ser gerada, verificamos se a interação resultou em um pedido.
-        # Usamos a mensagem original do usuário e o histórico para dar contexto ao Order Manager.
-        if message.content and isinstance(message.content, str) and message.content.strip():
-            # Precisamos do histórico mais recente para que o Order Manager possa extrair os itens
-            full_history_for_order = get_conversation_history(db, message.conversation_id, limit=20) # Pega um histórico maior
-            create_order_from_interaction(db, message.conversation, message.content, full_history_for_order)
     
         # Salvar a resposta da IA no banco de dados
-        ai_response = AIResponse(
-            message_id=message.id,
-            response_content=response_text,
-            agent_name=ai_metadata.get('agent_name'),
-            processing_time=ai_metadata.get('processing_time_ms')
-        )
-        db.add(ai_response)
-        db.commit()
-        db.refresh(ai_response)
-        logger.info(f"AI response for message {message.id} saved to DB.")
+        stage_ai_response(db, message, response_text, ai_metadata)
+        logger.info(f"AI response for message {message.id} staged; it is committed with the rest of the turn.")
         
         # Checar pela ação de solicitar um agente humano
         if ai_metadata and ai_metadata.get("action") == "REQUEST_HUMAN_AGENT":
@@ -755,17 +1054,122 @@ def generate_ai_response(db: Session, message: Message, media_bytes: Optional[by
 
     except Exception as e:
         logger.error(f"Error generating AI response for message {message.id}: {e}", exc_info=True)
-        db.rollback()
         # Fallback response
         return "Ops! Aconteceu um erro com a nossa IA. Já estamos verificando.", None
 
+def build_proactive_shipping_reply(geo_service, destination_address: str, result: tuple) -> tuple[str, Dict[str, Any]]:
+    """Formata a resposta do cálculo de frete proativo a partir do resultado da API de rotas."""
+    distance_km, _, _, duration_text = result
+    shipping_fee = geo_service.calculate_shipping_fee(distance_km)
+
+    response_text = f"Cálculo de frete automático da sua localização para '{destination_address}':\n\n" \
+                  f"📍 *Distância:* {distance_km:.2f} km\n" \
+                  f"⏳ *Duração Estimada:* {duration_text}\n" \
+                  f"💰 *Custo do Frete:* R$ {shipping_fee:.2f}"
+    return response_text, {'agent_name': 'Proactive Shipping Calculator', 'proactive': True}
+
+def stage_ai_response(db: Session, message: Message, response_text: str, ai_metadata: Dict[str, Any]) -> AIResponse:
+    """Adiciona a resposta da IA à sessão (o commit fica com quem chama)."""
+    ai_response = AIResponse(
+        message_id=message.id,
+        response_content=response_text,
+        agent_name=ai_metadata.get('agent_name'),
+        processing_time=ai_metadata.get('processing_time_ms')
+    )
+    db.add(ai_response)
+    return ai_response
+
+async def generate_ai_response_async(message: Message, context: Optional[ConversationContext], media_bytes: Optional[bytes] = None, turn_messages: Optional[List[Message]] = None) -> tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Versão asyncio de generate_ai_response. Não acessa o banco: recebe as leituras de load_turn_context
+    (sem contexto, responde sem histórico nem perfil) e não grava nada — quem chama registra a resposta com stage_ai_response.
+    """
+    turn_messages = turn_messages or [message]
+    context = context or ConversationContext(order_history=[])
+    try:
+        text_prompt = get_turn_text(turn_messages) if len(turn_messages) > 1 else (message.content or "")
+
+        # ---> VERIFICAÇÃO DE FRETE PROATIVO <---
+        if message.message_type == 'text' and text_prompt.strip() and context.previous_message_type == 'location':
+            logger.info("Sequência de localização -> texto detectada. Tentando cálculo de frete proativo.")
+            try:
+                location_data = json.loads(context.previous_message_content)
+                origin_coords = f"{location_data.get('latitude')},{location_data.get('longitude')}"
+                destination_address = text_prompt.strip()
+
+                geo_service = ai_service.geolocation_service
+                result = await geo_service.get_distance_and_duration_async(origin_coords, destination_address)
+                if result:
+                    return build_proactive_shipping_reply(geo_service, destination_address, result)
+                logger.warning("Cálculo proativo de frete falhou, pois a distância não pôde ser determinada. Seguindo fluxo normal.")
+            except (json.JSONDecodeError, ValueError, KeyError) as e:
+                logger.error(f"Erro ao tentar o cálculo de frete proativo: {e}. Seguindo fluxo normal.")
+
+        conversation_history = context.conversation_history
+        profile_data = context.profile_data
+
+        if message.message_type == 'image' and media_bytes:
+            ai_result = await ai_service.process_image_message_async(image_data=media_bytes, text_prompt=text_prompt, conversation_history=conversation_history, profile_data=profile_data)
+        elif message.message_type == 'video' and media_bytes:
+            ai_result = await ai_service.process_video_message_async(video_data=media_bytes, text_prompt=text_prompt, conversation_history=conversation_history, profile_data=profile_data)
+        elif message.message_type == 'audio' and media_bytes:
+            ai_result = await ai_service.process_audio_message_async(audio_data=media_bytes, conversation_history=conversation_history, profile_data=profile_data)
+        elif message.message_type == 'location':
+            try:
+                location_data = json.loads(message.content)
+                latitude = location_data.get('latitude')
+                longitude = location_data.get('longitude')
+                if latitude is None or longitude is None:
+                    raise ValueError("Latitude ou longitude ausentes no conteúdo da mensagem")
+                ai_result = await ai_service.process_location_message_async(
+                    latitude=latitude,
+                    longitude=longitude,
+                    conversation_history=conversation_history,
+                    profile_data=profile_data
+                )
+            except (json.JSONDecodeError, ValueError) as e:
+                logger.error(f"Não foi possível processar a localização da mensagem {message.id}: {e}")
+                ai_result = {'success': False, 'error': str(e)}
+        else:
+            ai_result = await ai_service.process_text_message_async(text=text_prompt, conversation_history=conversation_history, profile_data=profile_data, last_order_data=context.last_order_data)
+
+        if not ai_result or not ai_result.get('success'):
+            logger.error(f"AI service failed to generate a response for message {message.id}. Error: {ai_result.get('error') if ai_result else 'No result'}")
+            return "Desculpe, não consegui processar sua mensagem. Tente novamente mais tarde.", None
+
+        response_text = ai_result.get('response', '')
+        ai_metadata = ai_result.get('metadata', {})
+        if ai_metadata.get("action") == "REQUEST_HUMAN_AGENT":
+            logger.info(f"AI signaled for human agent for conversation {message.conversation_id}.")
+            ai_metadata['reason'] = response_text # A própria resposta pode conter a razão
+        return response_text, ai_metadata
+
+    except Exception as e:
+        logger.error(f"Error generating AI response for message {message.id}: {e}", exc_info=True)
+        return "Ops! Aconteceu um erro com a nossa IA. Já estamos verificando.", None
+
+async def extract_order_action_async(user_message: str, conversation_history: List[Dict]) -> Optional[Dict[str, Any]]:
+    """Detecção de pedido do pipeline asyncio (Order Manager via agent.arun), em paralelo com a resposta."""
+    if not user_message:
+        return None
+    try:
+        return await ai_service.extract_order_info_async(user_message, conversation_history)
+    except Exception as e:
+        logger.error(f"Falha ao extrair pedido da interação: {e}", exc_info=True)
+        return None
+
 def create_order_from_interaction(db: Session, conversation: Conversation, user_message: str, conversation_history: List[Dict]):
     """
-    Chama o AI Service para detectar uma confirmação de pedido e o salva no banco de dados.
+    Chama o AI Service para detectar uma confirmação de pedido e o adiciona à sessão (o commit fica com quem chama).
     """
     try:
-        order_action = ai_service.extract_order_info(user_message, conversation_history)
-        
+        stage_order(db, conversation, ai_service.extract_order_info(user_message, conversation_history))
+    except Exception as e:
+        logger.error(f"Falha ao criar pedido a partir da interação para a conversa {conversation.id}: {e}", exc_info=True)
+
+def stage_order(db: Session, conversation: Conversation, order_action: Optional[Dict[str, Any]]):
+    """Adiciona à sessão o pedido confirmado pelo Order Manager, se houver (sem commit)."""
+    try:
         if not order_action or order_action.get('action') != 'CREATE_ORDER':
             return # Nenhuma ação de criação de pedido necessária
 
@@ -781,19 +1185,15 @@ def create_order_from_interaction(db: Session, conversation: Conversation, user_
             status='completed' # Ou o status que fizer sentido no seu fluxo
         )
         db.add(new_order)
-        db.commit()
-        db.refresh(new_order)
-        logger.info(f"Novo pedido (ID: {new_order.id}) criado para a conversa {conversation.id} com base na interação do usuário.")
+        logger.info(f"Novo pedido criado para a conversa {conversation.id} com base na interação do usuário.")
 
     except Exception as e:
-        db.rollback()
         logger.error(f"Falha ao criar pedido a partir da interação para a conversa {conversation.id}: {e}", exc_info=True)
 
-def send_pushover_notification(title: str, message: str, user_key: str, app_token: str = Config.PUSHOVER_APP_TOKEN, **kwargs: Optional[Dict[str, Any]]):
-    """Envia uma notificação via Pushover."""
+def build_pushover_payload(title: str, message: str, user_key: str, app_token: str, **kwargs: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
     if not app_token or not user_key:
         logger.warning("Pushover APP_TOKEN ou USER_KEY não configurados. Notificação não enviada.")
-        return
+        return None
 
     payload = {
         "token": app_token,
@@ -805,10 +1205,31 @@ def send_pushover_notification(title: str, message: str, user_key: str, app_toke
     for key, value in kwargs.items():
         if value is not None: # Garantir que apenas valores não nulos sejam adicionados
             payload[key] = value
+    return payload
+
+def send_pushover_notification(title: str, message: str, user_key: str, app_token: str = Config.PUSHOVER_APP_TOKEN, **kwargs: Optional[Dict[str, Any]]):
+    """Envia uma notificação via Pushover."""
+    payload = build_pushover_payload(title, message, user_key, app_token, **kwargs)
+    if not payload:
+        return
 
     try:
-        response = requests.post("https://api.pushover.net/1/messages.json", data=payload, timeout=10)
+        response = requests.post(PUSHOVER_API_URL, data=payload, timeout=10)
         response.raise_for_status()  # Levanta um erro para respostas 4xx/5xx
         logger.info(f"Pushover notification sent successfully to user_key: {user_key[:5]}...") # Log apenas parte da chave
     except requests.exceptions.RequestException as e:
         logger.error(f"Error sending Pushover notification: {str(e)}")
+
+async def send_pushover_notification_async(title: str, message: str, user_key: str, app_token: str = Config.PUSHOVER_APP_TOKEN, **kwargs: Optional[Dict[str, Any]]):
+    """Versão assíncrona (httpx) de send_pushover_notification."""
+    payload = build_pushover_payload(title, message, user_key, app_token, **kwargs)
+    if not payload:
+        return
+
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.post(PUSHOVER_API_URL, data=payload)
+        response.raise_for_status()
+        logger.info(f"Pushover notification sent successfully to user_key: {user_key[:5]}...")
+    except httpx.HTTPError as e:
+        logger.error(f"Error sending Pushover notification: {str(e)}")
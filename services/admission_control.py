@@ -0,0 +1,72 @@
+import enum
+import logging
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class LoadLevel(enum.IntEnum):
+    """Níveis de carga, do normal ao mais restritivo; cada nível inclui as restrições dos anteriores."""
+    NORMAL = 0
+    DEGRADED = 1  # Só a resposta: sem extração de perfil e de pedido
+    BUSY = 2      # Sem IA: envia a mensagem de "estamos ocupados"
+    REJECT = 3    # O webhook responde 429 e a Evolution API reenvia depois
+
+
+class AdmissionController:
+    """
+    Controle de admissão do webhook. Compara o trabalho pendente (mensagens na fila local ou em
+    processamento) com marcas d'água configuráveis para decidir quanto trabalho cada turno pode fazer
+    e quando recusar novas mensagens, mantendo a latência limitada quando a IA fica lenta.
+    Uma marca d'água igual a 0 desativa o nível correspondente.
+    """
+
+    def __init__(self, pending_work: Callable[[], int],
+                 degraded_high_water: int = Config.LOAD_DEGRADED_HIGH_WATER,
+                 busy_high_water: int = Config.LOAD_BUSY_HIGH_WATER,
+                 reject_high_water: int = Config.LOAD_REJECT_HIGH_WATER):
+        self.pending_work = pending_work
+        self.high_water_marks = {
+            LoadLevel.DEGRADED: max(0, degraded_high_water),
+            LoadLevel.BUSY: max(0, busy_high_water),
+            LoadLevel.REJECT: max(0, reject_high_water),
+        }
+        self._counters: Counter = Counter()
+        self._counters_lock = threading.Lock()
+        self._last_level = LoadLevel.NORMAL
+
+    def level(self, incoming: int = 0) -> LoadLevel:
+        """Nível de carga atual, considerando também `incoming` mensagens prestes a entrar na fila."""
+        pending = self.pending_work() + incoming
+        current = LoadLevel.NORMAL
+        for level, high_water in self.high_water_marks.items():
+            if high_water and pending >= high_water:
+                current = level
+        if current != self._last_level:
+            log = logger.warning if current > self._last_level else logger.info
+            log(f"Nível de carga mudou de {self._last_level.name} para {current.name} ({pending} mensagens pendentes).")
+            self._last_level = current
+        return current
+
+    def admit(self, incoming: int) -> bool:
+        """False se as mensagens devem ser recusadas (429) para não ultrapassar a marca de rejeição."""
+        if self.level(incoming) >= LoadLevel.REJECT:
+            self.record('rejected', incoming)
+            return False
+        return True
+
+    def record(self, event: str, amount: int = 1):
+        with self._counters_lock:
+            self._counters[event] += amount
+
+    def stats(self) -> Dict[str, Any]:
+        with self._counters_lock:
+            stats: Dict[str, Any] = dict(self._counters)
+        stats['pending_work'] = self.pending_work()
+        stats['level'] = self.level().name.lower()
+        stats['high_water_marks'] = {level.name.lower(): mark for level, mark in self.high_water_marks.items()}
+        return stats
@@ -1,5 +1,6 @@
 import os
 import json
+import asyncio
 import logging
 import time
 from typing import Dict, Any, List, Optional
@@ -97,6 +98,20 @@ class AIService:
             - Mensagem: "Pode me enviar a fatura?" -> Saída: `{"action": "NONE"}`
             - Mensagem: "meu endereço é rua das flores 123" -> Saída: `{"action": "SAVE", "data": {"key": "address", "value": "Rua das Flores, 123"}}`
             """,
+            'order_manager': """Você é um analista de pedidos silencioso. Sua única função é verificar, pelo histórico da conversa e pela última mensagem do usuário, se o usuário CONFIRMOU um pedido, e estruturá-lo em JSON.
+
+            REGRAS DE SAÍDA:
+            1.  Sua saída DEVE SER SEMPRE um objeto JSON válido. Não inclua texto explicativo, apenas o JSON.
+            2.  Se a última mensagem confirmar um pedido, retorne:
+                `{"action": "CREATE_ORDER", "data": {"items": [{"name": "nome_do_item", "quantity": 1}], "total": 0.0}}`
+                Inclua "total" apenas se o valor tiver sido informado na conversa. NÃO invente itens nem valores.
+            3.  Se não houver uma confirmação clara de pedido (dúvidas, orçamentos, pedidos ainda em montagem), retorne:
+                `{"action": "NONE"}`
+
+            EXEMPLOS:
+            - Histórico: "Assistente: São 2 pizzas de calabresa, total R$ 90,00. Confirma?" / Mensagem: "Confirmo!" -> Saída: `{"action": "CREATE_ORDER", "data": {"items": [{"name": "Pizza de Calabresa", "quantity": 2}], "total": 90.0}}`
+            - Mensagem: "Quanto custa a pizza de calabresa?" -> Saída: `{"action": "NONE"}`
+            """,
             'multimodal_fusion': "Você é um especialista em fusão multimodal. Combine informações de texto, imagem e áudio para criar análises holísticas e contextualizadas."
         }
 
@@ -139,7 +154,7 @@ class AIService:
         )
         logger.info("AIService inicializado com Master Team e agentes especialistas.")
 
-    def _prepare_text_and_history(self, text: str, conversation_history: Optional[List[Dict[str, Any]]] = None, profile_data: Optional[Dict] = None, location_data: Optional[Dict] = None) -> str:
+    def _prepare_text_and_history(self, text: str, conversation_history: Optional[List[Dict[str, Any]]] = None, profile_data: Optional[Dict] = None, location_data: Optional[Dict] = None, last_order_data: Optional[Dict] = None) -> str:
         history_lines = []
         if conversation_history:
             for msg in conversation_history:
@@ -159,6 +174,9 @@ class AIService:
         if location_data:
             final_prompt_parts.append(f"LOCALIZAÇÃO ATUAL DO USUÁRIO (use isso como contexto de origem): Latitude {location_data['latitude']}, Longitude {location_data['longitude']}")
 
+        if last_order_data:
+            final_prompt_parts.append(f"ÚLTIMO PEDIDO DO USUÁRIO (use isso se ele quiser repetir ou consultar o pedido):\n{json.dumps(last_order_data, ensure_ascii=False)}")
+
         if history_str:
             final_prompt_parts.append(f"Contexto da conversa anterior:\n{history_str}")
         
@@ -184,10 +202,11 @@ class AIService:
             logger.error(f"Falha ao calcular distância/frete entre '{origin}' e '{destination}'.")
             return {"status": "error", "message": "Desculpe, não consegui calcular o frete. Verifique os endereços."}
 
-    def process_text_message(self, text: str, conversation_history: List[Dict] = None, profile_data: Optional[Dict] = None, location_data: Optional[Dict] = None) -> Dict[str, Any]:
-        if not text or not text.strip():
-            return {'success': True, 'response': "Olá! Como posso te ajudar?", 'metadata': {}}
-        
+    @staticmethod
+    def _response_content(run_response) -> str:
+        return run_response.content if hasattr(run_response, 'content') else str(run_response)
+
+    def _text_agent_for(self, text: str) -> Agent:
         conversational_agent = self.specialist_agents['conversational']
         # --- Lógica de Roteamento Simples ---
         # Se a intenção parecer relacionada a frete, usar o especialista.
@@ -195,11 +214,17 @@ class AIService:
         if any(keyword in text.lower() for keyword in ['frete', 'entrega', 'distância', 'endereço', 'localização', 'calcular']):
             conversational_agent = self.specialist_agents['geolocation_specialist']
             logger.info("Roteado para Geolocation Specialist com base em palavras-chave.")
+        return conversational_agent
+
+    def process_text_message(self, text: str, conversation_history: List[Dict] = None, profile_data: Optional[Dict] = None, location_data: Optional[Dict] = None, last_order_data: Optional[Dict] = None) -> Dict[str, Any]:
+        if not text or not text.strip():
+            return {'success': True, 'response': "Olá! Como posso te ajudar?", 'metadata': {}}
         
+        conversational_agent = self._text_agent_for(text)
         start_time = time.time()
-        prompt = self._prepare_text_and_history(text, conversation_history, profile_data, location_data)
+        prompt = self._prepare_text_and_history(text, conversation_history, profile_data, location_data, last_order_data)
         run_response = conversational_agent.run(prompt)
-        response_text = run_response.content if hasattr(run_response, 'content') else str(run_response)
+        response_text = self._response_content(run_response)
         processing_time_ms = int((time.time() - start_time) * 1000)
 
         logger.info(f"Mensagem de texto processada pelo {conversational_agent.name} em {processing_time_ms}ms.")
@@ -209,6 +234,67 @@ class AIService:
             'metadata': {'agent_name': conversational_agent.name, 'processing_time_ms': processing_time_ms}
         }
 
+    async def process_text_message_async(self, text: str, conversation_history: List[Dict] = None, profile_data: Optional[Dict] = None, location_data: Optional[Dict] = None, last_order_data: Optional[Dict] = None) -> Dict[str, Any]:
+        """Versão assíncrona de process_text_message (agent.arun)."""
+        if not text or not text.strip():
+            return {'success': True, 'response': "Olá! Como posso te ajudar?", 'metadata': {}}
+
+        conversational_agent = self._text_agent_for(text)
+        start_time = time.time()
+        prompt = self._prepare_text_and_history(text, conversation_history, profile_data, location_data, last_order_data)
+        run_response = await conversational_agent.arun(prompt)
+        response_text = self._response_content(run_response)
+        processing_time_ms = int((time.time() - start_time) * 1000)
+
+        logger.info(f"Mensagem de texto processada pelo {conversational_agent.name} em {processing_time_ms}ms.")
+        return {
+            'success': True,
+            'response': response_text,
+            'metadata': {'agent_name': conversational_agent.name, 'processing_time_ms': processing_time_ms}
+        }
+
+    async def _process_visual_message_async(self, media_data: bytes, suffix: str, media_param: str, prompt: str, media_label: str) -> Dict[str, Any]:
+        """Equivalente assíncrono de process_image_message/process_video_message (media_param: 'images' ou 'videos')."""
+        start_time = time.time()
+        agent = self.specialist_agents['visual_analyzer']
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(suffix=suffix)
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(media_data)
+
+            media_input = [{"filepath": temp_path}]
+            logger.debug(f"Enviando para Visual Analyzer. Prompt: '{prompt[:100]}...', {media_label}: {media_input}")
+            run_response = await agent.arun(prompt, **{media_param: media_input})
+            response_text = self._response_content(run_response)
+
+            processing_time_ms = int((time.time() - start_time) * 1000)
+            logger.info(f"{media_label} processado pelo Visual Analyzer em {processing_time_ms}ms.")
+            return {
+                'success': True,
+                'response': response_text,
+                'metadata': {'agent_name': 'Visual Analyzer (Shortcut)', 'processing_time_ms': processing_time_ms}
+            }
+        except Exception as e:
+            logger.error(f"Falha ao processar {media_label.lower()} com Visual Analyzer: {str(e)}", exc_info=True)
+            return {
+                'success': False,
+                'error': str(e),
+                'response': f"Desculpe, a IA encontrou um problema ao analisar {'a imagem' if media_param == 'images' else 'o vídeo'}. 😥"
+            }
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+                logger.debug(f"Removed temp {media_label.lower()} file: {temp_path}")
+
+    async def process_image_message_async(self, image_data: bytes, text_prompt: str = "", conversation_history: List[Dict] = None, profile_data: Optional[Dict] = None) -> Dict[str, Any]:
+        prompt = self._prepare_text_and_history(text_prompt or "Analise esta imagem em detalhes.", conversation_history, profile_data)
+        return await self._process_visual_message_async(image_data, ".jpg", "images", prompt, "Imagem")
+
+    async def process_video_message_async(self, video_data: bytes, text_prompt: str = "", conversation_history: List[Dict] = None, profile_data: Optional[Dict] = None) -> Dict[str, Any]:
+        prompt = self._prepare_text_and_history(text_prompt or "Analise este vídeo em detalhes e descreva o que acontece.", conversation_history, profile_data)
+        return await self._process_visual_message_async(video_data, ".mp4", "videos", prompt, "Vídeo")
+
     def process_image_message(self, image_data: bytes, text_prompt: str = "", conversation_history: List[Dict] = None, profile_data: Optional[Dict] = None) -> Dict[str, Any]:
         start_time = time.time()
         agent = self.specialist_agents['visual_analyzer']
@@ -320,18 +406,7 @@ class AIService:
 
             logger.debug(f"Attempting ffmpeg conversion via stdin to {temp_out_path}")
             
-            command = [
-                'ffmpeg',
-                '-v', 'error',           # Logar apenas erros
-                '-f', 'ogg',             # Assumir o formato de contêiner OGG para a entrada
-                '-c:a', 'libopus',       # EXPLICITAMENTE use o codec libopus para a entrada
-                '-i', '-',               # Ler a entrada do stdin (pipe)
-                '-acodec', 'pcm_s16le',  # Codec de áudio de saída (WAV padrão)
-                '-ar', '16000',          # Taxa de amostragem de 16kHz (bom para ASR)
-                '-ac', '1',              # Um canal de áudio (mono)
-                '-y',                    # Sobrescrever arquivo de saída
-                temp_out_path
-            ]
+            command = self._ffmpeg_to_wav_command(temp_out_path)
             
             # Executa o comando, passando os bytes do áudio para o stdin do processo.
             # text=False é crucial, pois o input e o stderr são tratados como bytes.
@@ -360,8 +435,8 @@ class AIService:
             # Etapa 4: Processar o texto transcrito como uma mensagem de conversação.
             if not transcribed_text or not transcribed_text.strip():
                 logger.warning("Transcription resulted in empty text. Sending a default reply.")
-            return {
-                'success': True,
+                return {
+                    'success': True,
                     'response': "Não consegui entender o que foi dito no áudio. Pode tentar de novo?", 
                     'metadata': {'agent_name': 'Audio Processor (Shortcut)', 'processing_time_ms': transcription_time_ms}
                 }
@@ -389,6 +464,82 @@ class AIService:
                 os.remove(temp_out_path)
                 logger.debug(f"Removed temp output audio file: {temp_out_path}")
             
+    @staticmethod
+    def _ffmpeg_to_wav_command(output_path: str) -> List[str]:
+        return [
+            'ffmpeg',
+            '-v', 'error',           # Logar apenas erros
+            '-f', 'ogg',             # Assumir o formato de contêiner OGG para a entrada
+            '-c:a', 'libopus',       # EXPLICITAMENTE use o codec libopus para a entrada
+            '-i', '-',               # Ler a entrada do stdin (pipe)
+            '-acodec', 'pcm_s16le',  # Codec de áudio de saída (WAV padrão)
+            '-ar', '16000',          # Taxa de amostragem de 16kHz (bom para ASR)
+            '-ac', '1',              # Um canal de áudio (mono)
+            '-y',                    # Sobrescrever arquivo de saída
+            output_path
+        ]
+
+    async def process_audio_message_async(self, audio_data: bytes, conversation_history: List[Dict] = None, profile_data: Optional[Dict] = None) -> Dict[str, Any]:
+        """Versão assíncrona de process_audio_message: ffmpeg como subprocesso asyncio e agentes via arun."""
+        start_time = time.time()
+        agent = self.specialist_agents['audio_processor']
+        prompt = "Transcreva o áudio a seguir. Se não for fala, descreva os sons que você ouve."
+
+        temp_out_path = None
+        try:
+            if not audio_data:
+                logger.error("process_audio_message_async received empty audio data. Aborting ffmpeg conversion.")
+                return {
+                    'success': False,
+                    'error': "Empty audio data received, possibly due to a decryption error.",
+                    'response': "Desculpe, não consegui processar o áudio. Parece que houve um problema na descriptografia. 😥"
+                }
+
+            fd_out, temp_out_path = tempfile.mkstemp(suffix=".wav")
+            os.close(fd_out)
+
+            process = await asyncio.create_subprocess_exec(
+                *self._ffmpeg_to_wav_command(temp_out_path),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            _, stderr = await process.communicate(input=audio_data)
+            if process.returncode != 0:
+                stderr_text = stderr.decode('utf-8', errors='replace').strip()
+                logger.error(f"ffmpeg conversion failed with code {process.returncode}. stderr: {stderr_text}")
+                raise Exception(f"ffmpeg failed: {stderr_text}")
+
+            run_response = await agent.arun(prompt, audio=[{"filepath": temp_out_path}])
+            transcribed_text = self._response_content(run_response)
+
+            transcription_time_ms = int((time.time() - start_time) * 1000)
+            logger.info(f"Audio transcribed in {transcription_time_ms}ms. Text: '{transcribed_text}'")
+
+            if not transcribed_text or not transcribed_text.strip():
+                logger.warning("Transcription resulted in empty text. Sending a default reply.")
+                return {
+                    'success': True,
+                    'response': "Não consegui entender o que foi dito no áudio. Pode tentar de novo?",
+                    'metadata': {'agent_name': 'Audio Processor (Shortcut)', 'processing_time_ms': transcription_time_ms}
+                }
+
+            text_processing_result = await self.process_text_message_async(transcribed_text, conversation_history, profile_data)
+            text_processing_result.setdefault('metadata', {})['transcribed_text'] = transcribed_text
+            return text_processing_result
+
+        except Exception as e:
+            logger.error(f"Falha ao processar áudio com Audio Processor: {str(e)}", exc_info=True)
+            return {
+                'success': False,
+                'error': str(e),
+                'response': "Desculpe, a IA encontrou um problema ao processar o áudio. 😥"
+            }
+        finally:
+            if temp_out_path and os.path.exists(temp_out_path):
+                os.remove(temp_out_path)
+                logger.debug(f"Removed temp output audio file: {temp_out_path}")
+
     def extract_profile_info(self, text: str) -> Optional[Dict[str, Any]]:
         """
         Usa o agente Profile Manager para extrair informações de perfil do texto.
@@ -406,37 +557,115 @@ class AIService:
             # O prompt para este agente é a própria mensagem do usuário.
             # O system prompt do agente já contém todas as instruções.
             run_response = agent.run(text)
-            response_content = run_response.content if hasattr(run_response, 'content') else str(run_response)
-            
-            # A resposta esperada é um JSON puro.
-            logger.debug(f"Profile Manager raw response: {response_content}")
-
-            # Limpa a string JSON de possíveis blocos de código markdown.
-            clean_json_str = response_content.strip()
-            if clean_json_str.startswith("```json"):
-                clean_json_str = clean_json_str[7:]
-            if clean_json_str.startswith("```"):
-                clean_json_str = clean_json_str[3:]
-            if clean_json_str.endswith("```"):
-                clean_json_str = clean_json_str[:-3]
-            clean_json_str = clean_json_str.strip()
-
-            profile_action = json.loads(clean_json_str)
-            
-            # Validação básica do schema esperado
-            if 'action' in profile_action and (profile_action['action'] == 'NONE' or ('data' in profile_action and 'key' in profile_action['data'] and 'value' in profile_action['data'])):
-                logger.info(f"Profile Manager extraiu a ação: {profile_action}")
-                return profile_action
-            else:
-                logger.warning(f"Profile Manager retornou JSON em formato inesperado: {clean_json_str}")
-                return None
-                
-        except json.JSONDecodeError:
-            logger.error(f"Falha ao decodificar a resposta JSON do Profile Manager. Resposta original: '{response_content}', Após limpeza: '{clean_json_str}'")
+            return self._parse_profile_action(self._response_content(run_response))
+        except Exception as e:
+            logger.error(f"Erro ao extrair informações de perfil: {e}", exc_info=True)
+            return None
+
+    async def extract_profile_info_async(self, text: str) -> Optional[Dict[str, Any]]:
+        """Versão assíncrona de extract_profile_info (agent.arun)."""
+        if not text or not text.strip():
+            return None
+
+        agent = self.specialist_agents.get('profile_manager')
+        if not agent:
+            logger.error("Agente 'profile_manager' não encontrado.")
             return None
+
+        try:
+            run_response = await agent.arun(text)
+            return self._parse_profile_action(self._response_content(run_response))
         except Exception as e:
             logger.error(f"Erro ao extrair informações de perfil: {e}", exc_info=True)
             return None
+
+    @staticmethod
+    def _load_json_action(response_content: str, agent_label: str) -> Optional[Any]:
+        # A resposta esperada é um JSON puro.
+        logger.debug(f"{agent_label} raw response: {response_content}")
+
+        # Limpa a string JSON de possíveis blocos de código markdown.
+        clean_json_str = response_content.strip()
+        if clean_json_str.startswith("```json"):
+            clean_json_str = clean_json_str[7:]
+        if clean_json_str.startswith("```"):
+            clean_json_str = clean_json_str[3:]
+        if clean_json_str.endswith("```"):
+            clean_json_str = clean_json_str[:-3]
+        clean_json_str = clean_json_str.strip()
+
+        try:
+            return json.loads(clean_json_str)
+        except json.JSONDecodeError:
+            logger.error(f"Falha ao decodificar a resposta JSON do {agent_label}. Resposta original: '{response_content}', Após limpeza: '{clean_json_str}'")
+            return None
+
+    def _parse_profile_action(self, response_content: str) -> Optional[Dict[str, Any]]:
+        profile_action = self._load_json_action(response_content, "Profile Manager")
+        if profile_action is None:
+            return None
+        
+        # Validação básica do schema esperado
+        if isinstance(profile_action, dict) and 'action' in profile_action and (profile_action['action'] == 'NONE' or ('data' in profile_action and 'key' in profile_action['data'] and 'value' in profile_action['data'])):
+            logger.info(f"Profile Manager extraiu a ação: {profile_action}")
+            return profile_action
+        logger.warning(f"Profile Manager retornou JSON em formato inesperado: {response_content}")
+        return None
+
+    def extract_order_info(self, text: str, conversation_history: Optional[List[Dict]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Usa o agente Order Manager para detectar, na mensagem e no histórico, um pedido confirmado.
+        Retorna {'action': 'CREATE_ORDER', 'data': {...}}, {'action': 'NONE'} ou None.
+        """
+        if not text or not text.strip():
+            return None
+
+        agent = self.specialist_agents.get('order_manager')
+        if not agent:
+            logger.error("Agente 'order_manager' não encontrado.")
+            return None
+
+        try:
+            run_response = agent.run(self._order_prompt(text, conversation_history))
+            return self._parse_order_action(self._response_content(run_response))
+        except Exception as e:
+            logger.error(f"Erro ao extrair informações de pedido: {e}", exc_info=True)
+            return None
+
+    async def extract_order_info_async(self, text: str, conversation_history: Optional[List[Dict]] = None) -> Optional[Dict[str, Any]]:
+        """Versão assíncrona de extract_order_info (agent.arun)."""
+        if not text or not text.strip():
+            return None
+
+        agent = self.specialist_agents.get('order_manager')
+        if not agent:
+            logger.error("Agente 'order_manager' não encontrado.")
+            return None
+
+        try:
+            run_response = await agent.arun(self._order_prompt(text, conversation_history))
+            return self._parse_order_action(self._response_content(run_response))
+        except Exception as e:
+            logger.error(f"Erro ao extrair informações de pedido: {e}", exc_info=True)
+            return None
+
+    def _order_prompt(self, text: str, conversation_history: Optional[List[Dict]]) -> str:
+        context = self._build_conversation_context(conversation_history)
+        return f"Histórico da conversa:\n{context}\n\nÚltima mensagem do usuário: {text}" if context else f"Última mensagem do usuário: {text}"
+
+    def _parse_order_action(self, response_content: str) -> Optional[Dict[str, Any]]:
+        order_action = self._load_json_action(response_content, "Order Manager")
+        if order_action is None:
+            return None
+
+        # Validação básica do schema esperado (os itens são validados de novo por quem grava o pedido)
+        if isinstance(order_action, dict) and (order_action.get('action') == 'NONE' or (
+                order_action.get('action') == 'CREATE_ORDER' and isinstance(order_action.get('data'), dict)
+                and isinstance(order_action['data'].get('items'), list) and order_action['data']['items'])):
+            logger.info(f"Order Manager extraiu a ação: {order_action}")
+            return order_action
+        logger.warning(f"Order Manager retornou JSON em formato inesperado: {response_content}")
+        return None
             
     def _process_with_team(self, text_prompt: str, conversation_history: Optional[List[Dict]] = None, audio_data: Optional[bytes] = None, image_data: Optional[List[bytes]] = None) -> Dict[str, Any]:
         start_time = time.time()
@@ -531,7 +760,26 @@ class AIService:
         prompt = self._prepare_text_and_history(text_prompt, conversation_history, profile_data, location_data)
         
         run_response = agent.run(prompt)
-        response_text = run_response.content if hasattr(run_response, 'content') else str(run_response)
+        response_text = self._response_content(run_response)
+        processing_time_ms = int((time.time() - start_time) * 1000)
+
+        logger.info(f"Localização processada pelo Geolocation Specialist em {processing_time_ms}ms.")
+        return {
+            'success': True,
+            'response': response_text,
+            'metadata': {'agent_name': agent.name, 'processing_time_ms': processing_time_ms}
+        }
+
+    async def process_location_message_async(self, latitude: float, longitude: float, conversation_history: List[Dict] = None, profile_data: Optional[Dict] = None) -> Dict[str, Any]:
+        """Versão assíncrona de process_location_message (agent.arun)."""
+        logger.info(f"Processando mensagem de localização: lat={latitude}, lon={longitude}")
+        location_data = {"latitude": latitude, "longitude": longitude}
+        agent = self.specialist_agents['geolocation_specialist']
+
+        start_time = time.time()
+        prompt = self._prepare_text_and_history("O usuário enviou uma localização.", conversation_history, profile_data, location_data)
+        run_response = await agent.arun(prompt)
+        response_text = self._response_content(run_response)
         processing_time_ms = int((time.time() - start_time) * 1000)
 
         logger.info(f"Localização processada pelo Geolocation Specialist em {processing_time_ms}ms.")
@@ -0,0 +1,29 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from config import Config
+from services.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True, frozen=True)
+class CachedConversation:
+    conversation_id: int
+    contact_name: Optional[str]
+    is_active: Optional[bool]
+
+
+class ConversationCache(TTLCache[str, CachedConversation]):
+    """
+    Cache em processo (LRU + TTL) de user_phone -> conversa, para que mensagens de clientes que já
+    conversaram não precisem consultar a tabela 'conversations'. Só recebe entradas já gravadas
+    (depois do commit); o TTL limita a defasagem em relação a outras instâncias.
+    """
+
+    def __init__(self, max_size: int = Config.CONVERSATION_CACHE_SIZE,
+                 ttl_seconds: float = Config.CONVERSATION_CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__(max_size, ttl_seconds, clock)
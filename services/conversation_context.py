@@ -0,0 +1,60 @@
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import null, select
+from sqlalchemy.orm import Session
+
+from models import Message, Order, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Mensagens do histórico enviadas no prompt da resposta; o Order Manager recebe o histórico completo do contexto
+PROMPT_HISTORY_LIMIT = 10
+
+
+@dataclass(slots=True, frozen=True)
+class ConversationContext:
+    """Tudo o que a IA lê do banco para responder a um turno, carregado uma vez e repassado pelo pipeline."""
+    order_history: List[Dict[str, Any]]
+    profile_data: Optional[Dict[str, Any]] = None
+    last_order_data: Optional[Dict[str, Any]] = None
+    previous_message_type: Optional[str] = None
+    previous_message_content: Optional[str] = None
+
+    @property
+    def conversation_history(self) -> List[Dict[str, Any]]:
+        # O histórico maior (Order Manager) contém o menor (resposta da IA)
+        return self.order_history[-PROMPT_HISTORY_LIMIT:]
+
+
+def load_conversation_context(db: Session, conversation_id: int, turn_started_at: Optional[datetime],
+                              order_history: List[Dict[str, Any]], load_profile: bool = True) -> ConversationContext:
+    """
+    Perfil, último pedido concluído e mensagem anterior ao turno em uma única consulta (subconsultas escalares,
+    cada uma servida por um índice). O histórico vem de quem chama (history_buffer), sem ida ao banco num acerto;
+    com load_profile=False o perfil também (profile_cache) e profile_data fica None.
+    """
+    previous_message = select(Message.message_type, Message.content).where(
+        Message.conversation_id == conversation_id,
+        Message.timestamp < turn_started_at,
+    ).order_by(Message.timestamp.desc()).limit(1)
+
+    profile_data = select(UserProfile.profile_data).where(UserProfile.conversation_id == conversation_id).scalar_subquery() \
+        if load_profile else null()
+    row = db.execute(select(
+        profile_data.label('profile_data'),
+        select(Order.order_details).where(Order.conversation_id == conversation_id, Order.status == 'completed')
+        .order_by(Order.created_at.desc()).limit(1).scalar_subquery().label('last_order_data'),
+        previous_message.with_only_columns(Message.message_type).scalar_subquery().label('previous_message_type'),
+        previous_message.with_only_columns(Message.content).scalar_subquery().label('previous_message_content'),
+    )).one()
+
+    return ConversationContext(
+        order_history=order_history,
+        profile_data=row.profile_data,
+        last_order_data=row.last_order_data,
+        previous_message_type=row.previous_message_type,
+        previous_message_content=row.previous_message_content,
+    )
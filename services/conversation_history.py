@@ -0,0 +1,102 @@
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from config import Config
+from services.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def naive_utc(timestamp: Optional[datetime]) -> datetime:
+    # O banco guarda DateTime sem fuso; datas com fuso (default do modelo) são comparadas em UTC
+    if timestamp is None:
+        return datetime.min
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+@dataclass(slots=True, frozen=True)
+class HistoryEntry:
+    """Uma mensagem do histórico, com só o que o prompt da IA usa."""
+    message_id: int
+    timestamp: Optional[datetime]
+    is_from_user: bool
+    content: Optional[str]
+
+    @property
+    def sort_key(self) -> Tuple[datetime, int]:
+        # Mesma ordem da consulta ao banco: timestamp e, no empate, ID
+        return (naive_utc(self.timestamp), self.message_id)
+
+    def as_prompt_item(self) -> Dict[str, Any]:
+        return {
+            'sender_type': 'user' if self.is_from_user else 'assistant',
+            'message_text': self.content or '[conteúdo não textual]',
+        }
+
+
+class ConversationHistoryBuffer(TTLCache[int, Deque[HistoryEntry]]):
+    """
+    Últimas `window` mensagens de cada conversa ativa, em um buffer circular (deque com maxlen) mantido
+    em sincronia com o que é gravado, para montar o histórico da IA em O(window) sem consultar o banco.
+    As conversas ficam em um LRU limitado a `max_conversations`; o TTL limita a defasagem em relação
+    a mensagens gravadas por outras instâncias.
+    """
+
+    def __init__(self, window: int = Config.CONVERSATION_HISTORY_WINDOW,
+                 max_conversations: int = Config.HISTORY_BUFFER_MAX_CONVERSATIONS,
+                 ttl_seconds: float = Config.HISTORY_BUFFER_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__(max_conversations, ttl_seconds, clock)
+        self.window = max(1, window)
+
+    def get(self, conversation_id: int) -> Optional[List[HistoryEntry]]:
+        """Histórico em ordem cronológica, ou None se a conversa não está no buffer (carregar do banco)."""
+        with self._lock:
+            buffer = super().get(conversation_id)
+            return list(buffer) if buffer is not None else None
+
+    def put(self, conversation_id: int, entries: Iterable[HistoryEntry]):
+        """Carrega a janela lida do banco (em ordem cronológica)."""
+        super().put(conversation_id, deque(entries, maxlen=self.window))
+
+    def append_many(self, entries: Iterable[Tuple[int, HistoryEntry]]):
+        """
+        Registra mensagens gravadas (conversation_id, entrada). Conversas fora do buffer são ignoradas:
+        a próxima leitura as carrega do banco já com essas mensagens.
+        """
+        with self._lock:
+            for conversation_id, entry in entries:
+                buffer = self.peek(conversation_id)
+                if buffer is None:
+                    continue
+                if not buffer or entry.sort_key >= buffer[-1].sort_key:
+                    buffer.append(entry)  # Caso comum; o maxlen descarta a mais antiga
+                else:
+                    # Entrega fora de ordem: reordena a janela como a consulta ao banco faria
+                    ordered = sorted([*buffer, entry], key=lambda item_entry: item_entry.sort_key)
+                    buffer.clear()
+                    buffer.extend(ordered[-self.window:])
+                self._counters['appends'] += 1
+
+    def update_content(self, conversation_id: int, message_id: int, content: Optional[str]):
+        """Atualiza o conteúdo de uma mensagem já no buffer (ex: transcrição de áudio)."""
+        with self._lock:
+            buffer = self.peek(conversation_id)
+            if buffer is None:
+                return
+            for index, entry in enumerate(buffer):
+                if entry.message_id == message_id:
+                    buffer[index] = HistoryEntry(entry.message_id, entry.timestamp, entry.is_from_user, content)
+                    return
+
+    def stats(self) -> Dict[str, float]:
+        stats = super().stats()
+        stats['conversations'] = stats.pop('size')
+        stats['window'] = self.window
+        return stats
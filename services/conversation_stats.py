@@ -0,0 +1,128 @@
+import logging
+from collections import defaultdict
+from typing import Iterable, List, Optional, Sequence
+
+from sqlalchemy import case, func, inspect as sa_inspect, or_, select, text, update
+from sqlalchemy.orm import Session
+
+from models import Conversation, Message, MessageArchiveSegment
+from services.conversation_history import naive_utc
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_PREVIEW_LENGTH = 200  # Tamanho de Conversation.last_message_preview
+CONVERSATION_STATS_COLUMNS = ('message_count', 'last_message_at', 'last_message_preview')
+
+
+def message_preview(content: Optional[str]) -> Optional[str]:
+    # Mesma regra do backfill (substr no banco), para os dois caminhos gravarem o mesmo valor
+    return content[:MESSAGE_PREVIEW_LENGTH] if content else None
+
+
+def record_conversation_messages(db: Session, messages: Iterable[Message]):
+    """
+    Atualiza message_count, last_message_at e last_message_preview das conversas com as mensagens
+    recém-inseridas (um UPDATE por conversa, na mesma transação da ingestão). O incremento e a
+    comparação com a última mensagem são feitos no banco, sem ler a linha da conversa.
+    """
+    by_conversation = defaultdict(list)
+    for message in messages:
+        by_conversation[message.conversation_id].append(message)
+
+    for conversation_id, conversation_messages in by_conversation.items():
+        latest = max(conversation_messages, key=lambda message: (naive_utc(message.timestamp), message.id))
+        # Entregas fora de ordem não substituem uma mensagem mais recente já registrada
+        is_latest = or_(Conversation.last_message_at.is_(None), Conversation.last_message_at <= latest.timestamp)
+        db.execute(
+            update(Conversation).where(Conversation.id == conversation_id).values(
+                message_count=Conversation.message_count + len(conversation_messages),
+                last_message_at=case((is_latest, latest.timestamp), else_=Conversation.last_message_at),
+                last_message_preview=case((is_latest, message_preview(latest.content)), else_=Conversation.last_message_preview),
+            ).execution_options(synchronize_session=False)
+        )
+        conversation = db.identity_map.get(sa_inspect(Conversation).identity_key_from_primary_key((conversation_id,)))
+        if conversation is not None:
+            db.expire(conversation, list(CONVERSATION_STATS_COLUMNS))
+
+
+def refresh_message_preview(db: Session, message: Message):
+    """Atualiza a prévia da conversa quando o conteúdo da última mensagem muda (ex: transcrição de áudio)."""
+    db.execute(
+        update(Conversation).where(
+            Conversation.id == message.conversation_id,
+            Conversation.last_message_at == message.timestamp,
+        ).values(last_message_preview=message_preview(message.content)).execution_options(synchronize_session=False)
+    )
+
+
+def upgrade_conversation_stats_schema(engine) -> List[str]:
+    """
+    Adiciona as colunas de estatísticas e o índice de last_message_at a uma tabela 'conversations' criada
+    antes delas (o create_all não altera tabelas existentes). Retorna as colunas adicionadas.
+    """
+    existing = {column['name'] for column in sa_inspect(engine).get_columns(Conversation.__tablename__)}
+    added = [name for name in CONVERSATION_STATS_COLUMNS if name not in existing]
+    with engine.begin() as connection:
+        for name in added:
+            column = Conversation.__table__.c[name]
+            ddl = f"ALTER TABLE {Conversation.__tablename__} ADD COLUMN {name} {column.type.compile(dialect=engine.dialect)}"
+            if column.server_default is not None:
+                ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+            connection.execute(text(ddl))
+        for index in Conversation.__table__.indexes:
+            index.create(connection, checkfirst=True)
+    if added:
+        logger.warning(f"Colunas {added} adicionadas a '{Conversation.__tablename__}'; "
+                       f"rode 'python backfill_conversation_stats.py' para preenchê-las.")
+    return added
+
+
+def recalculated_stats():
+    """
+    Valores de message_count, last_message_at e last_message_preview calculados a partir de 'messages' e do
+    arquivo ('message_archive_segments'), para um UPDATE de 'conversations' (subconsultas correlacionadas).
+    """
+    latest_message = select(Message).where(Message.conversation_id == Conversation.id).order_by(
+        Message.timestamp.desc(), Message.id.desc()
+    ).limit(1)
+    latest_timestamp = latest_message.with_only_columns(Message.timestamp).scalar_subquery()
+    archived = select(MessageArchiveSegment).where(MessageArchiveSegment.conversation_id == Conversation.id)
+    return {
+        'message_count': select(func.count(Message.id)).where(Message.conversation_id == Conversation.id).scalar_subquery()
+                         + archived.with_only_columns(func.coalesce(func.sum(MessageArchiveSegment.message_count), 0)).scalar_subquery(),
+        # Conversa toda arquivada: a última mensagem está no arquivo e a prévia gravada antes continua valendo;
+        # sem mensagens em lugar nenhum (ex: apagadas pela retenção) não sobra prévia
+        'last_message_at': func.coalesce(
+            latest_timestamp, archived.with_only_columns(func.max(MessageArchiveSegment.last_message_at)).scalar_subquery()
+        ),
+        'last_message_preview': case((latest_timestamp.isnot(None), latest_message.with_only_columns(
+            func.substr(Message.content, 1, MESSAGE_PREVIEW_LENGTH)
+        ).scalar_subquery()), (archived.exists(), Conversation.last_message_preview), else_=None),
+        # Estatísticas são derivadas: recalculá-las não é uma alteração da conversa (sem o onupdate de updated_at)
+        'updated_at': Conversation.updated_at,
+    }
+
+
+def recalculate_conversation_stats(db: Session, conversation_ids: Sequence[int]):
+    """Recalcula as estatísticas das conversas (ex: depois de apagar mensagens), sem commit."""
+    if conversation_ids:
+        db.execute(update(Conversation).where(Conversation.id.in_(conversation_ids)).values(**recalculated_stats())
+                   .execution_options(synchronize_session=False))
+
+
+def backfill_conversation_stats(db: Session, batch_size: int = 500) -> int:
+    """
+    Recalcula as estatísticas de todas as conversas em lotes de `batch_size` conversas (um UPDATE e um
+    commit por lote). Retorna o número de conversas atualizadas.
+    """
+    updated, last_id = 0, 0
+    while True:
+        ids = db.scalars(select(Conversation.id).where(Conversation.id > last_id)
+                         .order_by(Conversation.id).limit(batch_size)).all()
+        if not ids:
+            return updated
+        recalculate_conversation_stats(db, ids)
+        db.commit()
+        updated += len(ids)
+        last_id = ids[-1]
+        logger.info(f"Estatísticas recalculadas para {updated} conversas (até o ID {last_id})")
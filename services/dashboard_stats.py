@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import Config
+from models import AIResponse, Conversation, MediaFile, Message
+
+logger = logging.getLogger(__name__)
+
+
+async def compute_dashboard_stats(db: AsyncSession) -> Dict[str, Any]:
+    """
+    Estatísticas do dashboard com uma consulta agregada por tabela (COUNT ... FILTER), em vez de um
+    COUNT por número exibido. Os totais de 'messages' saem da mesma consulta agrupada por tipo.
+    """
+    total_conversations, active_conversations = (await db.execute(select(
+        func.count(),
+        func.count().filter(Conversation.is_active == True),
+    ).select_from(Conversation))).one()
+
+    message_types = (await db.execute(select(
+        Message.message_type,
+        func.count(),
+        func.count().filter(Message.processed == True),
+        func.count().filter(Message.processing_error.isnot(None)),
+    ).group_by(Message.message_type))).all()
+    total_messages = sum(count for _, count, _, _ in message_types)
+    processed_messages = sum(processed for _, _, processed, _ in message_types)
+    failed_messages = sum(failed for _, _, _, failed in message_types)
+
+    total_media_files = await db.scalar(select(func.count()).select_from(MediaFile))
+
+    ai_responses_count, successful_responses = (await db.execute(select(
+        func.count(),
+        func.count().filter(AIResponse.sent_to_whatsapp == True),
+    ).select_from(AIResponse))).one()
+
+    return {
+        'totals': {
+            'conversations': total_conversations,
+            'messages': total_messages,
+            'media_files': total_media_files,
+            'active_conversations': active_conversations,
+            'ai_responses': ai_responses_count,
+            'successful_responses': successful_responses,
+            'processed_messages': processed_messages,
+            'failed_messages': failed_messages
+        },
+        'message_types': {
+            msg_type: count for msg_type, count, _, _ in message_types
+        },
+        'success_rates': {
+            'processing': (processed_messages / total_messages * 100) if total_messages > 0 else 0,
+            'ai_responses': (successful_responses / ai_responses_count * 100) if ai_responses_count > 0 else 0
+        },
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+    }
+
+
+class DashboardStatsCache:
+    """
+    Guarda o resultado de compute_dashboard_stats por `ttl_seconds`, compartilhado por todas as requisições
+    do worker: o polling de várias abas custa no máximo uma recomputação por TTL. Requisições que chegam
+    durante a recomputação esperam por ela em vez de disparar outra.
+    """
+
+    def __init__(self, ttl_seconds: float = Config.DASHBOARD_STATS_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._value: Optional[Dict[str, Any]] = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> Optional[Dict[str, Any]]:
+        if self._value is not None and self._expires_at > self._clock():
+            return self._value
+        return None
+
+    async def get(self, db: AsyncSession) -> Dict[str, Any]:
+        value = self._fresh()
+        if value is not None:
+            return value
+        async with self._lock:
+            value = self._fresh()  # Outra requisição recalculou enquanto esta esperava
+            if value is not None:
+                return value
+            started = time.perf_counter()
+            value = await compute_dashboard_stats(db)
+            self._value, self._expires_at = value, self._clock() + self.ttl_seconds
+            logger.debug(f"Estatísticas do dashboard recalculadas em {(time.perf_counter() - started) * 1000:.1f}ms")
+            return value
@@ -0,0 +1,231 @@
+import logging
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+from config import Config
+from models import AIResponse, HumanAgentRequest, MediaFile, Message, MessageArchiveSegment
+from services.conversation_history import naive_utc
+from services.conversation_stats import recalculate_conversation_stats
+from services.message_archive import DELETE_CHUNK_SIZE, decode_segment
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class RetentionPolicy:
+    """
+    Dias de retenção de cada tabela; 0 mantém para sempre. Apagar uma mensagem apaga também suas respostas e mídias.
+    Respostas da IA e mídias arquivadas seguem a retenção de mensagens: saem com o mês do arquivo.
+    """
+    messages_days: int = Config.RETENTION_MESSAGES_DAYS
+    ai_responses_days: int = Config.RETENTION_AI_RESPONSES_DAYS
+    media_files_days: int = Config.RETENTION_MEDIA_FILES_DAYS
+
+
+@dataclass(slots=True)
+class RetentionRun:
+    media_files: int = 0
+    ai_responses: int = 0
+    messages: int = 0
+    blobs_deleted: int = 0
+    blob_failures: int = 0  # Mídias mantidas porque o objeto não pôde ser apagado; tentadas de novo na próxima execução
+    archive_partitions: int = 0
+    archive_segments: int = 0
+    batches: int = 0
+    complete: bool = False
+
+    def as_dict(self) -> Dict[str, object]:
+        return asdict(self)
+
+
+class BucketBlobDeleter:
+    """Apaga os objetos das mídias no Cloud Storage (bucket de cada MediaFile). Objeto ausente conta como apagado."""
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import storage  # Só a retenção de mídias precisa do cliente
+            self._client = storage.Client(project=Config.GOOGLE_CLOUD_PROJECT_ID)
+        return self._client
+
+    def delete(self, bucket_name: str, paths: Sequence[str]) -> Set[str]:
+        """Apaga `paths` do bucket e retorna os que não puderam ser apagados."""
+        bucket = self.client.bucket(bucket_name)
+        try:
+            bucket.delete_blobs([bucket.blob(path) for path in paths], on_error=lambda blob: None)
+        except Exception as e:
+            logger.warning(f"Falha ao apagar {len(paths)} objetos do bucket {bucket_name}: {e}")
+            return set(paths)
+        return set()
+
+
+class _BatchLimitReached(Exception):
+    pass
+
+
+class DataRetention:
+    """
+    Apaga o que passou da política de retenção em lotes de até `batch_size` linhas, cada lote na sua
+    transação e seguido de uma pausa, para não segurar locks longos nem disputar o banco com o webhook.
+    Objetos das mídias são apagados antes das linhas (uma falha mantém a linha para a próxima execução,
+    sem deixar objeto órfão); as estatísticas das conversas afetadas são recalculadas no mesmo commit.
+    Mensagens arquivadas saem por mês inteiro, quando o mês todo passou da retenção de mensagens, com os
+    objetos das mídias gravadas nos segmentos; o arquivo do mês só é removido depois do último objeto.
+    """
+
+    def __init__(self, db: Session, policy: Optional[RetentionPolicy] = None, blob_deleter=None, archive=None,
+                 batch_size: int = Config.RETENTION_BATCH_SIZE, pause_seconds: float = Config.RETENTION_BATCH_PAUSE_SECONDS,
+                 max_batches: Optional[int] = None, progress: Optional[Callable[[RetentionRun], None]] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.db = db
+        self.policy = policy or RetentionPolicy()
+        self.blob_deleter = blob_deleter or BucketBlobDeleter()
+        self.archive = archive
+        self.batch_size = max(1, batch_size)
+        self.pause_seconds = pause_seconds
+        self.max_batches = max_batches
+        self.progress = progress
+        self.sleep = sleep
+        self.run = RetentionRun()
+
+    def purge(self, now: Optional[datetime] = None) -> RetentionRun:
+        """Aplica a política; com `max_batches`, para no limite e devolve complete=False (chame de novo para continuar)."""
+        now = naive_utc(now or datetime.now(timezone.utc))
+        try:
+            if self.policy.media_files_days > 0:
+                self._purge_media_files(now - timedelta(days=self.policy.media_files_days))
+            if self.policy.ai_responses_days > 0:
+                self._purge_ai_responses(now - timedelta(days=self.policy.ai_responses_days))
+            if self.policy.messages_days > 0:
+                cutoff = now - timedelta(days=self.policy.messages_days)
+                self._purge_messages(cutoff)
+                if self.archive is not None:
+                    self._purge_archive(cutoff)
+            self.run.complete = True
+        except _BatchLimitReached:
+            logger.info(f"Retenção interrompida no limite de {self.max_batches} lotes; a próxima execução continua.")
+        return self.run
+
+    def _batches(self, query) -> Iterator[List[Tuple]]:
+        """Lotes de linhas (id primeiro) em ordem de ID; linhas mantidas de propósito (ex: falha no bucket) ficam para trás."""
+        last_id = 0
+        while True:
+            rows = self.db.execute(query.where(query.selected_columns[0] > last_id)
+                                   .order_by(query.selected_columns[0]).limit(self.batch_size)).all()
+            if not rows:
+                return
+            if self.max_batches is not None and self.run.batches >= self.max_batches:
+                raise _BatchLimitReached()
+            yield rows
+            last_id = rows[-1][0]
+
+    def _finish_batch(self, description: str):
+        self.db.commit()
+        self.db.expunge_all()
+        self.run.batches += 1
+        logger.info(f"Retenção: {description} (lote {self.run.batches})")
+        if self.progress:
+            self.progress(self.run)
+        if self.pause_seconds > 0:
+            self.sleep(self.pause_seconds)
+
+    def _delete_ids(self, model, column, ids: Sequence[int]):
+        for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+            self.db.execute(delete(model).where(column.in_(ids[start:start + DELETE_CHUNK_SIZE]))
+                            .execution_options(synchronize_session=False))
+
+    def _delete_blobs(self, media: Sequence[Tuple[int, str, str]]) -> Set[int]:
+        """Apaga os objetos de (id, bucket, path) e retorna os IDs de MediaFile cujo objeto continua no bucket."""
+        by_bucket = defaultdict(list)
+        for media_id, bucket_name, path in media:
+            if bucket_name and path:  # Upload que falhou: não há objeto a apagar
+                by_bucket[bucket_name].append((media_id, path))
+        failed = set()
+        for bucket_name, items in by_bucket.items():
+            failed_paths = self.blob_deleter.delete(bucket_name, [path for _, path in items])
+            failed.update(media_id for media_id, path in items if path in failed_paths)
+        self.run.blobs_deleted += len(media) - len(failed)
+        self.run.blob_failures += len(failed)
+        return failed
+
+    def _purge_media_files(self, cutoff: datetime):
+        query = select(MediaFile.id, MediaFile.cloud_storage_bucket, MediaFile.cloud_storage_path).where(MediaFile.uploaded_at < cutoff)
+        for rows in self._batches(query):
+            failed = self._delete_blobs(rows)
+            ids = [media_id for media_id, _, _ in rows if media_id not in failed]
+            self._delete_ids(MediaFile, MediaFile.id, ids)
+            self.run.media_files += len(ids)
+            self._finish_batch(f"{self.run.media_files} mídias apagadas")
+
+    def _purge_ai_responses(self, cutoff: datetime):
+        for rows in self._batches(select(AIResponse.id).where(AIResponse.created_at < cutoff)):
+            self._delete_ids(AIResponse, AIResponse.id, [response_id for response_id, in rows])
+            self.run.ai_responses += len(rows)
+            self._finish_batch(f"{self.run.ai_responses} respostas da IA apagadas")
+
+    def _purge_messages(self, cutoff: datetime):
+        for rows in self._batches(select(Message.id, Message.conversation_id).where(Message.timestamp < cutoff)):
+            media = self.db.execute(select(MediaFile.id, MediaFile.cloud_storage_bucket, MediaFile.cloud_storage_path, MediaFile.message_id)
+                                    .where(MediaFile.message_id.in_([message_id for message_id, _ in rows]))).all()
+            failed = self._delete_blobs([(media_id, bucket_name, path) for media_id, bucket_name, path, _ in media])
+            kept = {message_id for media_id, _, _, message_id in media if media_id in failed}
+            rows = [(message_id, conversation_id) for message_id, conversation_id in rows if message_id not in kept]
+            ids = [message_id for message_id, _ in rows]
+            for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+                chunk = ids[start:start + DELETE_CHUNK_SIZE]
+                # O pedido de atendimento guarda o histórico em full_conversation_history_json; só a referência sai
+                self.db.execute(update(HumanAgentRequest).where(HumanAgentRequest.last_message_id_before_escalation.in_(chunk))
+                                .values(last_message_id_before_escalation=None).execution_options(synchronize_session=False))
+            self._delete_ids(AIResponse, AIResponse.message_id, ids)
+            self._delete_ids(MediaFile, MediaFile.message_id, ids)
+            self._delete_ids(Message, Message.id, ids)
+            recalculate_conversation_stats(self.db, sorted({conversation_id for _, conversation_id in rows}))
+            self.run.messages += len(ids)
+            self._finish_batch(f"{self.run.messages} mensagens apagadas")
+
+    def _delete_archived_blobs(self, segments: Sequence[Tuple]) -> Set[int]:
+        """Apaga os objetos das mídias gravadas nos segmentos e retorna os IDs dos segmentos com objeto que continua no bucket."""
+        media, segment_of = [], {}
+        for segment_id, _, location, byte_offset, byte_length in segments:
+            for message in decode_segment(self.archive.read(location, byte_offset, byte_length)):
+                for media_file in message.media_files:
+                    media.append((media_file.id, media_file.cloud_storage_bucket, media_file.cloud_storage_path))
+                    segment_of[media_file.id] = segment_id
+        return {segment_of[media_id] for media_id in self._delete_blobs(media)}
+
+    def _purge_archive(self, cutoff: datetime):
+        # Meses inteiramente anteriores ao corte; o mês do corte sai na primeira execução do mês seguinte
+        month = cutoff.strftime('%Y-%m')
+        partitions = set(self.db.scalars(select(MessageArchiveSegment.partition).distinct()
+                                         .where(MessageArchiveSegment.partition < month)).all())
+        # Mês sem segmentos no banco mas ainda gravado: execução interrompida antes de remover o arquivo
+        partitions.update(partition for partition in self.archive.partitions() if partition < month)
+        for partition in sorted(partitions):
+            query = select(MessageArchiveSegment.id, MessageArchiveSegment.conversation_id, MessageArchiveSegment.location,
+                           MessageArchiveSegment.byte_offset, MessageArchiveSegment.byte_length
+                           ).where(MessageArchiveSegment.partition == partition)
+            kept = 0
+            for rows in self._batches(query):
+                # Objetos antes das linhas: um segmento com objeto que ficou no bucket é mantido para a próxima execução
+                failed = self._delete_archived_blobs(rows)
+                rows = [row for row in rows if row[0] not in failed]
+                self._delete_ids(MessageArchiveSegment, MessageArchiveSegment.id, [row[0] for row in rows])
+                recalculate_conversation_stats(self.db, sorted({row[1] for row in rows}))
+                self.run.archive_segments += len(rows)
+                kept += len(failed)
+                self._finish_batch(f"{self.run.archive_segments} segmentos do arquivo apagados (mês {partition})")
+            if kept:
+                logger.warning(f"Mês {partition} do arquivo mantido: {kept} segmentos com mídias que não puderam ser apagadas do bucket")
+                continue
+            # Arquivo depois das linhas: sem segmentos apontando para ele, e encontrado de novo pelo storage se a remoção falhar
+            self.archive.delete_partition(partition)
+            self.run.archive_partitions += 1
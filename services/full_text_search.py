@@ -0,0 +1,185 @@
+import html
+import logging
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from sqlalchemy import bindparam, func, literal_column, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import (CONTACT_SEARCH_DOCUMENT, CONTACT_SEARCH_INDEX, MESSAGE_SEARCH_DOCUMENT, MESSAGE_SEARCH_INDEX,
+                    Conversation, Message)
+
+logger = logging.getLogger(__name__)
+
+MAX_SEARCH_TERMS = 8
+# Mensagens candidatas lidas por resultado: várias mensagens da mesma conversa costumam casar
+MESSAGE_CANDIDATES_PER_RESULT = 5
+# Delimitadores do destaque devolvidos pelo banco; trocados por <mark> depois de escapar o texto
+HIGHLIGHT_START, HIGHLIGHT_STOP = '\x02', '\x03'
+
+# SQLite: tabelas FTS5 de conteúdo externo, mantidas por triggers a cada INSERT/UPDATE/DELETE
+SQLITE_FTS_TABLES = {
+    'messages_fts': ('messages', ('content',)),
+    'conversations_fts': ('conversations', ('contact_name', 'user_phone')),
+}
+
+
+class FullTextSearchUnavailable(RuntimeError):
+    """O banco não tem busca textual configurada (ex: SQLite compilado sem FTS5)."""
+
+
+@dataclass(slots=True, frozen=True)
+class SearchHit:
+    conversation_id: int
+    rank: float                         # Maior = mais relevante, comparável só dentro da mesma busca
+    matched_contact: bool               # Nome ou telefone do contato casou com a busca
+    message_id: Optional[int] = None    # Mensagem mais relevante da conversa, se alguma casou
+    snippet_html: Optional[str] = None  # Trecho da mensagem, escapado, com os termos em <mark>
+
+
+def search_terms(query: str) -> List[str]:
+    # Só palavras: nenhum operador da sintaxe de busca do banco passa adiante
+    return re.findall(r'\w+', query.lower())[:MAX_SEARCH_TERMS]
+
+
+def highlight_html(snippet: Optional[str]) -> Optional[str]:
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+
+
+def _sqlite_triggers(fts_table: str, table: str, columns: tuple) -> List[str]:
+    names = ', '.join(columns)
+    new_values = ', '.join(f"new.{column}" for column in columns)
+    old_values = ', '.join(f"old.{column}" for column in columns)
+    insert = f"INSERT INTO {fts_table}(rowid, {names}) VALUES (new.id, {new_values});"
+    delete = f"INSERT INTO {fts_table}({fts_table}, rowid, {names}) VALUES ('delete', old.id, {old_values});"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {table} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {table} BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF {names} ON {table} BEGIN {delete} {insert} END",
+    ]
+
+
+def setup_full_text_search(engine):
+    """
+    Cria a estrutura da busca textual em bancos já existentes: no Postgres os índices GIN definidos em
+    models.py; no SQLite as tabelas FTS5 e seus triggers, reconstruindo o índice quando a tabela FTS é
+    nova ou a tabela de origem foi recriada (triggers ausentes).
+    """
+    dialect = engine.dialect.name
+    if dialect == 'postgresql':
+        with engine.begin() as connection:
+            for index in (MESSAGE_SEARCH_INDEX, CONTACT_SEARCH_INDEX):
+                index.create(connection, checkfirst=True)
+        return
+    if dialect != 'sqlite':
+        logger.warning(f"Busca textual não suportada no dialeto '{dialect}'")
+        return
+
+    with engine.begin() as connection:
+        existing = set(connection.execute(text("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")).scalars())
+        for fts_table, (table, columns) in SQLITE_FTS_TABLES.items():
+            rebuild = fts_table not in existing or f"{fts_table}_insert" not in existing
+            try:
+                connection.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5({', '.join(columns)}, "
+                    f"content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+                ))
+            except Exception as e:
+                logger.warning(f"FTS5 indisponível neste SQLite; busca textual desativada: {e}")
+                return
+            for statement in _sqlite_triggers(fts_table, table, columns):
+                connection.execute(text(statement))
+            if rebuild:
+                connection.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"))
+                logger.info(f"Índice {fts_table} reconstruído a partir de '{table}'")
+
+
+async def search_conversations(db: AsyncSession, query: str, limit: int = 20) -> List[SearchHit]:
+    """
+    Conversas que casam com `query` no conteúdo das mensagens ou no nome/telefone do contato, em ordem de
+    relevância (contato primeiro), com o trecho da mensagem mais relevante de cada uma. Cada termo vale
+    como prefixo ("pizz" casa com "pizza") e todos precisam aparecer.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    limit = max(1, limit)
+    dialect = db.get_bind().dialect.name
+    if dialect == 'postgresql':
+        contact_ranks, message_hits = await _search_postgresql(db, terms, limit)
+    elif dialect == 'sqlite':
+        contact_ranks, message_hits = await _search_sqlite(db, terms, limit)
+    else:
+        raise FullTextSearchUnavailable(f"Busca textual não suportada no dialeto '{dialect}'")
+
+    hits: Dict[int, SearchHit] = {}
+    for conversation_id, message_id, rank, snippet in message_hits:
+        if conversation_id not in hits:  # Já em ordem de relevância: a primeira é a melhor mensagem da conversa
+            hits[conversation_id] = SearchHit(conversation_id, rank, conversation_id in contact_ranks, message_id, snippet)
+    for conversation_id, rank in contact_ranks.items():
+        if conversation_id not in hits:
+            hits[conversation_id] = SearchHit(conversation_id, rank, True)
+    return sorted(hits.values(), key=lambda hit: (hit.matched_contact, hit.rank), reverse=True)[:limit]
+
+
+async def _search_postgresql(db: AsyncSession, terms: List[str], limit: int):
+    message_query = func.to_tsquery(literal_column("'portuguese'"), ' & '.join(f"{term}:*" for term in terms))
+    contact_query = func.to_tsquery(literal_column("'simple'"), ' & '.join(f"{term}:*" for term in terms))
+
+    contact_rank = func.ts_rank_cd(CONTACT_SEARCH_DOCUMENT, contact_query)
+    contact_ranks = dict((await db.execute(
+        select(Conversation.id, contact_rank).where(CONTACT_SEARCH_DOCUMENT.op('@@')(contact_query))
+        .order_by(contact_rank.desc()).limit(limit)
+    )).all())
+
+    message_rank = func.ts_rank_cd(MESSAGE_SEARCH_DOCUMENT, message_query)
+    candidates = (await db.execute(
+        select(Message.conversation_id, Message.id, message_rank).where(MESSAGE_SEARCH_DOCUMENT.op('@@')(message_query))
+        .order_by(message_rank.desc(), Message.id.desc()).limit(limit * MESSAGE_CANDIDATES_PER_RESULT)
+    )).all()
+    best = {}
+    for conversation_id, message_id, rank in candidates:
+        best.setdefault(conversation_id, (message_id, rank))
+
+    # ts_headline relê o texto: só para a melhor mensagem de cada conversa
+    snippets = {}
+    if best:
+        snippets = dict((await db.execute(select(Message.id, func.ts_headline(
+            literal_column("'portuguese'"), Message.content, message_query,
+            bindparam('headline_options', f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxWords=24, MinWords=8"),
+        )).where(Message.id.in_([message_id for message_id, _ in best.values()])))).all())
+    message_hits = [
+        (conversation_id, message_id, float(rank), highlight_html(snippets.get(message_id)))
+        for conversation_id, (message_id, rank) in best.items()
+    ]
+    return {conversation_id: float(rank) for conversation_id, rank in contact_ranks.items()}, message_hits
+
+
+async def _search_sqlite(db: AsyncSession, terms: List[str], limit: int):
+    match = ' '.join(f'"{term}"*' for term in terms)  # Termos separados por espaço: todos precisam casar
+
+    # bm25: menor = mais relevante; negado para seguir a convenção "maior = melhor" de SearchHit.rank
+    try:
+        contact_ranks = dict((await db.execute(text(
+            "SELECT rowid, -bm25(conversations_fts) FROM conversations_fts "
+            "WHERE conversations_fts MATCH :match ORDER BY bm25(conversations_fts) LIMIT :limit"
+        ), {'match': match, 'limit': limit})).all())
+    except OperationalError as e:  # Tabelas FTS5 ausentes: setup_full_text_search não rodou ou o SQLite não tem FTS5
+        raise FullTextSearchUnavailable(str(e.orig)) from e
+
+    candidates = (await db.execute(text(
+        "SELECT m.conversation_id, m.id, -bm25(messages_fts), "
+        "snippet(messages_fts, 0, :start, :stop, '…', 16) "
+        "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+        "WHERE messages_fts MATCH :match ORDER BY bm25(messages_fts), m.id DESC LIMIT :limit"
+    ), {'match': match, 'start': HIGHLIGHT_START, 'stop': HIGHLIGHT_STOP,
+        'limit': limit * MESSAGE_CANDIDATES_PER_RESULT})).all()
+    message_hits = [
+        (conversation_id, message_id, rank, highlight_html(snippet))
+        for conversation_id, message_id, rank, snippet in candidates
+    ]
+    return contact_ranks, message_hits
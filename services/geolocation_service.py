@@ -1,10 +1,14 @@
 import googlemaps
+import httpx
 from config import Config
 import logging
 from typing import Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Endpoint REST da Directions API, usado pela versão assíncrona (o cliente googlemaps é síncrono)
+DIRECTIONS_API_URL = "https://maps.googleapis.com/maps/api/directions/json"
+
 class GeolocationService:
     def __init__(self):
         if not Config.GOOGLE_MAPS_API_KEY:
@@ -12,6 +16,13 @@ class GeolocationService:
             self.gmaps = None
         else:
             self.gmaps = googlemaps.Client(key=Config.GOOGLE_MAPS_API_KEY)
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    async def aclose(self):
+        """Fecha o cliente HTTP assíncrono (no mesmo event loop em que ele foi usado)."""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
 
     def get_distance_and_duration(self, origin: str, destination: str) -> Optional[Tuple[float, str, int, str]]:
         """
@@ -29,28 +40,60 @@ class GeolocationService:
                 mode="driving", # Pode ser "walking", "bicycling", "transit"
                 language="pt-BR"
             )
+            return self._parse_directions(origin, destination, directions_result)
+        except googlemaps.exceptions.ApiError as e:
+            logger.error(f"Erro na API do Google Maps ao calcular distância: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Erro inesperado ao calcular distância: {e}", exc_info=True)
+            return None
 
-            if directions_result and len(directions_result) > 0:
-                leg = directions_result[0]['legs'][0]
-                distance_meters = leg['distance']['value']
-                distance_km = distance_meters / 1000.0
-                distance_text = leg['distance']['text']
-                
-                duration_seconds = leg['duration']['value']
-                duration_text = leg['duration']['text']
-                
-                logger.info(f"Distância de '{origin}' para '{destination}': {distance_text} ({distance_km:.2f} km), Duração: {duration_text} ({duration_seconds} s)")
-                return distance_km, distance_text, duration_seconds, duration_text
-            else:
-                logger.warning(f"Não foi possível calcular a distância entre '{origin}' e '{destination}'. Resposta da API: {directions_result}")
+    async def get_distance_and_duration_async(self, origin: str, destination: str) -> Optional[Tuple[float, str, int, str]]:
+        """Versão assíncrona de get_distance_and_duration, chamando a Directions API via httpx."""
+        if not Config.GOOGLE_MAPS_API_KEY:
+            logger.error("Google Maps client não inicializado. Verifique a API Key.")
+            return None
+
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(timeout=Config.HTTP_CLIENT_TIMEOUT_SECONDS)
+        params = {
+            'origin': origin,
+            'destination': destination,
+            'mode': 'driving',
+            'language': 'pt-BR',
+            'key': Config.GOOGLE_MAPS_API_KEY,
+        }
+        try:
+            response = await self._async_client.get(DIRECTIONS_API_URL, params=params)
+            response.raise_for_status()
+            data = response.json()
+            if data.get('status') not in ('OK', 'ZERO_RESULTS'):
+                logger.error(f"Erro na API do Google Maps ao calcular distância: {data.get('status')} {data.get('error_message', '')}")
                 return None
-        except googlemaps.exceptions.ApiError as e:
+            return self._parse_directions(origin, destination, data.get('routes', []))
+        except httpx.HTTPError as e:
             logger.error(f"Erro na API do Google Maps ao calcular distância: {e}")
             return None
         except Exception as e:
             logger.error(f"Erro inesperado ao calcular distância: {e}", exc_info=True)
             return None
 
+    def _parse_directions(self, origin: str, destination: str, directions_result) -> Optional[Tuple[float, str, int, str]]:
+        """Extrai (distancia_km, distancia_texto, duracao_segundos, duracao_texto) da primeira rota."""
+        if directions_result and len(directions_result) > 0:
+            leg = directions_result[0]['legs'][0]
+            distance_meters = leg['distance']['value']
+            distance_km = distance_meters / 1000.0
+            distance_text = leg['distance']['text']
+            
+            duration_seconds = leg['duration']['value']
+            duration_text = leg['duration']['text']
+            
+            logger.info(f"Distância de '{origin}' para '{destination}': {distance_text} ({distance_km:.2f} km), Duração: {duration_text} ({duration_seconds} s)")
+            return distance_km, distance_text, duration_seconds, duration_text
+        logger.warning(f"Não foi possível calcular a distância entre '{origin}' e '{destination}'. Resposta da API: {directions_result}")
+        return None
+
     def calculate_shipping_fee(self, distance_km: float, base_fee: float = 5.0, fee_per_km: float = 1.5) -> float:
         """
         Calcula a taxa de frete com base na distância.
@@ -0,0 +1,194 @@
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# messageType da Evolution API -> tipo normalizado usado no banco e no restante do pipeline
+EVOLUTION_MESSAGE_TYPES = {
+    'conversation': 'text',
+    'imageMessage': 'image',
+    'audioMessage': 'audio',
+    'videoMessage': 'video',
+    'documentMessage': 'document',
+    'locationMessage': 'location',
+}
+MEDIA_MESSAGE_TYPES = frozenset({'image', 'audio', 'video', 'document'})
+
+
+class InvalidPayloadError(ValueError):
+    """Payload sem os campos mínimos (ID da mensagem e remetente) para ser processado."""
+
+
+@dataclass(slots=True, frozen=True)
+class InboundMedia:
+    """O que é preciso para baixar e armazenar a mídia, nos dois formatos de payload."""
+    filename: str
+    mime_type: Optional[str] = None
+    download_url: Optional[str] = None   # Formato novo: URL do arquivo criptografado
+    media_key: Optional[str] = None      # Formato novo: chave para descriptografar (base64)
+    media_id: Optional[str] = None       # Formato antigo: ID da mídia na API da Meta
+    original_url: str = ''
+
+
+@dataclass(slots=True, frozen=True)
+class InboundMessage:
+    """
+    Mensagem recebida pelo webhook, normalizada uma única vez a partir do payload da Evolution API
+    (messages.upsert) ou do formato antigo (entry/changes). O restante do pipeline usa apenas estes campos.
+    """
+    message_id: str
+    sender_phone: str
+    message_type: str               # text, image, audio, video, document, location ou o tipo original
+    message_type_raw: str           # Tipo como veio no payload (ex: "imageMessage"), usado no HKDF da mídia
+    is_new_format: bool
+    timestamp: Optional[datetime] = None
+    contact_name: Optional[str] = None
+    content: Optional[str] = None
+    media: Optional[InboundMedia] = None
+    processing_error: Optional[str] = None
+    instance: Optional[str] = None
+
+    @property
+    def is_text(self) -> bool:
+        return self.message_type == 'text'
+
+
+def parse_inbound_message(message_data: Dict[str, Any], webhook_context_data: Optional[Dict[str, Any]] = None) -> InboundMessage:
+    """Converte o payload de uma mensagem em InboundMessage. Levanta InvalidPayloadError se faltar ID ou remetente."""
+    webhook_context_data = webhook_context_data or {}
+    if 'key' in message_data:  # Evolution API (messages.upsert); o formato antigo usa 'id'/'from'
+        return _parse_evolution_message(message_data, webhook_context_data)
+    return _parse_legacy_message(message_data, webhook_context_data)
+
+
+def _parse_timestamp(timestamp_val: Any) -> Optional[datetime]:
+    # Epoch em segundos (int ou string de dígitos) nos dois formatos
+    if timestamp_val is None or not str(timestamp_val).isdigit():
+        return None
+    try:
+        return datetime.fromtimestamp(int(str(timestamp_val)))
+    except (ValueError, OverflowError, OSError) as e:
+        logger.warning(f"Could not parse timestamp {timestamp_val}: {e}")
+        return None
+
+
+def _media_filename(filename: Optional[str], message_type: str, message_id: str, mime_type: Optional[str]) -> str:
+    filename = filename or f"{message_type}_{message_id}"
+    if '.' not in filename and mime_type:
+        extension = mime_type.split('/')[-1].split(';')[0].strip()
+        if extension:
+            filename = f"{filename}.{extension}"
+    return filename
+
+
+def _parse_evolution_message(message_data: Dict[str, Any], webhook_context_data: Dict[str, Any]) -> InboundMessage:
+    key = message_data.get('key') or {}
+    message_id = key.get('id')
+    sender_phone = (key.get('remoteJid') or '').split('@')[0]
+    if not message_id or not sender_phone:
+        raise InvalidPayloadError(f"Mensagem sem ID ou remetente: key={key}")
+
+    message_type_raw = message_data.get('messageType') or ''
+    message_type = EVOLUTION_MESSAGE_TYPES.get(message_type_raw, message_type_raw)
+    body = message_data.get('message') or {}
+    content, media, processing_error = None, None, None
+
+    if message_type == 'text':
+        content = body.get('conversation', '')
+    elif message_type == 'location':
+        location_payload = body.get('locationMessage') or {}
+        latitude = location_payload.get('degreesLatitude')
+        longitude = location_payload.get('degreesLongitude')
+        if latitude is not None and longitude is not None:
+            # Coordenadas em JSON no conteúdo da mensagem, para o histórico e para o frete proativo
+            content = json.dumps({'latitude': latitude, 'longitude': longitude})
+        else:
+            content = "Received a location message with missing coordinates."
+            processing_error = "Missing coordinates in locationMessage"
+    elif message_type in MEDIA_MESSAGE_TYPES:
+        media_payload = body.get(message_type_raw) or {}
+        # A legenda pode vir no objeto da mídia, no objeto 'message' ou em um extendedTextMessage
+        caption = (media_payload.get('caption') or body.get('caption')
+                   or (body.get('extendedTextMessage') or {}).get('text'))
+        content = caption or f"Received {message_type_raw}"
+        download_url = media_payload.get('url')
+        media_key = media_payload.get('mediaKey')
+        mime_type = media_payload.get('mimetype')
+        if download_url or media_key:
+            media = InboundMedia(
+                filename=_media_filename(media_payload.get('fileName'), message_type, message_id, mime_type),
+                mime_type=mime_type,
+                download_url=download_url,
+                media_key=media_key,
+                original_url=download_url or '',
+            )
+        else:
+            processing_error = "No download information for media (new format)"
+    else:
+        content = f"Received {message_type_raw} (type not fully supported)"
+        processing_error = "Unsupported message type by current logic"
+
+    return InboundMessage(
+        message_id=message_id,
+        sender_phone=sender_phone,
+        message_type=message_type,
+        message_type_raw=message_type_raw,
+        is_new_format=True,
+        timestamp=_parse_timestamp(message_data.get('messageTimestamp')),
+        contact_name=message_data.get('pushName'),
+        content=content,
+        media=media,
+        processing_error=processing_error,
+        instance=webhook_context_data.get('instance'),
+    )
+
+
+def _parse_legacy_message(message_data: Dict[str, Any], webhook_context_data: Dict[str, Any]) -> InboundMessage:
+    message_id = message_data.get('id')
+    sender_phone = message_data.get('from')
+    if not message_id or not sender_phone:
+        raise InvalidPayloadError(f"Mensagem sem ID ou remetente: id={message_id}, from={sender_phone}")
+
+    message_type = message_data.get('type') or ''
+    content, media, processing_error = None, None, None
+
+    if message_type == 'text':
+        content = (message_data.get('text') or {}).get('body', '')
+    elif message_type == 'location':
+        content = "Location message from old format not supported."
+        processing_error = "Unsupported location message format"
+    elif message_type in MEDIA_MESSAGE_TYPES:
+        media_info = message_data.get(message_type) or {}
+        mime_type = media_info.get('mime_type')
+        content = media_info.get('caption', '')
+        media = InboundMedia(
+            filename=_media_filename(media_info.get('filename'), message_type, message_id, mime_type),
+            mime_type=mime_type,
+            media_id=media_info.get('id'),
+            original_url=media_info.get('url', ''),
+        )
+    else:
+        content = f"Received {message_type} (type not fully supported)"
+        processing_error = "Unsupported message type by current logic"
+
+    # No formato antigo o nome do contato vem em 'contacts', no contexto ('value') do payload
+    contact_name = next(
+        ((contact.get('profile') or {}).get('name')
+         for contact in webhook_context_data.get('contacts', []) if contact.get('wa_id') == sender_phone),
+        None
+    )
+    return InboundMessage(
+        message_id=message_id,
+        sender_phone=sender_phone,
+        message_type=message_type,
+        message_type_raw=message_type,
+        is_new_format=False,
+        timestamp=_parse_timestamp(message_data.get('timestamp')),
+        contact_name=contact_name,
+        content=content,
+        media=media,
+        processing_error=processing_error,
+    )
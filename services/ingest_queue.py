@@ -0,0 +1,487 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import inspect as sa_inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config import Config
+from models import IngestJob
+
+logger = logging.getLogger(__name__)
+
+# Assinatura do handler: ([(message_payload, context_payload), ...], db) -> None
+# A lista contém uma mensagem, ou uma rajada de mensagens consecutivas da mesma conversa.
+JobHandler = Callable[[List[Tuple[Dict[str, Any], Dict[str, Any]]], Session], None]
+# Handler do pipeline asyncio: mesma lista, recebe uma AsyncSession e é aguardado no event loop da fila
+AsyncJobHandler = Callable[[List[Tuple[Dict[str, Any], Dict[str, Any]]], AsyncSession], Awaitable[None]]
+# Item do enqueue: (conversation_key, message_payload, context_payload, is_text); só texto é agrupado em rajadas
+QueueItem = Tuple[Optional[str], Dict[str, Any], Dict[str, Any], bool]
+
+
+class ConsistentHashRing:
+    """Mapeia uma chave (ex: telefone do usuário) sempre para a mesma lane, usando nós virtuais."""
+
+    def __init__(self, num_nodes: int, replicas: int = 64):
+        ring = sorted(
+            (self._hash(f"lane-{node}-{replica}"), node)
+            for node in range(num_nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def node_for(self, key: str) -> int:
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class _Burst:
+    """Mensagens de uma conversa aguardando a janela de agrupamento fechar."""
+    __slots__ = ('job_ids', 'deadline')
+
+    def __init__(self, job_id: int, deadline: float):
+        self.job_ids = [job_id]
+        self.deadline = deadline
+
+
+class IngestQueue:
+    """
+    Fila persistente de mensagens do webhook com um pool de workers em processo.
+
+    O webhook apenas grava os jobs na tabela 'ingest_jobs' e responde. Cada worker
+    consome uma lane própria (com sua própria sessão de banco); os jobs de uma mesma
+    conversa sempre caem na mesma lane, então são processados em ordem, enquanto
+    conversas diferentes rodam em paralelo. Jobs pendentes são retomados no restart.
+
+    Mensagens de texto seguidas da mesma conversa que chegam dentro de coalesce_window_ms
+    umas das outras são entregues juntas ao handler, que as responde como um único turno.
+
+    Se o handler for uma corrotina, as lanes viram tarefas asyncio em um único event loop
+    (thread 'ingest-event-loop') com sessões de async_session_factory: centenas de conversas
+    esperando IA ou HTTP custam uma tarefa cada, e não uma thread.
+    """
+
+    def __init__(self, session_factory: Callable[[], Session],
+                 num_workers: int = Config.MAX_PROCESSING_THREADS,
+                 max_attempts: int = Config.INGEST_MAX_ATTEMPTS,
+                 poll_interval: float = Config.INGEST_POLL_INTERVAL_SECONDS,
+                 stale_job_seconds: int = Config.INGEST_STALE_JOB_SECONDS,
+                 coalesce_window_ms: int = Config.MESSAGE_COALESCE_WINDOW_MS,
+                 coalesce_max_messages: int = Config.MESSAGE_COALESCE_MAX_MESSAGES,
+                 async_session_factory: Optional[Callable[[], AsyncSession]] = None):
+        self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+        self.num_workers = max(1, num_workers)
+        self.max_attempts = max(1, max_attempts)
+        self.poll_interval = poll_interval
+        self.stale_job_seconds = stale_job_seconds
+        self.coalesce_window = max(0, coalesce_window_ms) / 1000.0
+        self.coalesce_max_messages = max(1, coalesce_max_messages)
+
+        self._handler: Optional[Any] = None  # JobHandler ou AsyncJobHandler
+        self._ring = ConsistentHashRing(self.num_workers)
+        self._lanes: List[Any] = []  # queue.Queue por worker, ou asyncio.Queue no modo asyncio
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._on_loop_stop: Optional[Callable[[], Awaitable[None]]] = None
+        self._known_ids: Set[int] = set()  # Jobs já colocados nas lanes locais (evita duplicatas da varredura)
+        self._known_lock = threading.Lock()
+        self._bursts: Dict[str, _Burst] = {}
+        self._bursts_cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def is_running(self) -> bool:
+        return bool(self._threads) and not self._stop_event.is_set()
+
+    def start(self, handler: Any, on_loop_stop: Optional[Callable[[], Awaitable[None]]] = None):
+        """
+        Inicia os workers e retoma os jobs que ficaram pendentes no banco.
+        on_loop_stop (modo asyncio): corrotina executada no event loop da fila ao parar, para fechar
+        clientes HTTP e conexões criados nele.
+        """
+        if self.is_running:
+            return
+        is_async = asyncio.iscoroutinefunction(handler)
+        if is_async and not self.async_session_factory:
+            raise ValueError("Um handler assíncrono exige async_session_factory.")
+        self._handler = handler
+        self._on_loop_stop = on_loop_stop
+        self._stop_event.clear()
+
+        if is_async:
+            # Criado antes da varredura: os jobs retomados são agendados no loop e consumidos quando ele iniciar
+            self._loop = asyncio.new_event_loop()
+            self._lanes = [asyncio.Queue() for _ in range(self.num_workers)]
+            worker_loops = [("ingest-event-loop", self._event_loop_main, ())]
+        else:
+            self._lanes = [queue.Queue() for _ in range(self.num_workers)]
+            worker_loops = [(f"ingest-worker-{i}", self._worker_loop, (i,)) for i in range(self.num_workers)]
+        self._sweep(include_stale=True)
+
+        for name, target, args in worker_loops:
+            thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        background_loops = [("ingest-sweeper", self._sweeper_loop)]
+        if self.coalesce_window:
+            background_loops.append(("ingest-coalescer", self._coalescer_loop))
+        for name, target in background_loops:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"IngestQueue iniciada com {self.num_workers} workers{' asyncio' if is_async else ''} (janela de agrupamento: {int(self.coalesce_window * 1000)}ms).")
+
+    def stop(self, timeout: float = 10.0):
+        """Sinaliza os workers para pararem; jobs não concluídos continuam no banco."""
+        self._stop_event.set()
+        with self._bursts_cond:
+            self._bursts_cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+        self._loop = None
+        logger.info("IngestQueue parada.")
+
+    def enqueue(self, db: Session, items: List[QueueItem]) -> List[int]:
+        """
+        Persiste um job por mensagem em uma única transação e os entrega aos workers.
+        items: lista de (conversation_key, message_payload, context_payload, is_text), na ordem de chegada.
+        """
+        if not items:
+            return []
+        job_ids = self._stage_jobs(db, items)
+        db.commit()
+        self._offer_jobs(items, job_ids)
+        return job_ids
+
+    async def enqueue_async(self, db: AsyncSession, items: List[QueueItem]) -> List[int]:
+        """Versão de enqueue para a AsyncSession das rotas: a gravação dos jobs não bloqueia o event loop."""
+        if not items:
+            return []
+        job_ids = await db.run_sync(self._stage_jobs, items)
+        await db.commit()
+        self._offer_jobs(items, job_ids)
+        return job_ids
+
+    def _stage_jobs(self, db: Session, items: List[QueueItem]) -> List[int]:
+        jobs = [
+            IngestJob(conversation_key=key, message_payload=payload, context_payload=context, is_text=is_text, status='pending')
+            for key, payload, context, is_text in items
+        ]
+        db.add_all(jobs)
+        db.flush()
+        # IDs lidos antes do commit: depois dele, acessar job.id recarregaria os jobs e manteria uma
+        # conexão do pool presa até o fim da requisição
+        return [job.id for job in jobs]
+
+    def _offer_jobs(self, items: List[QueueItem], job_ids: List[int]):
+        if not self.is_running:
+            return
+        for (key, _, _, is_text), job_id in zip(items, job_ids):
+            self._offer(job_id, key, coalesce=self._coalesces(key, is_text))
+
+    def _coalesces(self, conversation_key: Optional[str], is_text: bool) -> bool:
+        return bool(conversation_key and self.coalesce_window and is_text)
+
+    def pending_count(self) -> int:
+        with self._bursts_cond:
+            buffered = sum(len(burst.job_ids) for burst in self._bursts.values())
+        return buffered + sum(lane.qsize() for lane in self._lanes)
+
+    def backlog(self) -> int:
+        """Jobs aceitos por esta instância e ainda não concluídos (aguardando ou em processamento)."""
+        with self._known_lock:
+            return len(self._known_ids)
+
+    def stats(self) -> Dict[str, Any]:
+        """Profundidade da fila para métricas: jobs em rajadas, nas lanes e em processamento."""
+        with self._bursts_cond:
+            buffered = sum(len(burst.job_ids) for burst in self._bursts.values())
+        lane_depths = [lane.qsize() for lane in self._lanes]
+        backlog = self.backlog()
+        return {
+            'running': self.is_running,
+            'mode': 'asyncio' if self._loop else 'threads',
+            'workers': self.num_workers,
+            'backlog': backlog,
+            'buffered': buffered,
+            'queued': sum(lane_depths),
+            'in_flight': max(0, backlog - buffered - sum(lane_depths)),
+            'max_lane_depth': max(lane_depths, default=0),
+        }
+
+    def lane_for(self, conversation_key: Optional[str], job_id: int = 0) -> int:
+        # Jobs sem chave (payload malformado) não têm ordem a preservar; distribui pelo id.
+        return self._ring.node_for(conversation_key or f"job-{job_id}")
+
+    def _offer(self, job_id: int, conversation_key: Optional[str], coalesce: bool = False):
+        with self._known_lock:
+            if job_id in self._known_ids:
+                return
+            self._known_ids.add(job_id)
+
+        with self._bursts_cond:
+            burst = self._bursts.get(conversation_key) if conversation_key else None
+            if coalesce:
+                if burst:
+                    burst.job_ids.append(job_id)
+                    burst.deadline = time.monotonic() + self.coalesce_window
+                    if len(burst.job_ids) >= self.coalesce_max_messages:
+                        self._flush_burst(conversation_key)
+                else:
+                    self._bursts[conversation_key] = _Burst(job_id, time.monotonic() + self.coalesce_window)
+                self._bursts_cond.notify_all()
+                return
+
+            # Uma mensagem que não pode ser agrupada encerra a rajada anterior, que vai antes dela na lane.
+            if burst:
+                self._flush_burst(conversation_key)
+            self._put_lane(self.lane_for(conversation_key, job_id), [job_id])
+
+    def _flush_burst(self, conversation_key: str):
+        # Deve ser chamado com _bursts_cond adquirido
+        burst = self._bursts.pop(conversation_key)
+        self._put_lane(self.lane_for(conversation_key), burst.job_ids)
+
+    def _put_lane(self, lane_index: int, job_ids: List[int]):
+        loop = self._loop
+        if loop:
+            # asyncio.Queue não é thread-safe: a entrega é feita pelo próprio event loop
+            try:
+                loop.call_soon_threadsafe(self._lanes[lane_index].put_nowait, job_ids)
+            except RuntimeError:
+                # Loop já encerrado (parada em andamento): os jobs continuam pendentes no banco
+                self._forget(job_ids)
+        else:
+            self._lanes[lane_index].put(job_ids)
+
+    def _forget(self, job_ids: List[int]):
+        with self._known_lock:
+            self._known_ids.difference_update(job_ids)
+
+    def _coalescer_loop(self):
+        with self._bursts_cond:
+            while not self._stop_event.is_set():
+                now = time.monotonic()
+                for key in [key for key, burst in self._bursts.items() if burst.deadline <= now]:
+                    self._flush_burst(key)
+                next_deadline = min((burst.deadline for burst in self._bursts.values()), default=None)
+                self._bursts_cond.wait(timeout=(next_deadline - now) if next_deadline else self.poll_interval)
+
+            # Na parada, entrega o que estava acumulado; o que não for processado fica pendente no banco.
+            for key in list(self._bursts):
+                self._flush_burst(key)
+
+    def _worker_loop(self, lane_index: int):
+        lane = self._lanes[lane_index]
+        while not self._stop_event.is_set():
+            try:
+                job_ids = lane.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            try:
+                self._run_jobs(job_ids)
+            except Exception as e:
+                logger.error(f"Erro inesperado no worker ao processar os jobs {job_ids}: {e}", exc_info=True)
+            finally:
+                lane.task_done()
+
+    def _event_loop_main(self):
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(asyncio.gather(*(self._async_worker(i) for i in range(self.num_workers))))
+            if self._on_loop_stop:
+                loop.run_until_complete(self._on_loop_stop())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+    async def _async_worker(self, lane_index: int):
+        lane = self._lanes[lane_index]
+        while not self._stop_event.is_set():
+            try:
+                job_ids = await asyncio.wait_for(lane.get(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                continue
+            try:
+                await self._run_jobs_async(job_ids)
+            except Exception as e:
+                logger.error(f"Erro inesperado no worker ao processar os jobs {job_ids}: {e}", exc_info=True)
+
+    def _sweeper_loop(self):
+        # Recupera jobs órfãos (ex: gravados por uma instância que caiu antes de processá-los).
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                self._sweep(include_stale=False)
+            except Exception as e:
+                logger.error(f"Erro ao varrer jobs pendentes: {e}", exc_info=True)
+
+    def _sweep(self, include_stale: bool):
+        """
+        No startup (include_stale=True) retoma todos os jobs pendentes; nas varreduras periódicas,
+        apenas os pendentes há mais de stale_job_seconds, para não competir com a instância que os recebeu.
+        """
+        stale_before = datetime.utcnow() - timedelta(seconds=self.stale_job_seconds)
+        db = self.session_factory()
+        try:
+            reset = db.query(IngestJob).filter(
+                IngestJob.status == 'processing',
+                IngestJob.locked_at < stale_before
+            ).update({'status': 'pending', 'locked_at': None}, synchronize_session=False)
+            db.commit()
+            if reset:
+                logger.warning(f"{reset} jobs travados em 'processing' foram devolvidos para a fila.")
+
+            pending_query = db.query(IngestJob.id, IngestJob.conversation_key, IngestJob.is_text).filter(IngestJob.status == 'pending')
+            if not include_stale:
+                pending_query = pending_query.filter(IngestJob.created_at < stale_before)
+            pending = pending_query.order_by(IngestJob.id.asc()).all()
+        finally:
+            db.close()
+
+        for job_id, conversation_key, is_text in pending:
+            self._offer(job_id, conversation_key, coalesce=self._coalesces(conversation_key, is_text))
+        if pending:
+            logger.info(f"{len(pending)} jobs pendentes retomados do banco.")
+
+    def _claim(self, db: Session, job_ids: List[int]) -> List[IngestJob]:
+        """Marca como 'processing' apenas os jobs ainda pendentes (evita processamento duplo)."""
+        claimed = []
+        for job_id in job_ids:
+            updated = db.query(IngestJob).filter(
+                IngestJob.id == job_id,
+                IngestJob.status == 'pending'
+            ).update({
+                'status': 'processing',
+                'locked_at': datetime.utcnow(),
+                'attempts': IngestJob.attempts + 1
+            }, synchronize_session=False)
+            if updated:
+                claimed.append(job_id)
+        db.commit()
+        if not claimed:
+            return []
+        jobs = db.query(IngestJob).filter(IngestJob.id.in_(claimed)).all()
+        return sorted(jobs, key=lambda job: job.id)
+
+    def _run_jobs(self, job_ids: List[int]):
+        db = self.session_factory()
+        try:
+            jobs = self._claim(db, job_ids)
+            if not jobs:
+                logger.debug(f"Jobs {job_ids} já reivindicados por outro worker.")
+                return
+            claimed_ids = [job.id for job in jobs]
+            items = [(job.message_payload, job.context_payload or {}) for job in jobs]
+
+            # As novas tentativas acontecem aqui mesmo, na lane, para que as mensagens seguintes
+            # da mesma conversa não passem na frente destas.
+            attempts = max(job.attempts for job in jobs)
+            # Encerra a leitura dos jobs: a conexão volta ao pool durante o download das mídias
+            db.commit()
+            while True:
+                try:
+                    self._handler(items, db)
+                    break
+                except Exception as e:
+                    db.rollback()
+                    if attempts >= self.max_attempts:
+                        self._mark_failed(db, claimed_ids, e, attempts)
+                        return
+                    attempts += 1
+                    self._mark_retry(db, claimed_ids, e, attempts)
+                    self._stop_event.wait(min(2 ** (attempts - 2), 30))
+
+            self._delete_jobs(db, claimed_ids)
+        finally:
+            self._forget(job_ids)
+            db.close()
+
+    async def _run_jobs_async(self, job_ids: List[int]):
+        """Equivalente de _run_jobs para o handler assíncrono; o SQL da fila roda via run_sync."""
+        async with self.async_session_factory() as db:
+            try:
+                jobs = await db.run_sync(self._claim, job_ids)
+                if not jobs:
+                    logger.debug(f"Jobs {job_ids} já reivindicados por outro worker.")
+                    return
+                claimed_ids = [job.id for job in jobs]
+                items = [(job.message_payload, job.context_payload or {}) for job in jobs]
+
+                attempts = max(job.attempts for job in jobs)
+                await db.commit()
+                while True:
+                    try:
+                        await self._handler(items, db)
+                        break
+                    except Exception as e:
+                        await db.rollback()
+                        if attempts >= self.max_attempts:
+                            await db.run_sync(self._mark_failed, claimed_ids, e, attempts)
+                            return
+                        attempts += 1
+                        await db.run_sync(self._mark_retry, claimed_ids, e, attempts)
+                        await self._backoff_async(min(2 ** (attempts - 2), 30))
+
+                await db.run_sync(self._delete_jobs, claimed_ids)
+            finally:
+                self._forget(job_ids)
+
+    async def _backoff_async(self, delay: float):
+        # Como o _stop_event.wait() do modo com threads: interrompe a espera se a fila for parada
+        deadline = time.monotonic() + delay
+        while not self._stop_event.is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(min(self.poll_interval, deadline - time.monotonic()))
+
+    def _delete_jobs(self, db: Session, job_ids: List[int]):
+        # Jobs concluídos são removidos para manter a tabela pequena; falhas permanecem para inspeção.
+        db.query(IngestJob).filter(IngestJob.id.in_(job_ids)).delete(synchronize_session=False)
+        db.commit()
+
+    def _mark_retry(self, db: Session, job_ids: List[int], error: Exception, attempts: int):
+        db.query(IngestJob).filter(IngestJob.id.in_(job_ids)).update({
+            'attempts': attempts,
+            'locked_at': datetime.utcnow(),
+            'last_error': str(error)
+        }, synchronize_session=False)
+        db.commit()
+        logger.warning(f"Jobs {job_ids} falharam (tentativa {attempts - 1}/{self.max_attempts}), serão reprocessados: {error}")
+
+    def _mark_failed(self, db: Session, job_ids: List[int], error: Exception, attempts: int):
+        db.query(IngestJob).filter(IngestJob.id.in_(job_ids)).update({
+            'status': 'failed',
+            'locked_at': None,
+            'last_error': str(error)
+        }, synchronize_session=False)
+        db.commit()
+        logger.error(f"Jobs {job_ids} falharam após {attempts} tentativas: {error}", exc_info=True)
+
+
+def upgrade_ingest_jobs_schema(engine) -> bool:
+    """Adiciona a coluna is_text a uma tabela 'ingest_jobs' criada antes dela (o create_all não altera tabelas existentes)."""
+    existing = {column['name'] for column in sa_inspect(engine).get_columns(IngestJob.__tablename__)}
+    if 'is_text' in existing:
+        return False
+    column = IngestJob.__table__.c.is_text
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"ALTER TABLE {IngestJob.__tablename__} ADD COLUMN is_text {column.type.compile(dialect=engine.dialect)} "
+            f"NOT NULL DEFAULT {column.server_default.arg.compile(dialect=engine.dialect)}"
+        ))
+    logger.warning(f"Coluna is_text adicionada a '{IngestJob.__tablename__}'; jobs pendentes antigos não são agrupados.")
+    return True
@@ -0,0 +1,92 @@
+import base64
+import binascii
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, List, Optional, Tuple
+
+from sqlalchemy import func, literal, select, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+# Acima disso o total de uma busca é informado como aproximado ("pelo menos"), sem contar todas as linhas
+APPROXIMATE_COUNT_LIMIT = 10000
+
+
+class InvalidCursorError(ValueError):
+    """Cursor de paginação malformado (não foi gerado por encode_cursor)."""
+
+
+def encode_cursor(sort_value: Optional[datetime], row_id: int) -> str:
+    """Cursor opaco com a chave (data, ID) da última linha da página."""
+    payload = json.dumps([sort_value.isoformat() if sort_value else None, row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(row_id, int) or isinstance(row_id, bool):
+            raise ValueError(f"ID inválido: {row_id!r}")
+        return (datetime.fromisoformat(sort_value) if sort_value is not None else None), row_id
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as e:
+        raise InvalidCursorError(f"Cursor inválido: {cursor!r}") from e
+
+
+@dataclass(slots=True, frozen=True)
+class KeysetPage:
+    rows: List[Any]
+    next_cursor: Optional[str]
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+
+async def fetch_keyset_page(db: AsyncSession, query, sort_column, id_column, cursor: Optional[str], limit: int,
+                            row_key: Callable[[Any], Tuple[Optional[datetime], int]]) -> KeysetPage:
+    """
+    Página de `query` em ordem (sort_column DESC, id_column DESC), a partir do cursor, sem OFFSET nem COUNT:
+    cada página é uma busca por faixa no índice (sort_column, id_column), com custo constante.
+    Linhas com sort_column nulo (ex: conversa sem mensagens) vêm depois de todas as outras, em ordem de ID,
+    igual no Postgres e no SQLite. `row_key` extrai (data, ID) de uma linha para o próximo cursor.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    limit = max(1, limit)
+    query = query.order_by(None)
+    rows = []
+
+    if after is None or after[0] is not None:
+        dated = query.where(sort_column.isnot(None))
+        if after:
+            dated = dated.where(tuple_(sort_column, id_column) < tuple_(*after))
+        rows = (await db.execute(dated.order_by(sort_column.desc(), id_column.desc()).limit(limit + 1))).all()
+    if len(rows) <= limit:
+        undated = query.where(sort_column.is_(None))
+        if after and after[0] is None:
+            undated = undated.where(id_column < after[1])
+        rows += (await db.execute(undated.order_by(id_column.desc()).limit(limit + 1 - len(rows)))).all()
+
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    return KeysetPage(rows=rows, next_cursor=encode_cursor(*row_key(rows[-1])) if has_next else None)
+
+
+async def approximate_count(db: AsyncSession, model, *criteria) -> Tuple[int, bool]:
+    """
+    Total para exibição, sem varrer a tabela: sem filtros no Postgres usa a estimativa do planner
+    (pg_class.reltuples); com filtros conta até APPROXIMATE_COUNT_LIMIT. Retorna (total, é_aproximado).
+    """
+    if not criteria and db.get_bind().dialect.name == 'postgresql':
+        estimate = await db.scalar(text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+                                   {'table': model.__tablename__})
+        if estimate is not None and estimate >= 0:  # -1: tabela ainda não analisada
+            return int(estimate), True
+
+    capped = select(literal(1)).select_from(model).where(*criteria).limit(APPROXIMATE_COUNT_LIMIT + 1).subquery()
+    total = await db.scalar(select(func.count()).select_from(capped))
+    if total > APPROXIMATE_COUNT_LIMIT:
+        return APPROXIMATE_COUNT_LIMIT, True
+    return total, False
@@ -0,0 +1,293 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import DateTime, delete, exists, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+
+from config import Config
+from models import AIResponse, Conversation, HumanAgentRequest, MediaFile, Message, MessageArchiveSegment
+from services.conversation_history import naive_utc
+from services.keyset_pagination import KeysetPage, decode_cursor, encode_cursor
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FILE_SUFFIX = '.jsonl.gz'
+DELETE_CHUNK_SIZE = 500  # IDs por DELETE ... IN (limite de parâmetros do SQLite)
+
+
+class LocalArchiveStorage:
+    """
+    Um arquivo 'AAAA-MM.jsonl.gz' por mês em `root`, só acrescentado: cada arquivamento adiciona membros
+    gzip ao fim, e um leitor comum (zcat) vê o arquivo inteiro. Um job de arquivamento por vez.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def append(self, partition: str, data: bytes) -> Tuple[str, int]:
+        """Grava `data` no arquivo do mês e retorna (location, offset em que começou)."""
+        os.makedirs(self.root, exist_ok=True)
+        location = f"{partition}{ARCHIVE_FILE_SUFFIX}"
+        with open(os.path.join(self.root, location), 'ab') as archive:
+            archive.seek(0, os.SEEK_END)
+            offset = archive.tell()
+            archive.write(data)
+            archive.flush()
+            os.fsync(archive.fileno())  # No disco antes do commit que apaga as mensagens do banco
+        return location, offset
+
+    def read(self, location: str, offset: int, length: int) -> bytes:
+        with open(os.path.join(self.root, location), 'rb') as archive:
+            archive.seek(offset)
+            return archive.read(length)
+
+    def partitions(self) -> List[str]:
+        """Meses com arquivo gravado."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[:-len(ARCHIVE_FILE_SUFFIX)] for name in os.listdir(self.root) if name.endswith(ARCHIVE_FILE_SUFFIX))
+
+    def delete_partition(self, partition: str):
+        """Remove o arquivo do mês (retenção); ausente conta como removido."""
+        try:
+            os.remove(os.path.join(self.root, f"{partition}{ARCHIVE_FILE_SUFFIX}"))
+        except FileNotFoundError:
+            pass
+
+
+class BucketArchiveStorage:
+    """
+    Objetos 'prefixo/AAAA-MM/<data>-<id>.jsonl.gz' no bucket. Objetos não aceitam append, então cada lote
+    arquivado grava um objeto novo por mês; a leitura baixa só o trecho (Range) de cada conversa.
+    """
+
+    def __init__(self, bucket_name: str, prefix: str = ''):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip('/')
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            from google.cloud import storage  # Só quem arquiva no bucket precisa do cliente
+            self._bucket = storage.Client(project=Config.GOOGLE_CLOUD_PROJECT_ID).bucket(self.bucket_name)
+        return self._bucket
+
+    def append(self, partition: str, data: bytes) -> Tuple[str, int]:
+        name = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}{ARCHIVE_FILE_SUFFIX}"
+        location = '/'.join(part for part in (self.prefix, partition, name) if part)
+        # Sem content_encoding=gzip: o GCS não descomprime na entrega e os offsets continuam valendo
+        self.bucket.blob(location).upload_from_string(data, content_type='application/gzip')
+        return location, 0
+
+    def read(self, location: str, offset: int, length: int) -> bytes:
+        return self.bucket.blob(location).download_as_bytes(start=offset, end=offset + length - 1)
+
+    def partitions(self) -> List[str]:
+        """Meses com objetos gravados."""
+        prefix = f"{self.prefix}/" if self.prefix else ''
+        blobs = self.bucket.list_blobs(prefix=prefix, delimiter='/')
+        for _ in blobs:  # `prefixes` só é preenchido ao percorrer as páginas
+            pass
+        return sorted(month[len(prefix):].rstrip('/') for month in blobs.prefixes)
+
+    def delete_partition(self, partition: str):
+        """Remove todos os objetos do mês (retenção)."""
+        prefix = '/'.join(part for part in (self.prefix, partition) if part) + '/'
+        self.bucket.delete_blobs(list(self.bucket.list_blobs(prefix=prefix)), on_error=lambda blob: None)
+
+
+def archive_storage(path: str = Config.MESSAGE_ARCHIVE_PATH):
+    """Armazenamento do arquivo a partir de MESSAGE_ARCHIVE_PATH: diretório local ou gs://bucket/prefixo."""
+    if path.startswith('gs://'):
+        bucket_name, _, prefix = path[len('gs://'):].partition('/')
+        return BucketArchiveStorage(bucket_name, prefix)
+    return LocalArchiveStorage(path)
+
+
+def _row_values(row) -> Dict[str, Any]:
+    values = {}
+    for column in row.__table__.columns:
+        value = getattr(row, column.key)
+        values[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    return values
+
+
+def _transient_row(model, values: Dict[str, Any]):
+    kwargs = {}
+    for column in model.__table__.columns:
+        if column.key in values:
+            value = values[column.key]
+            if value is not None and isinstance(column.type, DateTime):
+                value = datetime.fromisoformat(value)
+            kwargs[column.key] = value
+    return model(**kwargs)
+
+
+def serialize_message(message: Message) -> Dict[str, Any]:
+    """Todas as colunas da mensagem, com as respostas da IA e os registros de mídia (os arquivos ficam no bucket)."""
+    values = _row_values(message)
+    values['ai_responses'] = [_row_values(response) for response in message.ai_responses]
+    values['media_files'] = [_row_values(media_file) for media_file in message.media_files]
+    return values
+
+
+def deserialize_message(values: Dict[str, Any]) -> Message:
+    """Message fora de qualquer sessão (só leitura), com ai_responses e media_files preenchidos."""
+    message = _transient_row(Message, values)
+    message.ai_responses = [_transient_row(AIResponse, response) for response in values.get('ai_responses', [])]
+    message.media_files = [_transient_row(MediaFile, media_file) for media_file in values.get('media_files', [])]
+    return message
+
+
+def encode_segment(messages: Sequence[Message]) -> bytes:
+    lines = ''.join(json.dumps(serialize_message(message), ensure_ascii=False) + '\n' for message in messages)
+    return gzip.compress(lines.encode('utf-8'), compresslevel=6)
+
+
+def decode_segment(data: bytes) -> List[Message]:
+    return [deserialize_message(json.loads(line)) for line in gzip.decompress(data).decode('utf-8').splitlines() if line.strip()]
+
+
+def message_sort_key(timestamp: Optional[datetime], message_id: int) -> Tuple[datetime, int]:
+    return naive_utc(timestamp), message_id
+
+
+@dataclass(slots=True)
+class ArchiveRun:
+    conversations: int = 0
+    messages: int = 0
+    segments: int = 0
+    bytes_written: int = 0
+
+
+def archive_idle_conversations(db: Session, storage, idle_days: int = Config.MESSAGE_ARCHIVE_AFTER_DAYS,
+                               batch_size: int = 100, now: Optional[datetime] = None) -> ArchiveRun:
+    """
+    Move para `storage` as mensagens (com respostas da IA e registros de mídia) das conversas sem mensagens
+    há mais de `idle_days` dias, em lotes de `batch_size` conversas: um membro gzip por conversa e mês,
+    gravado antes do commit que apaga as linhas e registra os segmentos em 'message_archive_segments'.
+    A conversa continua no banco, com as estatísticas inalteradas (message_count conta as arquivadas).
+    """
+    cutoff = naive_utc(now or datetime.now(timezone.utc)) - timedelta(days=idle_days)
+    has_messages = exists().where(Message.conversation_id == Conversation.id)
+    run, last_id = ArchiveRun(), 0
+    while True:
+        ids = db.scalars(select(Conversation.id).where(
+            Conversation.id > last_id, Conversation.last_message_at < cutoff, has_messages
+        ).order_by(Conversation.id).limit(batch_size)).all()
+        if not ids:
+            return run
+        _archive_conversations(db, storage, ids, run)
+        last_id = ids[-1]
+        logger.info(f"Arquivadas {run.messages} mensagens de {run.conversations} conversas (até o ID {last_id})")
+
+
+def _archive_conversations(db: Session, storage, conversation_ids: List[int], run: ArchiveRun):
+    messages = db.scalars(
+        select(Message).where(Message.conversation_id.in_(conversation_ids))
+        .options(selectinload(Message.ai_responses), selectinload(Message.media_files))
+        .order_by(Message.conversation_id, Message.timestamp, Message.id)
+    ).all()
+
+    by_partition = defaultdict(lambda: defaultdict(list))
+    for message in messages:
+        by_partition[naive_utc(message.timestamp).strftime('%Y-%m')][message.conversation_id].append(message)
+
+    segments = []
+    for partition, conversations in by_partition.items():
+        members = [(conversation_id, partition_messages, encode_segment(partition_messages))
+                   for conversation_id, partition_messages in conversations.items()]
+        location, offset = storage.append(partition, b''.join(data for _, _, data in members))
+        for conversation_id, partition_messages, data in members:
+            segments.append(MessageArchiveSegment(
+                conversation_id=conversation_id, partition=partition, location=location,
+                byte_offset=offset, byte_length=len(data), message_count=len(partition_messages),
+                first_message_at=naive_utc(partition_messages[0].timestamp),
+                last_message_at=naive_utc(partition_messages[-1].timestamp),
+            ))
+            offset += len(data)
+            run.bytes_written += len(data)
+
+    # Mensagens que chegarem durante o lote não estão em `message_ids` e continuam no banco
+    message_ids = [message.id for message in messages]
+    for start in range(0, len(message_ids), DELETE_CHUNK_SIZE):
+        chunk = message_ids[start:start + DELETE_CHUNK_SIZE]
+        # O pedido de atendimento guarda o histórico em full_conversation_history_json; só a referência sai
+        db.execute(update(HumanAgentRequest).where(HumanAgentRequest.last_message_id_before_escalation.in_(chunk))
+                   .values(last_message_id_before_escalation=None).execution_options(synchronize_session=False))
+        for statement in (delete(AIResponse).where(AIResponse.message_id.in_(chunk)),
+                          delete(MediaFile).where(MediaFile.message_id.in_(chunk)),
+                          delete(Message).where(Message.id.in_(chunk))):
+            db.execute(statement.execution_options(synchronize_session=False))
+    db.add_all(segments)
+    db.commit()
+    db.expunge_all()
+
+    run.conversations += len(conversation_ids)
+    run.messages += len(messages)
+    run.segments += len(segments)
+
+
+async def archived_segments(db: AsyncSession, conversation_id: int) -> List[MessageArchiveSegment]:
+    return list((await db.scalars(select(MessageArchiveSegment).where(
+        MessageArchiveSegment.conversation_id == conversation_id
+    ).order_by(MessageArchiveSegment.first_message_at, MessageArchiveSegment.id))).all())
+
+
+async def read_archived_messages(storage, segments: Sequence[MessageArchiveSegment]) -> List[Message]:
+    """Mensagens dos segmentos, em ordem cronológica. A leitura (disco ou bucket) roda fora do event loop."""
+    if not segments:
+        return []
+    ranges = [(segment.location, segment.byte_offset, segment.byte_length) for segment in segments]
+
+    def read_all():
+        return [message for location, offset, length in ranges for message in decode_segment(storage.read(location, offset, length))]
+
+    messages = await asyncio.to_thread(read_all)
+    messages.sort(key=lambda message: message_sort_key(message.timestamp, message.id))
+    return messages
+
+
+async def load_archived_messages(db: AsyncSession, storage, conversation_id: int) -> List[Message]:
+    return await read_archived_messages(storage, await archived_segments(db, conversation_id))
+
+
+async def with_archived_messages(db: AsyncSession, storage, conversation_id: int, page: KeysetPage,
+                                 cursor: Optional[str], limit: int) -> KeysetPage:
+    """
+    Completa uma página de mensagens do banco (mais recentes primeiro, rows = Message) com as arquivadas,
+    na mesma ordem e com o mesmo formato de cursor. Só lê os segmentos que podem cair na página: anteriores
+    ao cursor e, se a página do banco já está cheia, posteriores à última mensagem dela.
+    """
+    segments = await archived_segments(db, conversation_id)
+    if not segments:
+        return page
+    rows = list(page.rows)
+    after = message_sort_key(*decode_cursor(cursor)) if cursor else None
+    floor = message_sort_key(rows[-1].timestamp, rows[-1].id) if len(rows) >= limit else None
+
+    candidates, older_remaining = [], False
+    for segment in segments:
+        if after is not None and naive_utc(segment.first_message_at) > after[0]:
+            continue  # Inteiro em páginas anteriores
+        if floor is not None and naive_utc(segment.last_message_at) < floor[0]:
+            older_remaining = True  # Inteiro em páginas seguintes
+            continue
+        candidates.append(segment)
+
+    archived = [message for message in await read_archived_messages(storage, candidates)
+                if after is None or message_sort_key(message.timestamp, message.id) < after]
+    merged = sorted(rows + archived, key=lambda message: message_sort_key(message.timestamp, message.id), reverse=True)
+    has_next = page.has_next or older_remaining or len(merged) > limit
+    merged = merged[:limit]
+    return KeysetPage(rows=merged, next_cursor=encode_cursor(merged[-1].timestamp, merged[-1].id) if has_next and merged else None)
@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(ordered: List[float], pct: float) -> Optional[float]:
+    # Nearest-rank, como no relatório do replay_webhook.py
+    if not ordered:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class PoolMetrics:
+    """
+    Instrumentação do pool de conexões de uma engine: tempo de espera no checkout, conexões em uso,
+    conexões abertas além do pool_size (overflow) e timeouts. Serve para dimensionar o pool pelos workers.
+    """
+
+    def __init__(self, name: str, recent_samples: int = 1000):
+        self.name = name
+        self._engine = None
+        self._waits_ms: Deque[float] = deque(maxlen=recent_samples)
+        self._max_wait_ms = 0.0
+        self._open_connections = 0
+        self._counters: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def pool_class(self, base: type) -> type:
+        """
+        Subclasse de `base` (QueuePool, AsyncAdaptedQueuePool) que mede o tempo de _do_get, a espera por uma
+        conexão livre. A métrica fica na classe, então sobrevive ao pool recriado por engine.dispose().
+        """
+        metrics = self
+
+        def _do_get(pool):
+            started = time.perf_counter()
+            try:
+                return base._do_get(pool)
+            except PoolTimeoutError:
+                metrics.record('timeouts')
+                raise
+            finally:
+                metrics.observe_wait((time.perf_counter() - started) * 1000)
+
+        return type(f"Instrumented{base.__name__}", (base,), {'_do_get': _do_get})
+
+    def attach(self, engine):
+        """Registra os eventos do pool da engine (síncrona ou a sync_engine de uma engine asyncio)."""
+        self._engine = engine
+        event.listen(engine, 'checkout', lambda *args: self.record('checkouts'))
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'close', self._on_close)
+        event.listen(engine, 'close_detached', self._on_close)
+        event.listen(engine, 'invalidate', lambda *args: self.record('invalidations'))
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        # Conta as conexões abertas aqui: o gauge overflow() do pool já inclui as que ainda estão conectando
+        pool_size = self._pool_gauge('size')
+        with self._lock:
+            self._open_connections += 1
+            self._counters['connects'] += 1
+            if pool_size is not None and self._open_connections > pool_size:
+                self._counters['overflow_connects'] += 1
+
+    def _on_close(self, dbapi_connection, *args):
+        with self._lock:
+            self._open_connections = max(0, self._open_connections - 1)
+
+    def observe_wait(self, wait_ms: float):
+        with self._lock:
+            self._waits_ms.append(wait_ms)
+            self._max_wait_ms = max(self._max_wait_ms, wait_ms)
+
+    def record(self, event_name: str, amount: int = 1):
+        with self._lock:
+            self._counters[event_name] += amount
+
+    def _pool_gauge(self, name: str) -> Optional[int]:
+        # Pools sem limite (SingletonThreadPool, NullPool) não têm overflow/checkedout
+        gauge = getattr(self._engine.pool, name, None) if self._engine is not None else None
+        return gauge() if callable(gauge) else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._counters)
+            waits = sorted(self._waits_ms)
+            max_wait_ms = self._max_wait_ms
+        stats.update({
+            'pool_size': self._pool_gauge('size'),
+            'checked_out': self._pool_gauge('checkedout'),
+            'overflow': max(0, self._pool_gauge('overflow') or 0),  # Negativo enquanto o pool não está cheio
+            'checked_in': self._pool_gauge('checkedin'),
+            'checkout_wait_ms': {
+                name: (round(value, 2) if value is not None else None)
+                for name, value in (
+                    ('p50', _percentile(waits, 50)),
+                    ('p95', _percentile(waits, 95)),
+                    ('p99', _percentile(waits, 99)),
+                    ('max', max_wait_ms if waits else None),
+                )
+            },
+        })
+        return stats
@@ -0,0 +1,108 @@
+import time
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import JSON, cast, func, literal, select
+from sqlalchemy.dialects.postgresql import JSONB, insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from config import Config
+from models import UserProfile
+from services.ttl_cache import TTLCache
+
+
+def profile_upsert(dialect_name: str, conversation_id: int, changes: Dict[str, Any]):
+    """
+    INSERT ... ON CONFLICT que mescla `changes` no profile_data gravado, no próprio banco: sem ler o perfil
+    antes e sem perder chaves gravadas por outra instância. None se o dialeto não tem como mesclar JSON.
+    """
+    if dialect_name == 'postgresql':
+        statement = postgresql_insert(UserProfile.__table__)
+        merged = cast(
+            func.coalesce(cast(UserProfile.profile_data, JSONB), cast(literal('{}'), JSONB)).op('||')(cast(statement.excluded.profile_data, JSONB)),
+            JSON,
+        )
+    elif dialect_name == 'sqlite':
+        statement = sqlite_insert(UserProfile.__table__)
+        merged = func.json_patch(func.coalesce(UserProfile.profile_data, '{}'), statement.excluded.profile_data)
+    else:
+        return None
+    return statement.values(conversation_id=conversation_id, profile_data=changes).on_conflict_do_update(
+        index_elements=[UserProfile.conversation_id],
+        set_={'profile_data': merged, 'updated_at': func.now()},
+    )
+
+
+class ProfileCache(TTLCache[int, Dict[str, Any]]):
+    """
+    Cache em processo (LRU + TTL) de conversation_id -> profile_data, com escrita direta (write-through):
+    as chaves extraídas durante um turno ficam pendentes, são gravadas por write_pending em um único
+    upsert antes do commit do turno e só então entram no cache (committed). Perfil inexistente é guardado
+    como {}. O TTL limita a defasagem em relação a perfis gravados por outras instâncias.
+    """
+
+    def __init__(self, max_size: int = Config.PROFILE_CACHE_SIZE,
+                 ttl_seconds: float = Config.PROFILE_CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__(max_size, ttl_seconds, clock)
+        self._pending: Dict[int, Dict[str, Any]] = {}
+
+    def get(self, conversation_id: int) -> Optional[Dict[str, Any]]:
+        """Cópia do perfil em cache ({} se a conversa não tem perfil), ou None num miss."""
+        profile_data = super().get(conversation_id)
+        return dict(profile_data) if profile_data is not None else None
+
+    def put(self, conversation_id: int, profile_data: Optional[Dict[str, Any]]):
+        super().put(conversation_id, dict(profile_data or {}))
+
+    def stage(self, conversation_id: int, key: str, value: Any):
+        """Registra uma chave extraída no turno; várias chaves viram uma única escrita."""
+        with self._lock:
+            self._pending.setdefault(conversation_id, {})[key] = value
+            self._counters['staged_keys'] += 1
+
+    def pending(self, conversation_id: int) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._pending.get(conversation_id, {}))
+
+    def write_pending(self, db: Session, conversation_id: int):
+        """Adiciona à transação do turno a gravação das chaves pendentes (nada se não houver); o commit fica com quem chama."""
+        changes = self.pending(conversation_id)
+        if not changes:
+            return
+        statement = profile_upsert(db.get_bind().dialect.name, conversation_id, changes)
+        if statement is not None:
+            db.execute(statement)
+        else:
+            profile = db.scalar(select(UserProfile).where(UserProfile.conversation_id == conversation_id))
+            if profile is None:
+                db.add(UserProfile(conversation_id=conversation_id, profile_data=changes))
+            else:
+                profile.profile_data = {**(profile.profile_data or {}), **changes}
+        with self._lock:
+            self._counters['writes'] += 1
+
+    def committed(self, conversation_id: int):
+        """Depois do commit: as chaves pendentes passam a valer no cache."""
+        with self._lock:
+            changes = self._pending.pop(conversation_id, None)
+            profile_data = self.peek(conversation_id)
+            if changes and profile_data is not None:
+                self.replace(conversation_id, {**profile_data, **changes})
+
+    def discard(self, conversation_id: int):
+        """Turno desfeito: descarta as chaves pendentes e a entrada, que pode não refletir o banco."""
+        with self._lock:
+            self._pending.pop(conversation_id, None)
+            self.invalidate(conversation_id)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._pending.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = super().stats()
+            stats['pending'] = len(self._pending)
+        return stats
@@ -0,0 +1,79 @@
+import logging
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+logger = logging.getLogger(__name__)
+
+# Atraso de replicação da réplica Postgres: 0 quando tudo o que foi recebido já foi aplicado (primário ocioso
+# não conta como atraso), senão o tempo desde a última transação aplicada. NULL se nada foi aplicado ainda.
+POSTGRES_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+
+class ReplicaRouter:
+    """
+    Decide se uma leitura do dashboard pode ir para a réplica: só quando o atraso de replicação medido está
+    dentro do tolerado pela tela. O atraso é medido no máximo a cada `check_interval_seconds` (uma consulta
+    barata na réplica); réplica fora do ar ou atraso desconhecido mandam as leituras para o primário até a
+    próxima medição. Sem engine (DATABASE_REPLICA_URL vazio) tudo vai para o primário.
+    """
+
+    def __init__(self, engine: Optional[AsyncEngine], session_factory: Optional[async_sessionmaker] = None,
+                 check_interval_seconds: float = 5.0, clock: Callable[[], float] = time.monotonic):
+        self.engine = engine
+        self.session_factory = session_factory
+        self.check_interval_seconds = check_interval_seconds
+        self._clock = clock
+        self._lag_seconds: Optional[float] = None
+        self._checked_at: Optional[float] = None
+        self._counters: Counter = Counter()
+
+    async def measure_lag(self) -> Optional[float]:
+        async with self.engine.connect() as connection:
+            if connection.dialect.name != 'postgresql':
+                return 0.0  # Sem noção de atraso (ex: SQLite em desenvolvimento): a réplica é tratada como em dia
+            lag = await connection.scalar(POSTGRES_LAG_QUERY)
+        return None if lag is None else max(0.0, float(lag))
+
+    async def lag_seconds(self) -> Optional[float]:
+        """Último atraso medido, remedido se a medição venceu; None se a réplica não respondeu."""
+        now = self._clock()
+        if self._checked_at is None or now - self._checked_at >= self.check_interval_seconds:
+            # Sem lock: requisições simultâneas no vencimento podem medir duas vezes, o que é inofensivo
+            self._checked_at = now
+            try:
+                self._lag_seconds = await self.measure_lag()
+                self._counters['lag_checks'] += 1
+            except Exception as e:
+                self._lag_seconds = None
+                self._counters['replica_errors'] += 1
+                logger.warning(f"Réplica de leitura indisponível; leituras vão para o primário: {e}")
+        return self._lag_seconds
+
+    async def session_factory_for(self, max_lag_seconds: float) -> Optional[async_sessionmaker]:
+        """Fábrica de sessões da réplica se ela pode atender uma leitura que tolera `max_lag_seconds`; senão None."""
+        if self.engine is None:
+            return None
+        lag = await self.lag_seconds()
+        if lag is None or lag > max_lag_seconds:
+            self._counters['primary_reads'] += 1
+            if lag is not None:
+                self._counters['lag_fallbacks'] += 1
+            return None
+        self._counters['replica_reads'] += 1
+        return self.session_factory
+
+    def stats(self) -> Dict[str, float]:
+        stats: Dict[str, float] = dict(self._counters)
+        stats['enabled'] = self.engine is not None
+        stats['lag_seconds'] = self._lag_seconds
+        return stats
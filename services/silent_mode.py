@@ -0,0 +1,98 @@
+import heapq
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from config import Config
+from models import SilentMode
+
+logger = logging.getLogger(__name__)
+
+
+def utcnow() -> datetime:
+    # SilentMode.expires_at é gravado em UTC sem fuso (ver enable_silent_mode no dashboard)
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class SilentModeRegistry:
+    """
+    Janelas de modo silencioso ativas (conversation_id -> expires_at) em memória, para o webhook decidir
+    em O(1), sem sessão de banco, se a IA responde. As expirações saem por um min-heap de expires_at.
+    O dashboard atualiza o registro ao ativar/desativar; o recarregamento a cada `refresh_seconds`
+    traz as mudanças feitas por outras instâncias.
+    """
+
+    def __init__(self, refresh_seconds: float = Config.SILENT_MODE_REFRESH_SECONDS,
+                 clock: Callable[[], datetime] = utcnow, monotonic: Callable[[], float] = time.monotonic):
+        self.refresh_seconds = refresh_seconds
+        self._clock = clock
+        self._monotonic = monotonic
+        self._expires: Dict[int, datetime] = {}
+        self._heap: List[Tuple[datetime, int]] = []
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._counters: Counter = Counter()
+
+    def _expire(self, now: datetime):
+        # Entradas do heap substituídas (reativação ou desativação) são descartadas quando chegam ao topo
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, conversation_id = heapq.heappop(self._heap)
+            if self._expires.get(conversation_id) == expires_at:
+                del self._expires[conversation_id]
+                self._counters['expirations'] += 1
+
+    def is_silent(self, conversation_id: int) -> bool:
+        with self._lock:
+            self._expire(self._clock())
+            silent = conversation_id in self._expires
+            self._counters['checks'] += 1
+            if silent:
+                self._counters['silenced'] += 1
+            return silent
+
+    def enable(self, conversation_id: int, expires_at: datetime):
+        with self._lock:
+            self._expires[conversation_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, conversation_id))
+            self._counters['enables'] += 1
+
+    def disable(self, conversation_id: int):
+        with self._lock:
+            if self._expires.pop(conversation_id, None) is not None:
+                self._counters['disables'] += 1
+
+    def replace(self, entries: Iterable[Tuple[int, datetime]]):
+        """Substitui todas as janelas (ex: recarregadas do banco)."""
+        with self._lock:
+            self._expires = dict(entries)
+            self._heap = [(expires_at, conversation_id) for conversation_id, expires_at in self._expires.items()]
+            heapq.heapify(self._heap)
+            self._loaded_at = self._monotonic()
+            self._counters['loads'] += 1
+
+    def needs_refresh(self) -> bool:
+        with self._lock:
+            return self._loaded_at is None or self._monotonic() - self._loaded_at >= self.refresh_seconds
+
+    def load(self, db: Session):
+        """Recarrega as janelas ativas de 'silent_mode' (uma consulta agrupada por conversa)."""
+        rows = db.execute(select(SilentMode.conversation_id, func.max(SilentMode.expires_at)).where(
+            SilentMode.is_active == True, SilentMode.expires_at > self._clock()
+        ).group_by(SilentMode.conversation_id)).all()
+        self.replace((conversation_id, expires_at) for conversation_id, expires_at in rows)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats: Dict[str, float] = dict(self._counters)
+            stats['active'] = len(self._expires)
+        return stats
+
+
+# Compartilhado pelo webhook, pelo dashboard e por SilentMode.is_conversation_silent
+silent_mode_registry = SilentModeRegistry()
@@ -0,0 +1,113 @@
+import gzip
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Campos com mídia em base64 (thumbnails, payload com webhook_base64 ativo): removidos por padrão
+MEDIA_BLOB_FIELDS = frozenset({'base64', 'jpegThumbnail', 'thumbnail'})
+# Credenciais nunca vão para o arquivo de captura, nem com capture_media
+SECRET_FIELDS = frozenset({'apikey'})
+
+
+def redact_payload(value: Any, capture_media: bool = False) -> Any:
+    """Cópia do payload sem credenciais e, a menos que capture_media, sem os blobs de mídia."""
+    if isinstance(value, dict):
+        redacted = {}
+        for key, item in value.items():
+            if key in SECRET_FIELDS:
+                redacted[key] = '<redacted>'
+            elif not capture_media and key in MEDIA_BLOB_FIELDS and isinstance(item, str):
+                redacted[key] = f'<redacted {len(item)} chars>'
+            else:
+                redacted[key] = redact_payload(item, capture_media)
+        return redacted
+    if isinstance(value, list):
+        return [redact_payload(item, capture_media) for item in value]
+    return value
+
+
+class TrafficRecorder:
+    """
+    Grava as requisições recebidas pelo webhook em um arquivo JSONL comprimido com gzip
+    (um objeto por linha: {"t": epoch em segundos, "path": ..., "payload": ...}),
+    para reproduzir a carga de produção com replay_webhook.py.
+    """
+
+    def __init__(self, path: str, capture_media: bool = Config.TRAFFIC_RECORDER_CAPTURE_MEDIA):
+        self.path = path
+        self.capture_media = capture_media
+        self.recorded = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def record(self, path: str, body: bytes, received_at: Optional[float] = None):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            logger.debug(f"Requisição para {path} não é JSON; não foi gravada.")
+            return
+        line = json.dumps({
+            't': received_at if received_at is not None else time.time(),
+            'path': path,
+            'payload': redact_payload(payload, self.capture_media),
+        }, ensure_ascii=False)
+        try:
+            with self._lock:
+                if self._file is None:
+                    # Modo 'at': cada execução adiciona um novo membro gzip, que read_capture lê em sequência
+                    self._file = gzip.open(self.path, 'at', encoding='utf-8')
+                self._file.write(line + '\n')
+                self._file.flush()
+                self.recorded += 1
+        except OSError as e:
+            logger.error(f"Falha ao gravar a captura de tráfego em {self.path}: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path: str) -> Iterator[Dict[str, Any]]:
+    """Lê os registros de um arquivo gravado pelo TrafficRecorder, na ordem em que chegaram."""
+    with gzip.open(path, 'rt', encoding='utf-8') as capture:
+        for line in capture:
+            if line.strip():
+                yield json.loads(line)
+
+
+class TrafficRecorderMiddleware:
+    """
+    Middleware ASGI que grava o corpo dos POSTs para `paths`. Só observa o receive da requisição,
+    então o corpo continua disponível para a rota e a resposta não é alterada.
+    """
+
+    def __init__(self, app, recorder: TrafficRecorder, paths: Iterable[str] = ('/webhook/whatsapp',)):
+        self.app = app
+        self.recorder = recorder
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        received_at = time.time()
+        chunks = []
+
+        async def recording_receive():
+            message = await receive()
+            if message['type'] == 'http.request':
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    self.recorder.record(scope['path'], b''.join(chunks), received_at)
+            return message
+
+        await self.app(scope, recording_receive, send)
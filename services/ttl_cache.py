@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Generic, Iterable, Optional, Tuple, TypeVar
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    """
+    Mapa em processo com LRU (no máximo `max_size` chaves) e TTL por entrada, com contadores de hits,
+    misses, expirações, evictions e invalidações para as métricas. Base dos caches do webhook
+    (conversas, histórico e perfis); as subclasses que alteram o valor guardado no lugar fazem isso
+    com `_lock` adquirido (reentrante).
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, clock: Callable[[], float] = time.monotonic):
+        self.max_size = max(1, max_size)
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[K, Tuple[V, float]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._counters: Counter = Counter()
+
+    def get(self, key: K) -> Optional[V]:
+        """Valor da chave (e a marca como a mais recente), ou None se ausente ou expirada."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self._counters['misses'] += 1
+                return None
+            value, expires_at = item
+            if expires_at <= self._clock():
+                del self._entries[key]
+                self._counters['expired'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return value
+
+    def peek(self, key: K) -> Optional[V]:
+        """Valor guardado, sem contar como acesso nem verificar o TTL (atualizações no lugar)."""
+        with self._lock:
+            item = self._entries.get(key)
+            return item[0] if item is not None else None
+
+    def put_many(self, items: Iterable[Tuple[K, V]]):
+        with self._lock:
+            expires_at = self._clock() + self.ttl_seconds
+            for key, value in items:
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def put(self, key: K, value: V):
+        self.put_many([(key, value)])
+
+    def replace(self, key: K, value: V):
+        """Troca o valor de uma chave presente, mantendo a expiração; chave ausente é ignorada."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                self._entries[key] = (value, item[1])
+
+    def invalidate(self, key: K):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._counters['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats: Dict[str, float] = dict(self._counters)
+            stats['size'] = len(self._entries)
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        stats['hit_rate'] = round(stats.get('hits', 0) / lookups, 4) if lookups else 0.0
+        return stats
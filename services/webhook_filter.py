@@ -0,0 +1,104 @@
+import logging
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Eventos da Evolution API que carregam mensagens recebidas
+MESSAGE_EVENTS = frozenset({'messages.upsert'})
+
+
+class RecentIdSet:
+    """Conjunto limitado (LRU) de IDs de mensagens vistos recentemente."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, message_id: str) -> bool:
+        with self._lock:
+            if message_id in self._ids:
+                self._ids.move_to_end(message_id)
+                return True
+            return False
+
+    def add_many(self, message_ids: Iterable[str]):
+        with self._lock:
+            for message_id in message_ids:
+                self._ids[message_id] = None
+                self._ids.move_to_end(message_id)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+class WebhookFilter:
+    """
+    Filtro de entrada do webhook. Descarta, sem acessar o banco, eventos que não são mensagens,
+    mensagens enviadas por nós (fromMe), status/broadcast, números ignorados e reentregas
+    de mensagens já aceitas recentemente.
+    """
+
+    def __init__(self, max_seen_ids: int = Config.WEBHOOK_DEDUPE_CACHE_SIZE,
+                 ignore_numbers: Iterable[str] = Config.IGNORE_LIST_NUMBERS):
+        self.ignore_numbers = frozenset(ignore_numbers)
+        self._seen_ids = RecentIdSet(max_seen_ids)
+        self._counters: Counter = Counter()
+        self._counters_lock = threading.Lock()
+
+    def is_message_event(self, data: Dict[str, Any]) -> bool:
+        """True se o payload é um evento de mensagem (formato novo) ou o formato antigo 'entry/changes'."""
+        if data.get('event') in MESSAGE_EVENTS or 'entry' in data:
+            return True
+        self._count('unknown_event')
+        return False
+
+    @staticmethod
+    def message_id_of(message_data: Dict[str, Any]) -> Optional[str]:
+        if 'key' in message_data:
+            return (message_data.get('key') or {}).get('id')
+        return message_data.get('id')
+
+    def rejection_reason(self, message_data: Dict[str, Any]) -> Optional[str]:
+        """Retorna o motivo para descartar a mensagem, ou None se ela deve ser processada."""
+        message_id = self.message_id_of(message_data)
+        if 'key' in message_data:
+            key = message_data.get('key') or {}
+            remote_jid = key.get('remoteJid') or ''
+            if key.get('fromMe'):
+                return self._count('from_me')
+            if remote_jid.endswith('@broadcast'):
+                return self._count('status')
+            from_number = remote_jid.split('@')[0]
+        else:
+            from_number = message_data.get('from')
+
+        if not message_id or not from_number:
+            return self._count('malformed')
+        if from_number in self.ignore_numbers:
+            return self._count('ignored_number')
+        if message_id in self._seen_ids:
+            return self._count('duplicate')
+        return None
+
+    def remember(self, message_ids: List[str]):
+        """Registra IDs aceitos; chamado só depois que as mensagens foram persistidas com sucesso."""
+        self._seen_ids.add_many(message_id for message_id in message_ids if message_id)
+        self._count('accepted', len(message_ids))
+
+    def stats(self) -> Dict[str, int]:
+        with self._counters_lock:
+            stats = dict(self._counters)
+        stats['seen_ids_cached'] = len(self._seen_ids)
+        return stats
+
+    def _count(self, reason: str, amount: int = 1) -> str:
+        with self._counters_lock:
+            self._counters[reason] += amount
+        return reason
@@ -1,3 +1,5 @@
+import asyncio
+import httpx
 import requests
 import logging
 from typing import Dict, Any, Optional
@@ -62,6 +64,19 @@ class WhatsAppService:
         self.media_download_headers = {
             # 'apikey': self.api_key, # A Evolution API pode gerar URLs que não precisam disso
         }
+        # Cliente HTTP assíncrono compartilhado (pool de conexões keep-alive), criado no primeiro uso
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(timeout=Config.HTTP_CLIENT_TIMEOUT_SECONDS)
+        return self._async_client
+
+    async def aclose(self):
+        """Fecha o cliente HTTP assíncrono (chamado no shutdown do pipeline asyncio)."""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
     
     def _get_full_url(self, endpoint: str) -> str:
         """Constructs full URL including schema if not present in server_url."""
@@ -70,8 +85,8 @@ class WhatsAppService:
         # Assumir https como padrão se nenhum esquema for fornecido
         return f"https://{self.server_url}{endpoint}"
     
-    def send_text_message(self, to_number: str, text: str, delay: int = 1200, quoted_message_id: Optional[str] = None) -> Optional[str]:
-        """Send a text message via the Evolution API."""
+    def _build_text_message_request(self, to_number: str, text: str, delay: int, quoted_message_id: Optional[str]) -> tuple:
+        """Monta (url, payload) do envio de texto; compartilhado pelas versões síncrona e assíncrona."""
         # Endpoint para Evolution API: /message/sendText/{instanceName}
         # Nota: O URL base auto-adiciona http/https se não estiver presente.
         # O exemplo original tinha 'https://' + server_url, o que pode causar https://http://...
@@ -100,34 +115,44 @@ class WhatsAppService:
                  "remoteJid": to_number_jid
             }
             # TODO: Validar se a estrutura de citação acima está correta para esta versão da API.
+        return url, payload
 
+    def _parse_send_response(self, to_number: str, response) -> Optional[str]:
+        """
+        Extrai o message_id da resposta do envio. Aceita respostas do requests ou do httpx
+        (mesma interface: status_code, json(), text, raise_for_status()).
+        """
+        # Verificar o conteúdo da resposta, mesmo se o status não for de erro
+        response_data = {}
         try:
-            logger.debug(f"Sending text message to {to_number}. URL: {url}, Payload: {payload}")
-            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
-            
-            # Verificar o conteúdo da resposta, mesmo se o status não for de erro
-            response_data = {}
-            try:
-                response_data = response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON from response. Status: {response.status_code}, Body: {response.text}")
-                # Se não for possível decodificar, lançar o erro original do status
-                response.raise_for_status()
-                return None # Fallback
+            response_data = response.json()
+        except json.JSONDecodeError:
+            logger.error(f"Failed to decode JSON from response. Status: {response.status_code}, Body: {response.text}")
+            # Se não for possível decodificar, lançar o erro original do status
+            response.raise_for_status()
+            return None # Fallback
 
-            # Checar por status de erro dentro da resposta JSON
-            if response.status_code >= 400 or response_data.get('status') == 'error':
-                 logger.error(f"Error from Evolution API. Status: {response.status_code}, Response: {response_data}")
-                 # Lançar um erro para ser pego pelo bloco except abaixo
-                 response.raise_for_status()
+        # Checar por status de erro dentro da resposta JSON
+        if response.status_code >= 400 or response_data.get('status') == 'error':
+             logger.error(f"Error from Evolution API. Status: {response.status_code}, Response: {response_data}")
+             # Lançar um erro para ser pego pelo bloco except de quem chamou
+             response.raise_for_status()
 
-            message_id = response_data.get('key', {}).get('id')
-            
-            if message_id:
-                logger.info(f"Text message sent successfully to {to_number}, message_id: {message_id}")
-            else:
-                logger.warning(f"Text message sent to {to_number}, but no message_id was found in the response: {response_data}")
-            return message_id
+        message_id = response_data.get('key', {}).get('id')
+        
+        if message_id:
+            logger.info(f"Text message sent successfully to {to_number}, message_id: {message_id}")
+        else:
+            logger.warning(f"Text message sent to {to_number}, but no message_id was found in the response: {response_data}")
+        return message_id
+
+    def send_text_message(self, to_number: str, text: str, delay: int = 1200, quoted_message_id: Optional[str] = None) -> Optional[str]:
+        """Send a text message via the Evolution API."""
+        url, payload = self._build_text_message_request(to_number, text, delay, quoted_message_id)
+        try:
+            logger.debug(f"Sending text message to {to_number}. URL: {url}, Payload: {payload}")
+            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
+            return self._parse_send_response(to_number, response)
             
         except requests.exceptions.RequestException as e:
             # Este log agora será mais detalhado, incluindo a resposta da API se disponível
@@ -139,23 +164,33 @@ class WhatsAppService:
         except Exception as e:
             logger.error(f"Unexpected error sending text message to {to_number}: {str(e)}", exc_info=True)
             return None
+
+    async def send_text_message_async(self, to_number: str, text: str, delay: int = 1200, quoted_message_id: Optional[str] = None) -> Optional[str]:
+        """Versão assíncrona de send_text_message (httpx.AsyncClient, não bloqueia o event loop)."""
+        url, payload = self._build_text_message_request(to_number, text, delay, quoted_message_id)
+        try:
+            logger.debug(f"Sending text message to {to_number}. URL: {url}, Payload: {payload}")
+            response = await self._get_async_client().post(url, json=payload, headers=self.headers)
+            return self._parse_send_response(to_number, response)
+        except httpx.HTTPStatusError as e:
+            logger.error(f"Failed to send text message to {to_number}: Status: {e.response.status_code}, Response: {e.response.text}")
+            return None
+        except httpx.HTTPError as e:
+            logger.error(f"Failed to send text message to {to_number}: {str(e)}")
+            return None
+        except Exception as e:
+            logger.error(f"Unexpected error sending text message to {to_number}: {str(e)}", exc_info=True)
+            return None
     
     def download_media(self, media_url: str, media_key_b64: str, original_message_type: str) -> Optional[bytes]:
         """
         Downloads and decrypts media from Evolution API.
         original_message_type é o tipo da mensagem como vem no webhook (ex: 'imageMessage', 'audioMessage')
         """
-        if not media_url or not media_key_b64 or not original_message_type:
-            logger.error("media_url, media_key_b64, and original_message_type are required for download and decryption.")
+        app_info_bytes = self._media_app_info(media_url, media_key_b64, original_message_type)
+        if not app_info_bytes:
             return None
 
-        app_info_str = MEDIA_TYPE_APP_INFO.get(original_message_type)
-        if not app_info_str:
-            logger.error(f"Unsupported media type for decryption app_info: {original_message_type}")
-            return None
-    
-        app_info_bytes = app_info_str.encode('utf-8')
-
         try:
             logger.info(f"Downloading .enc file from: {media_url}")
             # Usar self.media_download_headers (que pode ser vazio ou ter apikey)
@@ -163,49 +198,88 @@ class WhatsAppService:
             enc_response.raise_for_status()
             encrypted_data = enc_response.content
             logger.info(f"Downloaded .enc file, size: {len(encrypted_data)} bytes")
-
-            media_key_bytes = base64.b64decode(media_key_b64)
+            return self._decrypt_media(encrypted_data, media_key_b64, app_info_bytes, media_url)
             
-            # Derivar chaves usando HKDF da biblioteca pycryptodome para maior robustez.
-            media_key_expanded = HKDF(
-                master=media_key_bytes,
-                key_len=80,
-                salt=b'',
-                hashmod=SHA256,
-                context=app_info_bytes
-            )
-
-            # Separar as chaves: IV, Chave de Cifra e Chave de MAC
-            iv = media_key_expanded[:16]
-            cipher_key = media_key_expanded[16:48]
-            mac_key = media_key_expanded[48:80]
-            
-            # Separar o arquivo em conteúdo cifrado e MAC (assinatura)
-            file_content_to_decrypt = encrypted_data[:-10]
-            mac_from_file = encrypted_data[-10:]
-
-            # Validar o MAC antes de tentar descriptografar
-            if not _validate_mac(mac_key, iv + file_content_to_decrypt, mac_from_file):
-                error_msg = "MAC validation failed. File may be corrupted or decryption keys are incorrect."
-                logger.error(error_msg)
-                raise Exception(error_msg)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to download .enc file from {media_url}: {str(e)}")
+            return None
+        except Exception as e:
+            logger.error(f"Failed to download or decrypt media (URL: {media_url}): {str(e)}", exc_info=True)
+            return None
 
-            logger.info("MAC validation successful.")
+    async def download_media_async(self, media_url: str, media_key_b64: str, original_message_type: str) -> Optional[bytes]:
+        """
+        Versão assíncrona de download_media: o download usa httpx e a descriptografia (CPU)
+        roda em uma thread, para não travar o event loop com arquivos grandes.
+        """
+        app_info_bytes = self._media_app_info(media_url, media_key_b64, original_message_type)
+        if not app_info_bytes:
+            return None
 
-            decrypted_bytes = _aes_decrypt(cipher_key, file_content_to_decrypt, iv)
-            
-            if not decrypted_bytes:
-                logger.warning(f"Decryption resulted in empty bytes for media from {media_url}. This may indicate a decryption key/logic issue.")
+        try:
+            logger.info(f"Downloading .enc file from: {media_url}")
+            enc_response = await self._get_async_client().get(media_url, headers=self.media_download_headers)
+            enc_response.raise_for_status()
+            encrypted_data = enc_response.content
+            logger.info(f"Downloaded .enc file, size: {len(encrypted_data)} bytes")
+            return await asyncio.to_thread(self._decrypt_media, encrypted_data, media_key_b64, app_info_bytes, media_url)
 
-            logger.info(f"Media decrypted successfully. Decrypted size: {len(decrypted_bytes)}")
-            return decrypted_bytes
-            
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Failed to download .enc file from {media_url}: {str(e)}")
             return None
         except Exception as e:
             logger.error(f"Failed to download or decrypt media (URL: {media_url}): {str(e)}", exc_info=True)
             return None
+
+    def _media_app_info(self, media_url: str, media_key_b64: str, original_message_type: str) -> Optional[bytes]:
+        """Valida os parâmetros do download e retorna o app_info da HKDF para o tipo de mídia."""
+        if not media_url or not media_key_b64 or not original_message_type:
+            logger.error("media_url, media_key_b64, and original_message_type are required for download and decryption.")
+            return None
+
+        app_info_str = MEDIA_TYPE_APP_INFO.get(original_message_type)
+        if not app_info_str:
+            logger.error(f"Unsupported media type for decryption app_info: {original_message_type}")
+            return None
+        return app_info_str.encode('utf-8')
+
+    def _decrypt_media(self, encrypted_data: bytes, media_key_b64: str, app_info_bytes: bytes, media_url: str) -> bytes:
+        """Valida o MAC e descriptografa o arquivo .enc baixado do WhatsApp."""
+        media_key_bytes = base64.b64decode(media_key_b64)
+        
+        # Derivar chaves usando HKDF da biblioteca pycryptodome para maior robustez.
+        media_key_expanded = HKDF(
+            master=media_key_bytes,
+            key_len=80,
+            salt=b'',
+            hashmod=SHA256,
+            context=app_info_bytes
+        )
+
+        # Separar as chaves: IV, Chave de Cifra e Chave de MAC
+        iv = media_key_expanded[:16]
+        cipher_key = media_key_expanded[16:48]
+        mac_key = media_key_expanded[48:80]
+        
+        # Separar o arquivo em conteúdo cifrado e MAC (assinatura)
+        file_content_to_decrypt = encrypted_data[:-10]
+        mac_from_file = encrypted_data[-10:]
+
+        # Validar o MAC antes de tentar descriptografar
+        if not _validate_mac(mac_key, iv + file_content_to_decrypt, mac_from_file):
+            error_msg = "MAC validation failed. File may be corrupted or decryption keys are incorrect."
+            logger.error(error_msg)
+            raise Exception(error_msg)
+
+        logger.info("MAC validation successful.")
+
+        decrypted_bytes = _aes_decrypt(cipher_key, file_content_to_decrypt, iv)
+        
+        if not decrypted_bytes:
+            logger.warning(f"Decryption resulted in empty bytes for media from {media_url}. This may indicate a decryption key/logic issue.")
+
+        logger.info(f"Media decrypted successfully. Decrypted size: {len(decrypted_bytes)}")
+        return decrypted_bytes
     
     def send_media_message(self, to_number: str, media_type: str, media_url_or_path: str, caption: Optional[str] = None, filename: Optional[str] = None) -> Optional[str]:
         """
@@ -149,7 +149,7 @@ class WhatsAppDashboard {
 
     async refreshDashboardStats() {
         try {
-            const response = await fetch('/api/stats');
+            const response = await fetch('/dashboard/api/stats');
             const data = await response.json();
             
             if (data.error) {
@@ -236,7 +236,7 @@ class WhatsAppDashboard {
         if (!conversationId) return;
 
         try {
-            const response = await fetch(`/api/conversation/${conversationId}/messages?per_page=50`);
+            const response = await fetch(`/dashboard/api/conversation/${conversationId}/messages?per_page=50`);
             const data = await response.json();
             
             if (data.error) {
@@ -292,7 +292,7 @@ class WhatsAppDashboard {
         }
 
         try {
-            const response = await fetch(`/api/conversations?search=${encodeURIComponent(query)}&per_page=10`);
+            const response = await fetch(`/dashboard/api/search?q=${encodeURIComponent(query)}&limit=10`);
             const data = await response.json();
             
             if (data.error) {
@@ -317,7 +317,8 @@ class WhatsAppDashboard {
                 <div class="d-flex justify-content-between align-items-start">
                     <div>
                         <h6 class="mb-1">${conv.contact_name || 'Unknown'}</h6>
-                        <p class="mb-1 text-muted small">${conv.phone_number}</p>
+                        <p class="mb-1 text-muted small">${conv.user_phone}</p>
+                        ${conv.snippet_html ? `<p class="mb-1 small">${conv.snippet_html}</p>` : ''}
                         <small class="text-muted">${conv.message_count} messages</small>
                     </div>
                     <div>
@@ -390,7 +391,7 @@ class WhatsAppDashboard {
 
     async retryMessage(messageId) {
         try {
-            const response = await fetch(`/api/message/${messageId}/retry`, {
+            const response = await fetch(`/dashboard/api/message/${messageId}/retry`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
@@ -412,7 +413,7 @@ class WhatsAppDashboard {
 
     async regenerateResponse(messageId) {
         try {
-            const response = await fetch(`/api/message/${messageId}/regenerate`, {
+            const response = await fetch(`/dashboard/api/message/${messageId}/regenerate`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
@@ -1,10 +1,18 @@
+from datetime import datetime, timedelta
+
 import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import NullPool
 
+import routes.dashboard as dashboard
 from app import app # Your FastAPI app instance
-from database_session import Base, get_db # Your SQLAlchemy Base and dependency
+from database_session import Base, get_db, get_async_db, make_async_sessionmaker # Your SQLAlchemy Base and dependencies
+from models import AIResponse, Conversation, MediaFile, Message
+from services.conversation_stats import record_conversation_messages
 
 # Use an in-memory SQLite database for testing
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -17,6 +25,9 @@ engine = create_engine(
     } # Needed for SQLite
 )
 SessionTesting = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Rotas async, mesmo banco. NullPool: cada TestClient roda em um event loop novo
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+AsyncSessionTesting = make_async_sessionmaker(async_engine)
 
 @pytest.fixture(name="db_session")
 def db_session_fixture():
@@ -38,7 +49,83 @@ def client_fixture(db_session: Session):
         finally:
             db_session.close()
             
+    async def override_get_async_db():
+        async with AsyncSessionTesting() as async_db:
+            yield async_db
+
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
     with TestClient(app) as client:
         yield client
-    app.dependency_overrides.clear() # Clear overrides after test 
\ No newline at end of file
+    app.dependency_overrides.clear() # Clear overrides after test
+
+
+# Bancos SQLite em arquivo por teste (tmp_path), para os testes que montam só o router do dashboard
+SEED_TIME = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def create_test_database(path):
+    """Engine síncrona de um banco SQLite em `path`, com todas as tabelas (quem chama faz o dispose)."""
+    test_engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=test_engine)
+    return test_engine
+
+
+def create_test_async_engine(path):
+    # NullPool: cada TestClient/asyncio.run roda em um event loop novo
+    return create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=NullPool)
+
+
+def add_messages(db, conversation, contents, timestamps=None, with_responses=False, media=(), media_paths=None):
+    """
+    Grava uma mensagem por item de `contents`, um minuto depois da outra a partir de SEED_TIME (ou em
+    `timestamps`), com uma resposta da IA cada (with_responses) e mídia nas posições em `media` ou em
+    `media_paths` (posição -> caminho no bucket), e atualiza as estatísticas da conversa como a ingestão.
+    Respostas e mídias têm o horário da mensagem.
+    """
+    timestamps = timestamps or [SEED_TIME + timedelta(minutes=index) for index in range(len(contents))]
+    media_paths = media_paths or {}
+    messages = []
+    for index, (content, timestamp) in enumerate(zip(contents, timestamps)):
+        has_media = index in media or index in media_paths
+        message = Message(conversation_id=conversation.id, whatsapp_message_id=f"{conversation.id}-{timestamp.isoformat()}",
+                          sender_phone=conversation.user_phone, message_type='image' if has_media else 'text',
+                          content=content, timestamp=timestamp)
+        if with_responses:
+            message.ai_responses.append(AIResponse(agent_name='agent', response_content=f"resposta: {content}", created_at=timestamp))
+        if has_media:
+            path = media_paths.get(index, f"media/{conversation.id}/{timestamp:%Y%m%d%H%M}.jpg")
+            message.media_files.append(MediaFile(original_url='http://example.com/a.jpg', cloud_storage_bucket='bucket',
+                                                 cloud_storage_path=path, file_name=f"{index}.jpg", uploaded_at=timestamp))
+        messages.append(message)
+    db.add_all(messages)
+    db.flush()
+    record_conversation_messages(db, messages)
+    db.commit()
+    return messages
+
+
+def add_conversation(db, user_phone, contents=(), contact_name=None, **message_options):
+    """Conversa com as mensagens de add_messages; retorna o ID."""
+    conversation = Conversation(user_phone=user_phone, contact_name=contact_name)
+    db.add(conversation)
+    db.flush()
+    add_messages(db, conversation, list(contents), **message_options)
+    return conversation.id
+
+
+@pytest.fixture(name="dashboard_client_for")
+def dashboard_client_for_fixture():
+    """TestClient de um app só com o router do dashboard, com get_async_db na engine asyncio dada."""
+    def make_client(async_db_engine):
+        session_factory = make_async_sessionmaker(async_db_engine)
+
+        async def override_get_async_db():
+            async with session_factory() as async_db:
+                yield async_db
+
+        dashboard_app = FastAPI()
+        dashboard_app.include_router(dashboard.router, prefix="/dashboard")
+        dashboard_app.dependency_overrides[get_async_db] = override_get_async_db
+        return TestClient(dashboard_app)
+    return make_client
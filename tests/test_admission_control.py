@@ -0,0 +1,33 @@
+from services.admission_control import AdmissionController, LoadLevel
+
+
+def make_controller(pending):
+    return AdmissionController(lambda: pending['count'], degraded_high_water=10, busy_high_water=20, reject_high_water=30)
+
+
+def test_levels_follow_high_water_marks():
+    pending = {'count': 0}
+    controller = make_controller(pending)
+    assert controller.level() == LoadLevel.NORMAL
+    pending['count'] = 10
+    assert controller.level() == LoadLevel.DEGRADED
+    pending['count'] = 25
+    assert controller.level() == LoadLevel.BUSY
+    assert controller.level(incoming=5) == LoadLevel.REJECT
+
+
+def test_admit_rejects_above_reject_mark_and_counts():
+    pending = {'count': 28}
+    controller = make_controller(pending)
+    assert controller.admit(1)
+    assert not controller.admit(2)
+    stats = controller.stats()
+    assert stats['rejected'] == 2
+    assert stats['pending_work'] == 28
+    assert stats['level'] == 'busy'
+
+
+def test_zero_high_water_disables_level():
+    controller = AdmissionController(lambda: 1000, degraded_high_water=0, busy_high_water=0, reject_high_water=0)
+    assert controller.level() == LoadLevel.NORMAL
+    assert controller.admit(100)
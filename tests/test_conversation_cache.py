@@ -0,0 +1,76 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from conftest import add_conversation, create_test_database
+from models import Conversation
+from services.conversation_cache import CachedConversation, ConversationCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def entry(conversation_id):
+    return CachedConversation(conversation_id, f"Cliente {conversation_id}", True)
+
+
+def test_hits_misses_and_ttl_expiry():
+    clock = FakeClock()
+    cache = ConversationCache(max_size=10, ttl_seconds=60, clock=clock)
+    assert cache.get('5511') is None
+    cache.put('5511', entry(1))
+    assert cache.get('5511') == entry(1)
+    clock.now = 61
+    assert cache.get('5511') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['expired'], stats['size']) == (1, 2, 1, 0)
+    assert stats['hit_rate'] == round(1 / 3, 4)
+
+
+def test_evicts_least_recently_used():
+    cache = ConversationCache(max_size=2, ttl_seconds=60, clock=FakeClock())
+    cache.put_many([('a', entry(1)), ('b', entry(2))])
+    cache.get('a')  # 'b' passa a ser o menos usado
+    cache.put('c', entry(3))
+    assert cache.get('b') is None
+    assert cache.get('a') == entry(1) and cache.get('c') == entry(3)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_invalidate_removes_entry():
+    cache = ConversationCache(max_size=10, ttl_seconds=60, clock=FakeClock())
+    cache.put('5511', entry(1))
+    cache.invalidate('5511')
+    cache.invalidate('5599')  # Ausente: não conta
+    assert cache.get('5511') is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_find_conversation_hit_skips_select(tmp_path, monkeypatch):
+    import routes.webhook as webhook
+
+    test_engine = create_test_database(tmp_path / 'cache.db')
+    db = Session(bind=test_engine, autoflush=False)
+    conversation_id = add_conversation(db, '5511911110001')
+
+    cache = ConversationCache(max_size=10, ttl_seconds=60)
+    cache.put('5511911110001', CachedConversation(conversation_id, None, True))
+    monkeypatch.setattr(webhook, 'conversation_cache', cache)
+    db.expunge_all()
+
+    statements = []
+    event.listen(test_engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    found = webhook.find_conversation(db, '5511911110001')
+    assert found.id == conversation_id
+    assert not any(statement.lstrip().upper().startswith('SELECT') for statement in statements)
+
+    # A entrada do cache continua sendo uma conversa persistente: alterações viram UPDATE
+    found.contact_name = 'Ana'
+    db.commit()
+    assert db.query(Conversation).filter_by(user_phone='5511911110001').one().contact_name == 'Ana'
+    db.close()
+    test_engine.dispose()
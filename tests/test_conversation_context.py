@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from database_session import Base
+from models import Conversation, Message, Order, UserProfile
+from services.conversation_context import load_conversation_context
+
+BASE_TIME = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def test_context_is_loaded_in_one_statement(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'context.db'}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autoflush=False, bind=engine)()
+    conversation = Conversation(user_phone='5511911110001')
+    db.add(conversation)
+    db.flush()
+    db.add(UserProfile(conversation_id=conversation.id, profile_data={'nome': 'Ana'}))
+    db.add_all([
+        Order(conversation_id=conversation.id, order_details={'total': 10}, created_at=BASE_TIME),
+        Order(conversation_id=conversation.id, order_details={'total': 20}, created_at=BASE_TIME + timedelta(days=1)),
+        Order(conversation_id=conversation.id, order_details={'total': 30}, status='pending', created_at=BASE_TIME + timedelta(days=2)),
+    ])
+    for index, (message_type, content) in enumerate([('text', 'oi'), ('location', '{"latitude": 1, "longitude": 2}'), ('text', 'Rua X')]):
+        db.add(Message(conversation_id=conversation.id, whatsapp_message_id=f"m{index}", sender_phone='5511911110001',
+                       message_type=message_type, content=content, timestamp=BASE_TIME + timedelta(minutes=index)))
+    conversation_id = conversation.id
+    db.commit()
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    history = [{'sender_type': 'user', 'message_text': str(index)} for index in range(15)]
+    context = load_conversation_context(db, conversation_id, BASE_TIME + timedelta(minutes=2), history)
+
+    assert len(statements) == 1
+    assert context.profile_data == {'nome': 'Ana'}
+    assert context.last_order_data == {'total': 20}
+    assert (context.previous_message_type, context.previous_message_content) == ('location', '{"latitude": 1, "longitude": 2}')
+    assert context.order_history == history and context.conversation_history == history[-10:]
+
+    empty = load_conversation_context(db, conversation_id, BASE_TIME, [])
+    assert (empty.previous_message_type, empty.previous_message_content) == (None, None)
+    db.close()
@@ -0,0 +1,59 @@
+from datetime import timedelta, timezone
+
+from sqlalchemy.orm import Session
+
+from conftest import SEED_TIME, add_conversation, create_test_database
+from services.conversation_history import ConversationHistoryBuffer, HistoryEntry
+
+
+def entry(message_id, minutes, content=None):
+    return HistoryEntry(message_id, SEED_TIME + timedelta(minutes=minutes), True, content or f"msg {message_id}")
+
+
+def test_ring_buffer_keeps_last_window_in_order():
+    buffer = ConversationHistoryBuffer(window=3, max_conversations=10, ttl_seconds=60)
+    assert buffer.get(1) is None
+    buffer.put(1, [entry(1, 1), entry(2, 2)])
+    buffer.append_many([(1, entry(3, 3)), (1, entry(4, 4)), (2, entry(5, 5))])  # Conversa 2 não está carregada
+    assert [e.message_id for e in buffer.get(1)] == [2, 3, 4]
+    assert buffer.get(2) is None
+
+    # Entrega atrasada: entra na posição do timestamp e a janela continua com as 3 mais recentes
+    buffer.append_many([(1, entry(6, 3.5))])
+    assert [e.message_id for e in buffer.get(1)] == [3, 6, 4]
+    buffer.append_many([(1, entry(7, 0))])
+    assert [e.message_id for e in buffer.get(1)] == [3, 6, 4]
+
+
+def test_update_content_and_lru_eviction():
+    buffer = ConversationHistoryBuffer(window=5, max_conversations=1, ttl_seconds=60)
+    buffer.put(1, [entry(1, 1, '[audio]')])
+    buffer.update_content(1, 1, 'transcrição')
+    assert buffer.get(1)[0].as_prompt_item() == {'sender_type': 'user', 'message_text': 'transcrição'}
+    buffer.put(2, [entry(2, 1)])
+    assert buffer.get(1) is None
+    assert buffer.stats()['evictions'] == 1
+
+
+def test_get_conversation_history_matches_full_scan(tmp_path, monkeypatch):
+    import routes.webhook as webhook
+
+    test_engine = create_test_database(tmp_path / 'history.db')
+    db = Session(bind=test_engine, autoflush=False)
+    # Timestamps fora da ordem de inserção e com e sem fuso, como chegam do webhook
+    minutes = [5, 1, 30, 2, 25, 8, 13, 21, 3, 34, 55, 40]
+    timestamps = [SEED_TIME + timedelta(minutes=minute) for minute in minutes]
+    conversation_id = add_conversation(db, '5511911110001', [f"msg {minute}" for minute in minutes],
+                                       timestamps=[timestamp.replace(tzinfo=timezone.utc) if index % 2 else timestamp
+                                                   for index, timestamp in enumerate(timestamps)])
+
+    monkeypatch.setattr(webhook, 'history_buffer', ConversationHistoryBuffer(window=5, max_conversations=10, ttl_seconds=60))
+    full_scan = [f"msg {minute}" for minute in sorted(minutes)]
+    assert [item['message_text'] for item in webhook.get_conversation_history(db, conversation_id, limit=3)] == full_scan[-3:]
+    assert [item['message_text'] for item in webhook.get_conversation_history(db, conversation_id, limit=5)] == full_scan[-5:]
+    # Maior que a janela: vai direto ao banco
+    assert [item['message_text'] for item in webhook.get_conversation_history(db, conversation_id, limit=8)] == full_scan[-8:]
+    stats = webhook.history_buffer.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+    db.close()
+    test_engine.dispose()
@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from sqlalchemy import create_engine, inspect, select, text, update
+from sqlalchemy.orm import Session
+
+from conftest import SEED_TIME, add_messages, create_test_database
+from models import Conversation
+from services.conversation_stats import backfill_conversation_stats, upgrade_conversation_stats_schema
+
+
+def add_messages_at(db, conversation, *minutes):
+    add_messages(db, conversation, [f"mensagem {minute}" for minute in minutes],
+                 timestamps=[SEED_TIME + timedelta(minutes=minute) for minute in minutes])
+
+
+def test_stats_are_maintained_on_write_and_match_the_backfill(tmp_path):
+    test_engine = create_test_database(tmp_path / 'stats.db')
+    db = Session(bind=test_engine, autoflush=False)
+    first, second = Conversation(user_phone='5511911110001'), Conversation(user_phone='5511911110002')
+    db.add_all([first, second])
+    db.flush()
+
+    add_messages_at(db, first, 1, 5)
+    add_messages_at(db, first, 3)  # Entrega fora de ordem: conta, mas não vira a última mensagem
+    db.commit()
+    assert (first.message_count, first.last_message_at, first.last_message_preview) == (3, SEED_TIME + timedelta(minutes=5), 'mensagem 5')
+    assert (second.message_count, second.last_message_at) == (0, None)
+
+    stats = select(Conversation.id, Conversation.message_count, Conversation.last_message_at,
+                   Conversation.last_message_preview).order_by(Conversation.id)
+    written = db.execute(stats).all()
+    db.execute(update(Conversation).values(message_count=0, last_message_at=None, last_message_preview=None))
+    db.commit()
+    updated_at = db.scalars(select(Conversation.updated_at).order_by(Conversation.id)).all()
+    assert backfill_conversation_stats(db, batch_size=1) == 2
+    assert db.execute(stats).all() == written
+    assert db.scalars(select(Conversation.updated_at).order_by(Conversation.id)).all() == updated_at
+    db.close()
+    test_engine.dispose()
+
+
+def test_upgrade_adds_columns_and_index_to_an_existing_table(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE conversations (id INTEGER PRIMARY KEY, created_at DATETIME, updated_at DATETIME, "
+                                "user_phone VARCHAR(20) NOT NULL, contact_name VARCHAR(100), is_active BOOLEAN)"))
+        connection.execute(text("INSERT INTO conversations (user_phone) VALUES ('5511911110001')"))
+
+    assert upgrade_conversation_stats_schema(engine) == ['message_count', 'last_message_at', 'last_message_preview']
+    assert upgrade_conversation_stats_schema(engine) == []
+    assert 'idx_conversations_last_message' in {index['name'] for index in inspect(engine).get_indexes('conversations')}
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT message_count FROM conversations")).scalar() == 0
@@ -67,7 +67,7 @@ def test_api_conversations(client: TestClient, db_session: Session):
     db_session.add_all([conv1, conv2])
     db_session.commit()
 
-    response = client.get("/dashboard/api/conversations")
+    response = client.get("/dashboard/api/conversations?include_total=true")
     assert response.status_code == 200
     data = response.json()
     assert len(data['conversations']) >= 2
@@ -104,18 +104,20 @@ def test_api_conversation_messages(client: TestClient, db_session: Session):
 
 def test_api_stats(client: TestClient, db_session: Session):
     conv = Conversation(user_phone="88888")
+    db_session.add(conv)
+    db_session.commit()
     msg_text = Message(conversation_id=conv.id, whatsapp_message_id="stat_msg_text", sender_phone="88888", message_type="text", content="Stat text", processed=True)
     msg_img = Message(conversation_id=conv.id, whatsapp_message_id="stat_msg_img", sender_phone="88888", message_type="image", content="", processed=True)
-    ai_resp = AIResponse(message_id=msg_text.id, agent_name="TestAI", response_content="AI response", sent_to_whatsapp=True)
+    msg_text.ai_responses.append(AIResponse(agent_name="TestAI", response_content="AI response", sent_to_whatsapp=True))
 
-    db_session.add_all([conv, msg_text, msg_img, ai_resp])
+    db_session.add_all([msg_text, msg_img])
     db_session.commit()
 
     response = client.get("/dashboard/api/stats")
     assert response.status_code == 200
     data = response.json()
-    assert data['totals']['total_conversations'] >= 1
-    assert data['totals']['total_messages'] >= 2
+    assert data['totals']['conversations'] >= 1
+    assert data['totals']['messages'] >= 2
     assert data['message_types']['text'] >= 1
 
 # Mocking AIService for summary generation
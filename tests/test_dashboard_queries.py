@@ -0,0 +1,57 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import routes.dashboard as dashboard
+from conftest import add_conversation, create_test_async_engine, create_test_database
+
+
+@pytest.fixture(name="dashboard_client")
+def dashboard_client_fixture(tmp_path, dashboard_client_for):
+    database_path = tmp_path / 'dashboard.db'
+    engine = create_test_database(database_path)
+    with sessionmaker(bind=engine)() as db:
+        # Todas as mensagens com resposta da IA; mídia em uma a cada duas
+        conversation_ids = tuple(add_conversation(db, user_phone, [f"mensagem {index}" for index in range(count)],
+                                                  with_responses=True, media=range(1, count, 2))
+                                 for user_phone, count in (('5511911110001', 3), ('5511911110002', 30)))
+    engine.dispose()
+
+    async_engine = create_test_async_engine(database_path)
+    statements = []
+    event.listen(async_engine.sync_engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    with dashboard_client_for(async_engine) as client:
+        yield client, conversation_ids, statements
+
+
+def test_conversation_messages_api_uses_a_constant_number_of_queries(dashboard_client):
+    client, (small, large), statements = dashboard_client
+    counts = []
+    for conversation_id in (small, large):
+        statements.clear()
+        response = client.get(f"/dashboard/api/conversation/{conversation_id}/messages", params={'per_page': 50})
+        assert response.status_code == 200
+        counts.append(len(statements))
+        messages = response.json()['messages']
+        assert all(len(message['ai_responses']) == 1 for message in messages)
+        assert all(('media_file' in message) == (message['message_type'] == 'image') for message in messages)
+
+    assert len(response.json()['messages']) == 30
+    assert counts[0] == counts[1]
+
+
+def test_conversation_detail_uses_a_constant_number_of_queries(dashboard_client, monkeypatch):
+    client, (small, large), statements = dashboard_client
+    rendered = []
+    monkeypatch.setattr(dashboard.templates, 'TemplateResponse', lambda request, name, context: rendered.append(context) or '')
+    counts = []
+    for conversation_id in (small, large):
+        statements.clear()
+        assert client.get(f"/dashboard/conversation/{conversation_id}").status_code == 200
+        counts.append(len(statements))
+
+    context = rendered[-1]
+    assert len(context['messages']) == 30
+    assert all(len(responses) == 1 for responses in context['message_responses'].values())
+    assert len(context['message_media']) == 15 and all(context['message_media'].values())
+    assert counts[0] == counts[1]
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from conftest import create_test_async_engine, create_test_database
+from database_session import make_async_sessionmaker
+from models import AIResponse, Conversation, MediaFile, Message
+from services.dashboard_stats import DashboardStatsCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def seed(database_path):
+    engine = create_test_database(database_path)
+    with sessionmaker(bind=engine)() as db:
+        conversation = Conversation(user_phone='5511911110001')
+        db.add_all([conversation, Conversation(user_phone='5511911110002', is_active=False)])
+        db.flush()
+        for index, (message_type, processed, error) in enumerate([('text', True, None), ('text', False, 'falhou'), ('image', True, None)]):
+            message = Message(conversation_id=conversation.id, whatsapp_message_id=f"m{index}", sender_phone='5511911110001',
+                              message_type=message_type, processed=processed, processing_error=error, timestamp=datetime(2024, 1, 1))
+            message.ai_responses.append(AIResponse(agent_name='agent', response_content='ok', sent_to_whatsapp=index != 1))
+            db.add(message)
+        db.flush()
+        db.add(MediaFile(message_id=message.id, original_url='u', cloud_storage_bucket='b', cloud_storage_path='p', file_name='f.jpg'))
+        db.commit()
+    engine.dispose()
+
+
+def test_stats_use_one_query_per_table_and_are_cached_for_the_ttl(tmp_path):
+    seed(tmp_path / 'stats.db')
+    clock = FakeClock()
+    cache = DashboardStatsCache(ttl_seconds=10, clock=clock)
+
+    async def scenario():
+        async_engine = create_test_async_engine(tmp_path / 'stats.db')
+        statements = []
+        event.listen(async_engine.sync_engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+        async with make_async_sessionmaker(async_engine)() as db:
+            # Requisições simultâneas com o cache vazio compartilham uma única recomputação
+            first, second = await asyncio.gather(cache.get(db), cache.get(db))
+            queries_on_refresh = len(statements)
+            clock.now = 9
+            cached = await cache.get(db)
+            queries_within_ttl = len(statements) - queries_on_refresh
+            clock.now = 11
+            await cache.get(db)
+            queries_after_ttl = len(statements) - queries_on_refresh
+        await async_engine.dispose()
+        return first, second, cached, queries_on_refresh, queries_within_ttl, queries_after_ttl
+
+    first, second, cached, queries_on_refresh, queries_within_ttl, queries_after_ttl = asyncio.run(scenario())
+    assert first is second is cached
+    assert (queries_on_refresh, queries_within_ttl, queries_after_ttl) == (4, 0, 4)
+    assert first['totals'] == {
+        'conversations': 2, 'messages': 3, 'media_files': 1, 'active_conversations': 1,
+        'ai_responses': 3, 'successful_responses': 2, 'processed_messages': 2, 'failed_messages': 1,
+    }
+    assert first['message_types'] == {'text': 2, 'image': 1}
@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta
+from functools import partial
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+import routes.tasks as tasks
+from config import Config
+from conftest import add_conversation, add_messages, create_test_database
+from database_session import get_db
+from models import AIResponse, Conversation, HumanAgentRequest, MediaFile, Message, MessageArchiveSegment
+from services.data_retention import DataRetention, RetentionPolicy
+from services.message_archive import LocalArchiveStorage, archive_idle_conversations
+
+NOW = datetime(2024, 6, 1, 12, 0, 0)
+
+
+class FakeBlobDeleter:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.deleted = []
+
+    def delete(self, bucket_name, paths):
+        self.deleted.extend(f"{bucket_name}/{path}" for path in paths if path not in self.failing)
+        return self.failing.intersection(paths)
+
+
+def add_message(db, conversation, timestamp, media_path=None):
+    message, = add_messages(db, conversation, [f"mensagem {timestamp:%d/%m/%Y}"], timestamps=[timestamp], with_responses=True,
+                            media_paths={0: media_path} if media_path else None)
+    return message
+
+
+def make_session(tmp_path):
+    return sessionmaker(autoflush=False, bind=create_test_database(tmp_path / 'retention.db'))
+
+
+def test_each_table_is_purged_by_its_policy_in_batches(tmp_path):
+    db = make_session(tmp_path)()
+    forgotten_id, active_id = add_conversation(db, '5511911110001'), add_conversation(db, '5511911110002')
+    forgotten = db.get(Conversation, forgotten_id)
+    for day, media_path in enumerate([None, 'archived.jpg', None]):
+        add_message(db, forgotten, datetime(2023, 6, 10 + day), media_path=media_path)
+    storage = LocalArchiveStorage(str(tmp_path / 'archive'))
+    assert archive_idle_conversations(db, storage, idle_days=90, now=NOW).messages == 3
+
+    active = db.get(Conversation, active_id)
+    old = add_message(db, active, datetime(2023, 11, 1), media_path='old.jpg')
+    add_message(db, active, datetime(2024, 2, 1), media_path='february.jpg')
+    add_message(db, active, datetime(2024, 5, 25), media_path='recent.jpg')
+    db.add(HumanAgentRequest(conversation_id=active.id, phone_number=active.user_phone, last_message_id_before_escalation=old.id))
+    db.commit()
+
+    pauses, blobs = [], FakeBlobDeleter()
+    policy = RetentionPolicy(messages_days=180, ai_responses_days=90, media_files_days=30)
+    run = DataRetention(db, policy, blob_deleter=blobs, archive=storage, batch_size=1, pause_seconds=0.5,
+                        sleep=pauses.append).purge(NOW)
+
+    assert run.complete and (run.media_files, run.ai_responses, run.messages, run.archive_partitions) == (2, 2, 1, 1)
+    assert sorted(blobs.deleted) == ['bucket/archived.jpg', 'bucket/february.jpg', 'bucket/old.jpg']
+    assert pauses == [0.5] * run.batches
+    assert db.scalars(select(Message.content).order_by(Message.timestamp)).all() == ['mensagem 01/02/2024', 'mensagem 25/05/2024']
+    assert db.scalars(select(AIResponse.created_at)).all() == [datetime(2024, 5, 25)]
+    assert db.scalars(select(MediaFile.cloud_storage_path)).all() == ['recent.jpg']
+    assert db.scalar(select(HumanAgentRequest.last_message_id_before_escalation)) is None
+    assert db.scalar(select(MessageArchiveSegment.id)) is None
+    assert not (tmp_path / 'archive' / '2023-06.jsonl.gz').exists()
+
+    stats = {row.id: (row.message_count, row.last_message_at, row.last_message_preview)
+             for row in db.execute(select(Conversation.id, Conversation.message_count, Conversation.last_message_at,
+                                          Conversation.last_message_preview))}
+    assert stats == {forgotten_id: (0, None, None), active_id: (2, datetime(2024, 5, 25), 'mensagem 25/05/2024')}
+    db.close()
+
+
+def test_task_runs_a_bounded_number_of_batches_and_keeps_media_it_could_not_delete(tmp_path, monkeypatch):
+    session_factory = make_session(tmp_path)
+    db = session_factory()
+    conversation = db.get(Conversation, add_conversation(db, '5511911110001'))
+    for index, path in enumerate(['a.jpg', 'locked.jpg', 'b.jpg']):
+        add_message(db, conversation, NOW - timedelta(days=60, minutes=index), media_path=path)
+    db.close()
+
+    blobs = FakeBlobDeleter(failing={'locked.jpg'})
+    monkeypatch.setattr(tasks, 'DataRetention', partial(DataRetention, policy=RetentionPolicy(0, 0, 30),
+                                                        blob_deleter=blobs, batch_size=1, pause_seconds=0))
+
+    def override_get_db():
+        session = session_factory()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    app = FastAPI()
+    app.include_router(tasks.router, prefix="/tasks")
+    app.dependency_overrides[get_db] = override_get_db
+    headers = {'Authorization': f"Bearer {Config.INTERNAL_TASK_TOKEN}"}
+    with TestClient(app) as client:
+        assert client.post("/tasks/purge-expired-data").status_code == 403
+        first = client.post("/tasks/purge-expired-data", params={'max_batches': 2}, headers=headers).json()
+        second = client.post("/tasks/purge-expired-data", params={'max_batches': 2}, headers=headers).json()
+
+    assert (first['complete'], first['batches'], first['media_files'], first['blob_failures']) == (False, 2, 1, 1)
+    assert (second['complete'], second['media_files'], second['blob_failures']) == (True, 1, 1)
+    db = session_factory()
+    assert db.scalars(select(MediaFile.cloud_storage_path)).all() == ['locked.jpg']
+    assert db.scalar(select(Conversation.message_count)) == 3  # A retenção das mídias não apaga as mensagens
+    db.close()
+
+
+def test_archived_month_stays_until_every_media_object_is_deleted(tmp_path):
+    db = make_session(tmp_path)()
+    conversation_id = add_conversation(db, '5511911110001')
+    conversation = db.get(Conversation, conversation_id)
+    add_message(db, conversation, datetime(2023, 6, 10), media_path='locked.jpg')
+    storage = LocalArchiveStorage(str(tmp_path / 'archive'))
+    archive_idle_conversations(db, storage, idle_days=90, now=NOW)
+
+    policy = RetentionPolicy(messages_days=180, ai_responses_days=0, media_files_days=0)
+    run = DataRetention(db, policy, blob_deleter=FakeBlobDeleter(failing={'locked.jpg'}), archive=storage,
+                        pause_seconds=0).purge(NOW)
+    assert (run.archive_partitions, run.archive_segments, run.blob_failures) == (0, 0, 1)
+    assert storage.partitions() == ['2023-06']
+    assert db.scalar(select(MessageArchiveSegment.partition)) == '2023-06'
+
+    blobs = FakeBlobDeleter()
+    run = DataRetention(db, policy, blob_deleter=blobs, archive=storage, pause_seconds=0).purge(NOW)
+    assert (run.archive_partitions, run.archive_segments, blobs.deleted) == (1, 1, ['bucket/locked.jpg'])
+    assert storage.partitions() == [] and db.scalar(select(MessageArchiveSegment.id)) is None
+    assert db.get(Conversation, conversation_id).message_count == 0
+    db.close()
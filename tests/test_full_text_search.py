@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from conftest import add_conversation, create_test_async_engine, create_test_database
+from database_session import make_async_sessionmaker
+from models import Message
+from services.full_text_search import (FullTextSearchUnavailable, highlight_html, search_conversations, search_terms,
+                                       setup_full_text_search)
+
+
+@pytest.fixture(name="search_database")
+def search_database_fixture(tmp_path):
+    database_path = tmp_path / 'search.db'
+    engine = create_test_database(database_path)
+    with sessionmaker(bind=engine)() as db:
+        # Mensagem anterior ao setup: entra no índice pela reconstrução
+        pizza = add_conversation(db, '5511911110001', ['Quero uma pizza de calabresa'], contact_name='Ana')
+    setup_full_text_search(engine)
+    with sessionmaker(bind=engine)() as db:
+        # Depois do setup: entram pelos triggers
+        ids = {
+            'pizza': pizza,
+            'acai': add_conversation(db, '5511911110002', ['Vocês têm açaí?', 'Pode ser <b>grande</b> açaí'], contact_name='Bruno'),
+            'contact': add_conversation(db, '5511911110003', ['Bom dia'], contact_name='Pizzaria do Zé'),
+        }
+        db.get(Message, 1).content = 'Quero uma esfiha'  # Só a mensagem de Ana sobre pizza
+        db.commit()
+    engine.dispose()
+    return database_path, ids
+
+
+def search(database_path, query, limit=20):
+    async def run():
+        async_engine = create_test_async_engine(database_path)
+        async with make_async_sessionmaker(async_engine)() as db:
+            hits = await search_conversations(db, query, limit)
+        await async_engine.dispose()
+        return hits
+    return asyncio.run(run())
+
+
+def test_search_terms_and_highlight_escape_user_text():
+    assert search_terms('pizza OR "calabresa"*') == ['pizza', 'or', 'calabresa']
+    assert search_terms('  -- ') == []
+    assert highlight_html('<b>\x02açaí\x03</b>') == '&lt;b&gt;<mark>açaí</mark>&lt;/b&gt;'
+
+
+def test_messages_are_indexed_on_insert_and_update(search_database):
+    database_path, ids = search_database
+    assert [hit.conversation_id for hit in search(database_path, 'esfiha')] == [ids['pizza']]
+    assert search(database_path, 'calabresa') == []  # O UPDATE tirou o texto antigo do índice
+
+    # Sem acento, por prefixo; o trecho vem escapado e com o termo destacado
+    hits = search(database_path, 'aca')
+    assert [hit.conversation_id for hit in hits] == [ids['acai']]
+    assert '<mark>' in hits[0].snippet_html and '<b>' not in hits[0].snippet_html and not hits[0].matched_contact
+
+
+def test_contact_matches_rank_first(search_database):
+    database_path, ids = search_database
+    assert [hit.conversation_id for hit in search(database_path, '5511911110002')] == [ids['acai']]
+
+    with sessionmaker(bind=create_test_database(database_path))() as db:
+        add_conversation(db, '5511911110004', ['A pizzaria já abriu?'], contact_name='Carla')
+    hits = search(database_path, 'pizzaria')
+    assert hits[0].conversation_id == ids['contact'] and hits[0].matched_contact
+    assert len(hits) == 2 and not hits[1].matched_contact
+    assert len(search(database_path, 'pizzaria', limit=1)) == 1
+
+
+def test_search_without_fts_tables_is_unavailable(tmp_path):
+    create_test_database(tmp_path / 'plain.db').dispose()
+    with pytest.raises(FullTextSearchUnavailable):
+        search(tmp_path / 'plain.db', 'pizza')
+
+
+def test_search_endpoint_returns_ranked_conversations(search_database, dashboard_client_for):
+    database_path, ids = search_database
+    with dashboard_client_for(create_test_async_engine(database_path)) as client:
+        response = client.get("/dashboard/api/search", params={'q': 'açaí grande'})
+        assert response.status_code == 200
+        conversations = response.json()['conversations']
+        assert [conv['id'] for conv in conversations] == [ids['acai']]
+        assert conversations[0]['user_phone'] == '5511911110002' and '&lt;b&gt;' in conversations[0]['snippet_html']
+
+        assert client.get("/dashboard/api/search", params={'q': '...'}).json()['conversations'] == []
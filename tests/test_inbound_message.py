@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+
+from services.inbound_message import InvalidPayloadError, parse_inbound_message
+
+
+def evolution_payload(message_type, message, message_id='EV1'):
+    return {
+        'key': {'id': message_id, 'remoteJid': '5511911110001@s.whatsapp.net', 'fromMe': False},
+        'pushName': 'Ana',
+        'messageTimestamp': 1700000000,
+        'messageType': message_type,
+        'message': message,
+    }
+
+
+def test_evolution_text_message():
+    inbound = parse_inbound_message(evolution_payload('conversation', {'conversation': 'oi'}), {'instance': 'loja'})
+    assert inbound.sender_phone == '5511911110001'
+    assert inbound.is_text and inbound.is_new_format
+    assert inbound.content == 'oi'
+    assert inbound.contact_name == 'Ana'
+    assert inbound.instance == 'loja'
+    assert inbound.timestamp == datetime.fromtimestamp(1700000000)
+    assert inbound.media is None
+
+
+def test_evolution_media_and_location_messages():
+    image = parse_inbound_message(evolution_payload('imageMessage', {
+        'imageMessage': {'url': 'https://mmg/enc', 'mediaKey': 'a2V5', 'mimetype': 'image/jpeg', 'caption': 'meu pedido'}
+    }))
+    assert image.message_type == 'image' and image.message_type_raw == 'imageMessage'
+    assert image.content == 'meu pedido'
+    assert image.media.filename == 'image_EV1.jpeg'
+    assert image.media.download_url == 'https://mmg/enc' and image.media.media_key == 'a2V5'
+
+    no_download = parse_inbound_message(evolution_payload('audioMessage', {'audioMessage': {}}))
+    assert no_download.media is None
+    assert no_download.content == 'Received audioMessage'
+    assert no_download.processing_error
+
+    location = parse_inbound_message(evolution_payload('locationMessage', {
+        'locationMessage': {'degreesLatitude': -23.5, 'degreesLongitude': -46.6}
+    }))
+    assert location.content == '{"latitude": -23.5, "longitude": -46.6}'
+
+
+def test_legacy_message_with_contact_name():
+    inbound = parse_inbound_message(
+        {'id': 'OLD1', 'from': '5511911110002', 'timestamp': '1700000000', 'type': 'image',
+         'image': {'id': 'media-1', 'mime_type': 'image/png', 'caption': 'foto'}},
+        {'contacts': [{'wa_id': '5511911110002', 'profile': {'name': 'Bruno'}}]}
+    )
+    assert not inbound.is_new_format
+    assert inbound.contact_name == 'Bruno'
+    assert inbound.media.media_id == 'media-1'
+    assert inbound.media.filename == 'image_OLD1.png'
+    assert inbound.content == 'foto'
+
+
+def test_payload_without_id_or_sender_is_rejected():
+    with pytest.raises(InvalidPayloadError):
+        parse_inbound_message({'key': {'remoteJid': '5511911110001@s.whatsapp.net'}, 'messageType': 'conversation'})
+    with pytest.raises(InvalidPayloadError):
+        parse_inbound_message({'id': 'OLD2', 'type': 'text'})
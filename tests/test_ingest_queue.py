@@ -0,0 +1,211 @@
+import asyncio
+import threading
+import time
+
+from sqlalchemy import create_engine, text as sql_text
+from sqlalchemy.orm import sessionmaker
+
+from conftest import create_test_async_engine, create_test_database
+from database_session import make_async_sessionmaker
+from models import IngestJob
+from services.ingest_queue import IngestQueue, upgrade_ingest_jobs_schema
+
+
+def make_session_factory(tmp_path):
+    return sessionmaker(autocommit=False, autoflush=False, bind=create_test_database(tmp_path / 'ingest.db'))
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_jobs_persisted_before_start_are_recovered(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    processed = []
+    ingest_queue = IngestQueue(session_factory, num_workers=2, poll_interval=0.1)
+
+    db = session_factory()
+    ingest_queue.enqueue(db, [('5511911110001', {'n': 1}, {}, False), ('5511911110002', {'n': 2}, {'instance': 'test'}, False)])
+    db.close()
+
+    ingest_queue.start(lambda items, session: processed.extend(payload['n'] for payload, _ in items))
+    try:
+        assert wait_until(lambda: len(processed) == 2)
+    finally:
+        ingest_queue.stop()
+
+    assert sorted(processed) == [1, 2]
+    db = session_factory()
+    assert db.query(IngestJob).count() == 0
+    db.close()
+
+
+def test_failed_job_is_retried_then_kept_as_failed(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    ingest_queue = IngestQueue(session_factory, num_workers=1, max_attempts=2, poll_interval=0.1)
+
+    def failing_handler(items, session):
+        raise ValueError("boom")
+
+    ingest_queue.start(failing_handler)
+    try:
+        db = session_factory()
+        ingest_queue.enqueue(db, [('5511911110001', {'n': 1}, {}, False)])
+        db.close()
+
+        def job_failed():
+            session = session_factory()
+            try:
+                job = session.query(IngestJob).first()
+                return job is not None and job.status == 'failed'
+            finally:
+                session.close()
+
+        assert wait_until(job_failed, timeout=10.0)
+    finally:
+        ingest_queue.stop()
+
+    db = session_factory()
+    job = db.query(IngestJob).first()
+    assert job.attempts == 2
+    assert job.last_error == "boom"
+    db.close()
+
+
+def test_messages_from_same_conversation_are_processed_in_order(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    processed = {}
+    ingest_queue = IngestQueue(session_factory, num_workers=4, poll_interval=0.1)
+
+    def handler(items, session):
+        time.sleep(0.01)
+        for payload, _ in items:
+            processed.setdefault(payload['phone'], []).append(payload['n'])
+
+    ingest_queue.start(handler)
+    try:
+        db = session_factory()
+        phones = ['5511911110001', '5511911110002', '5511911110003']
+        ingest_queue.enqueue(db, [
+            (phone, {'phone': phone, 'n': n}, {}, False) for n in range(10) for phone in phones
+        ])
+        db.close()
+        assert wait_until(lambda: sum(len(v) for v in processed.values()) == 30)
+    finally:
+        ingest_queue.stop()
+
+    for phone in phones:
+        assert processed[phone] == list(range(10))
+
+
+def test_text_burst_is_delivered_as_one_batch(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    batches = []
+    ingest_queue = IngestQueue(session_factory, num_workers=2, poll_interval=0.1,
+                               coalesce_window_ms=200, coalesce_max_messages=5)
+
+    def handler(items, session):
+        batches.append([payload['text'] for payload, _ in items])
+
+    ingest_queue.start(handler)
+    try:
+        db = session_factory()
+        for text in ["oi", "quero pedir", "uma pizza"]:
+            ingest_queue.enqueue(db, [('5511911110001', {'type': 'text', 'text': text}, {}, True)])
+        ingest_queue.enqueue(db, [('5511911110001', {'type': 'image', 'text': 'foto'}, {}, False)])
+        db.close()
+        assert wait_until(lambda: sum(len(batch) for batch in batches) == 4)
+    finally:
+        ingest_queue.stop()
+
+    assert batches == [["oi", "quero pedir", "uma pizza"], ["foto"]]
+
+
+def test_text_jobs_resumed_from_the_database_are_still_grouped(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    batches = []
+    ingest_queue = IngestQueue(session_factory, num_workers=2, poll_interval=0.1, coalesce_window_ms=200)
+
+    db = session_factory()
+    ingest_queue.enqueue(db, [('5511911110001', {'text': text}, {}, True) for text in ["oi", "tudo bem?"]])
+    db.close()
+
+    # is_text gravado no job: a retomada não precisa fazer o parse do payload de novo
+    ingest_queue.start(lambda items, session: batches.append([payload['text'] for payload, _ in items]))
+    try:
+        assert wait_until(lambda: sum(len(batch) for batch in batches) == 2)
+    finally:
+        ingest_queue.stop()
+
+    assert batches == [["oi", "tudo bem?"]]
+
+
+def test_backlog_counts_jobs_until_they_finish(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    release = threading.Event()
+    ingest_queue = IngestQueue(session_factory, num_workers=1, poll_interval=0.1)
+    ingest_queue.start(lambda items, session: release.wait(5))
+    try:
+        db = session_factory()
+        ingest_queue.enqueue(db, [('5511911110001', {'n': n}, {}, False) for n in range(3)])
+        db.close()
+        assert wait_until(lambda: ingest_queue.stats()['in_flight'] == 1)
+        stats = ingest_queue.stats()
+        assert stats['backlog'] == 3
+        assert stats['queued'] == 2
+        release.set()
+        assert wait_until(lambda: ingest_queue.backlog() == 0)
+    finally:
+        release.set()
+        ingest_queue.stop()
+
+
+def test_async_handler_runs_lanes_on_event_loop_in_order(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    async_engine = create_test_async_engine(tmp_path / 'ingest.db')
+    async_session_factory = make_async_sessionmaker(async_engine)
+    processed = {}
+    ingest_queue = IngestQueue(session_factory, num_workers=50, poll_interval=0.1,
+                               async_session_factory=async_session_factory)
+
+    async def handler(items, session):
+        await asyncio.sleep(0.01)
+        for payload, _ in items:
+            processed.setdefault(payload['phone'], []).append(payload['n'])
+
+    ingest_queue.start(handler, on_loop_stop=async_engine.dispose)
+    try:
+        db = session_factory()
+        phones = ['5511911110001', '5511911110002', '5511911110003']
+        ingest_queue.enqueue(db, [
+            (phone, {'phone': phone, 'n': n}, {}, False) for n in range(10) for phone in phones
+        ])
+        db.close()
+        assert wait_until(lambda: sum(len(v) for v in processed.values()) == 30)
+    finally:
+        ingest_queue.stop()
+
+    for phone in phones:
+        assert processed[phone] == list(range(10))
+    db = session_factory()
+    assert db.query(IngestJob).count() == 0
+    db.close()
+
+
+def test_upgrade_adds_is_text_to_an_existing_table(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(sql_text("CREATE TABLE ingest_jobs (id INTEGER PRIMARY KEY, created_at DATETIME, updated_at DATETIME, "
+                                "conversation_key VARCHAR(30), message_payload JSON NOT NULL, context_payload JSON, "
+                                "status VARCHAR(20) NOT NULL, attempts INTEGER NOT NULL, locked_at DATETIME, last_error TEXT)"))
+        connection.execute(sql_text("INSERT INTO ingest_jobs (message_payload, status, attempts) VALUES ('{}', 'pending', 0)"))
+
+    assert upgrade_ingest_jobs_schema(engine) is True
+    assert upgrade_ingest_jobs_schema(engine) is False
+    with engine.connect() as connection:
+        assert connection.execute(sql_text("SELECT is_text FROM ingest_jobs")).scalar() == 0
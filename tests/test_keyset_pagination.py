@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from database_session import Base, make_async_sessionmaker
+from models import Conversation
+from services.keyset_pagination import (InvalidCursorError, approximate_count, decode_cursor, encode_cursor,
+                                        fetch_keyset_page)
+
+BASE_TIME = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def test_cursor_round_trip_and_invalid_cursors():
+    assert decode_cursor(encode_cursor(BASE_TIME, 42)) == (BASE_TIME, 42)
+    assert decode_cursor(encode_cursor(None, 7)) == (None, 7)
+    for cursor in ('nao-e-um-cursor', encode_cursor(BASE_TIME, 1)[:-3], 'WyJ4IiwieSJd'):
+        with pytest.raises(InvalidCursorError):
+            decode_cursor(cursor)
+
+
+def test_pages_follow_the_full_ordering_including_ties_and_nulls(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pages.db'}")
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        # Empates em last_message_at (desempate pelo ID) e conversas sem mensagens (last_message_at nulo)
+        db.add_all([
+            Conversation(user_phone=f"55119111100{index:02d}",
+                         last_message_at=None if index % 5 == 0 else BASE_TIME + timedelta(minutes=index // 3))
+            for index in range(23)
+        ])
+        db.commit()
+        keys = db.execute(select(Conversation.last_message_at, Conversation.id)).all()
+        # Mais recentes primeiro, empates por ID decrescente, conversas sem mensagens no fim
+        dated = sorted((key for key in keys if key.last_message_at), reverse=True)
+        undated = sorted((key for key in keys if not key.last_message_at), key=lambda key: key.id, reverse=True)
+        expected = [key.id for key in dated + undated]
+
+    async def read_all_pages():
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pages.db'}")
+        seen, cursor, pages = [], None, 0
+        async with make_async_sessionmaker(async_engine)() as db:
+            while True:
+                page = await fetch_keyset_page(db, select(Conversation), Conversation.last_message_at, Conversation.id,
+                                               cursor, 4, row_key=lambda row: (row.Conversation.last_message_at, row.Conversation.id))
+                seen += [row.Conversation.id for row in page.rows]
+                pages += 1
+                if not page.has_next:
+                    break
+                cursor = page.next_cursor
+            total = await approximate_count(db, Conversation, Conversation.last_message_at.is_(None))
+        await async_engine.dispose()
+        return seen, pages, total
+
+    seen, pages, total = asyncio.run(read_all_pages())
+    assert seen == expected
+    assert pages == 6
+    assert total == (5, False)
@@ -0,0 +1,92 @@
+import gzip
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+import routes.dashboard as dashboard
+from conftest import add_messages, create_test_async_engine, create_test_database
+from models import AIResponse, Conversation, HumanAgentRequest, MediaFile, Message, MessageArchiveSegment
+from services.conversation_stats import backfill_conversation_stats
+from services.message_archive import LocalArchiveStorage, archive_idle_conversations
+
+NOW = datetime(2024, 6, 1, 12, 0, 0)
+
+
+def add_media_messages(db, conversation, *timestamps):
+    """Mensagens com resposta da IA e mídia, com o dia no conteúdo."""
+    return add_messages(db, conversation, [f"mensagem {timestamp:%d/%m}" for timestamp in timestamps], timestamps=list(timestamps),
+                        with_responses=True, media=range(len(timestamps)))
+
+
+@pytest.fixture(name="archived_database")
+def archived_database_fixture(tmp_path):
+    database_path = tmp_path / 'archive.db'
+    db = sessionmaker(bind=create_test_database(database_path))()
+    idle, active = Conversation(user_phone='5511911110001'), Conversation(user_phone='5511911110002')
+    db.add_all([idle, active])
+    db.flush()
+    # Conversa parada com mensagens em dois meses; a ativa recebeu mensagem há 10 dias
+    old = [datetime(2024, 1, 30, 10, 0) + timedelta(days=day) for day in range(5)]
+    escalated = add_media_messages(db, idle, *old)[-1]
+    add_media_messages(db, active, datetime(2024, 1, 5, 9, 0), NOW - timedelta(days=10))
+    db.add(HumanAgentRequest(conversation_id=idle.id, phone_number=idle.user_phone, last_message_id_before_escalation=escalated.id))
+    db.commit()
+    ids = (idle.id, active.id)
+    stats_before = db.execute(Conversation.__table__.select().order_by(Conversation.id)).all()
+
+    storage = LocalArchiveStorage(str(tmp_path / 'archive'))
+    run = archive_idle_conversations(db, storage, idle_days=90, batch_size=1, now=NOW)
+    yield database_path, storage, ids, run, db, stats_before
+    db.close()
+
+
+def test_idle_conversations_move_to_monthly_files(archived_database, tmp_path):
+    _, storage, (idle, active), run, db, stats_before = archived_database
+    assert (run.conversations, run.messages, run.segments) == (1, 5, 2)
+
+    assert db.scalar(select(func.count()).select_from(Message).where(Message.conversation_id == idle)) == 0
+    assert db.scalar(select(func.count()).select_from(Message).where(Message.conversation_id == active)) == 2
+    assert db.scalar(select(func.count()).select_from(AIResponse)) == 2
+    assert db.scalar(select(func.count()).select_from(MediaFile)) == 2
+    assert db.scalar(select(HumanAgentRequest.last_message_id_before_escalation)) is None
+
+    segments = db.scalars(select(MessageArchiveSegment).order_by(MessageArchiveSegment.partition)).all()
+    assert [(segment.partition, segment.message_count) for segment in segments] == [('2024-01', 2), ('2024-02', 3)]
+    # Arquivos gzip comuns: legíveis inteiros, fora da aplicação
+    with gzip.open(tmp_path / 'archive' / '2024-02.jsonl.gz', 'rt', encoding='utf-8') as archive:
+        assert len(archive.readlines()) == 3
+
+    # Nada mais a arquivar; as estatísticas da conversa continuam contando as arquivadas, também no backfill
+    assert archive_idle_conversations(db, storage, idle_days=90, now=NOW).conversations == 0
+    assert db.execute(Conversation.__table__.select().order_by(Conversation.id)).all() == stats_before
+    backfill_conversation_stats(db)
+    assert db.execute(Conversation.__table__.select().order_by(Conversation.id)).all() == stats_before
+
+
+def test_dashboard_reads_archived_messages_back(archived_database, monkeypatch, dashboard_client_for):
+    database_path, storage, (idle, _), _, db, _ = archived_database
+    conversation = db.get(Conversation, idle)
+    add_media_messages(db, conversation, *(NOW + timedelta(minutes=minute) for minute in range(4)))  # A conversa voltou a receber mensagens
+    monkeypatch.setattr(dashboard, 'message_archive', storage)
+
+    url = f"/dashboard/api/conversation/{idle}/messages"
+    with dashboard_client_for(create_test_async_engine(database_path)) as client:
+        pages, cursor = [], None
+        while True:
+            body = client.get(url, params={'per_page': 3, **({'cursor': cursor} if cursor else {})}).json()
+            pages.append([message['content'] for message in body['messages']])
+            cursor = body['pagination']['next_cursor']
+            if not cursor:
+                break
+        offset_pages = [[message['content'] for message in client.get(url, params={'per_page': 3, 'page': page}).json()['messages']]
+                        for page in (1, 2, 3)]
+        archived = client.get(url, params={'per_page': 10}).json()['messages'][-1]
+
+    expected = ['mensagem 01/06'] * 4 + ['mensagem 03/02', 'mensagem 02/02', 'mensagem 01/02', 'mensagem 31/01', 'mensagem 30/01']
+    assert [content for page in pages for content in page] == expected
+    assert [len(page) for page in pages] == [3, 3, 3]
+    assert offset_pages == pages
+    assert archived['ai_responses'][0]['response_content'] == 'resposta: mensagem 30/01'
+    assert archived['media_file']['file_size'] is None and archived['timestamp'] == '2024-01-30T10:00:00'
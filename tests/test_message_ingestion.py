@@ -0,0 +1,90 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import routes.webhook as webhook
+from conftest import add_conversation, create_test_database
+from models import MediaFile, Message
+from services.conversation_cache import ConversationCache
+from services.conversation_history import ConversationHistoryBuffer
+from services.profile_cache import ProfileCache
+
+
+def evolution_payload(message_id, message_type, message):
+    return {
+        'key': {'id': message_id, 'remoteJid': '5511977770001@s.whatsapp.net', 'fromMe': False},
+        'pushName': 'Ana',
+        'messageTimestamp': 1700000000,
+        'messageType': message_type,
+        'message': message,
+    }
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """Sessão com commits e flushes contados; WhatsApp, Cloud Storage e IA falsos registram se havia transação aberta."""
+    test_engine = create_test_database(tmp_path / 'ingest.db')
+    db = Session(bind=test_engine, autoflush=False)  # Como SessionLocal
+    # Conversa existente: uma conversa nova tem mais um flush, para receber o ID
+    add_conversation(db, '5511977770001', contact_name='Ana')
+    db.commit()  # Encerra a leitura do ID da conversa
+    counts = {'commits': 0, 'flushes': 0, 'io_in_transaction': []}
+    event.listen(db, 'after_commit', lambda session: counts.update(commits=counts['commits'] + 1))
+    event.listen(db, 'after_flush', lambda session, context: counts.update(flushes=counts['flushes'] + 1))
+
+    def external_call(result):
+        def call(*args, **kwargs):
+            counts['io_in_transaction'].append(db.in_transaction())
+            return result
+        return call
+
+    monkeypatch.setattr(webhook.Config, 'GOOGLE_CLOUD_BUCKET_NAME', 'bucket')
+    monkeypatch.setattr(webhook, 'conversation_cache', ConversationCache())
+    monkeypatch.setattr(webhook, 'history_buffer', ConversationHistoryBuffer())
+    monkeypatch.setattr(webhook, 'profile_cache', ProfileCache())
+    monkeypatch.setattr(webhook.whatsapp_service, 'download_media', external_call(b'%PDF-1.4'))
+    monkeypatch.setattr(webhook.whatsapp_service, 'send_text_message', lambda **kwargs: True)
+    monkeypatch.setattr(webhook.cloud_storage, 'upload_file', external_call(('whatsapp_media/pedido.pdf', 'https://storage/pedido.pdf')))
+    monkeypatch.setattr(webhook.ai_service, 'extract_profile_info', external_call({'action': 'NONE'}))
+    monkeypatch.setattr(webhook.ai_service, 'extract_order_info', lambda text, history: {'action': 'NONE'})
+    monkeypatch.setattr(webhook.ai_service, 'process_text_message',
+                        external_call({'success': True, 'response': 'ok', 'metadata': {'agent_name': 'agent'}}))
+    yield db, counts
+    db.close()
+    test_engine.dispose()
+
+
+@pytest.mark.parametrize('message_type, message, has_media', [
+    ('conversation', {'conversation': 'quero um bolo'}, False),
+    ('documentMessage', {'documentMessage': {'url': 'https://mmg/enc', 'mediaKey': 'a2V5', 'mimetype': 'application/pdf',
+                                             'fileName': 'pedido.pdf', 'caption': 'meu pedido'}}, True),
+])
+def test_turn_commits_ingestion_and_ai_result_once_each(pipeline, message_type, message, has_media):
+    db, counts = pipeline
+    webhook.process_message_batch([(evolution_payload('ING1', message_type, message), {})], db)
+
+    # Um commit (e um flush) para a ingestão e outro para o resultado da IA, com ou sem mídia; o commit
+    # do meio só encerra a leitura do contexto, sem flush
+    assert counts['commits'] == 3
+    assert counts['flushes'] == 2
+    # Download e upload rodam antes da transação de ingestão; perfil e resposta da IA, sem transação aberta
+    assert counts['io_in_transaction'] == ([False, False] if has_media else []) + [False, False]
+
+    stored = db.query(Message).filter_by(whatsapp_message_id='ING1').one()
+    assert len(stored.ai_responses) == 1
+    assert db.query(MediaFile).count() == (1 if has_media else 0)
+    if has_media:
+        assert stored.cloud_storage_url == 'https://storage/pedido.pdf'
+
+
+def test_redelivery_that_loses_the_claim_deletes_its_uploaded_media(pipeline, monkeypatch):
+    db, counts = pipeline
+    deleted = []
+    monkeypatch.setattr(webhook.cloud_storage, 'delete_file', lambda blob_name: deleted.append(blob_name) or True)
+    payload = evolution_payload('ING2', 'documentMessage', {'documentMessage': {'url': 'https://mmg/enc', 'mediaKey': 'a2V5',
+                                                                                'mimetype': 'application/pdf', 'fileName': 'pedido.pdf'}})
+    webhook.process_message_batch([(payload, {})], db)
+    webhook.process_message_batch([(payload, {})], db)
+
+    assert db.query(MediaFile).count() == 1
+    assert deleted == ['whatsapp_media/pedido.pdf']
@@ -0,0 +1,12 @@
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+
+
+def test_metrics_require_the_internal_task_token(client: TestClient):
+    with patch('config.Config.INTERNAL_TASK_TOKEN', 'test_secret_token'):
+        assert client.get("/metrics").status_code == 403
+        assert client.get("/metrics", headers={'Authorization': 'Bearer wrong_token'}).status_code == 403
+
+        response = client.get("/metrics", headers={'Authorization': 'Bearer test_secret_token'})
+        assert response.status_code == 200
+        assert {'ingest_queue', 'admission', 'db_pools'} <= response.json().keys()
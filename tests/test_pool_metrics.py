@@ -0,0 +1,31 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from services.pool_metrics import PoolMetrics
+
+
+def test_pool_metrics_record_checkouts_overflow_and_timeouts(tmp_path):
+    metrics = PoolMetrics('test')
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=metrics.pool_class(QueuePool),
+                           pool_size=1, max_overflow=1, pool_timeout=0.05)
+    metrics.attach(engine)
+    try:
+        first, second = engine.connect(), engine.connect()  # A segunda conexão só existe como overflow
+        first.execute(text('SELECT 1'))
+        with pytest.raises(PoolTimeoutError):
+            engine.connect()
+        stats = metrics.stats()
+        assert stats['checkouts'] == 2
+        assert stats['connects'] == 2
+        assert stats['overflow_connects'] == 1
+        assert stats['timeouts'] == 1
+        assert stats['checked_out'] == 2
+        assert stats['overflow'] == 1
+        assert stats['checkout_wait_ms']['max'] >= 50
+        first.close()
+        second.close()
+        assert metrics.stats()['checked_out'] == 0
+    finally:
+        engine.dispose()
@@ -0,0 +1,80 @@
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+import routes.webhook as webhook
+from conftest import add_conversation, add_messages, create_test_database
+from models import Conversation, UserProfile
+from services.profile_cache import ProfileCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_session(tmp_path):
+    test_engine = create_test_database(tmp_path / 'profile.db')
+    return test_engine, Session(bind=test_engine, autoflush=False)
+
+
+def test_turn_keys_are_written_in_one_upsert_merged_in_the_database(tmp_path):
+    engine, db = make_session(tmp_path)
+    known, new = add_conversation(db, '5511911110001'), add_conversation(db, '5511911110002')
+    db.add(UserProfile(conversation_id=known, profile_data={'nome': 'Ana', 'bairro': 'Centro'}))
+    db.commit()
+
+    clock = FakeClock()
+    cache = ProfileCache(max_size=10, ttl_seconds=60, clock=clock)
+    cache.put(known, {'nome': 'Ana', 'bairro': 'Centro'})
+    for conversation_id, key, value in [(known, 'endereco', 'Rua X'), (known, 'bairro', 'Moema'), (new, 'nome', 'Bruno')]:
+        cache.stage(conversation_id, key, value)
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    cache.write_pending(db, known)
+    cache.write_pending(db, new)
+    db.commit()
+    cache.committed(known)
+    cache.committed(new)
+
+    assert [statement.split()[0] for statement in statements] == ['INSERT', 'INSERT']
+    profiles = dict(db.execute(select(UserProfile.conversation_id, UserProfile.profile_data)).all())
+    assert profiles == {known: {'nome': 'Ana', 'bairro': 'Moema', 'endereco': 'Rua X'}, new: {'nome': 'Bruno'}}
+    assert cache.get(known) == profiles[known]
+    assert cache.get(new) is None  # Não estava em cache: a próxima leitura vem do banco
+    clock.now = 61
+    assert cache.get(known) is None
+    stats = cache.stats()
+    assert (stats['staged_keys'], stats['writes'], stats['pending'], stats['expired']) == (3, 2, 0, 1)
+    db.close()
+    engine.dispose()
+
+
+def test_turn_context_reads_the_profile_from_memory(tmp_path, monkeypatch):
+    engine, db = make_session(tmp_path)
+    conversation = Conversation(user_phone='5511911110001')
+    db.add(conversation)
+    db.flush()
+    db.add(UserProfile(conversation_id=conversation.id, profile_data={'nome': 'Ana'}))
+    message, = add_messages(db, conversation, ['oi'])
+    cache = ProfileCache(max_size=10, ttl_seconds=60, clock=FakeClock())
+    monkeypatch.setattr(webhook, 'profile_cache', cache)
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    assert webhook.load_turn_context(db, message, [message]).profile_data == {'nome': 'Ana'}
+    loaded = len([statement for statement in statements if 'user_profiles' in statement])
+    statements.clear()
+
+    webhook.apply_profile_action(conversation, {'action': 'SAVE', 'data': {'key': 'endereco', 'value': 'Rua X'}})
+    # O perfil extraído no turno já vale para a resposta, antes de ser gravado
+    assert webhook.load_turn_context(db, message, [message]).profile_data == {'nome': 'Ana', 'endereco': 'Rua X'}
+    assert (loaded, [statement for statement in statements if 'user_profiles' in statement]) == (1, [])
+
+    cache.discard(conversation.id)  # Turno desfeito: nada pendente e o perfil volta a ser lido do banco
+    assert webhook.load_turn_context(db, message, [message]).profile_data == {'nome': 'Ana'}
+    db.close()
+    engine.dispose()
@@ -0,0 +1,79 @@
+import asyncio
+
+from sqlalchemy.orm import sessionmaker
+
+import database_session
+from conftest import add_conversation, create_test_async_engine, create_test_database
+from database_session import make_async_sessionmaker
+from services.read_replica import ReplicaRouter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeLagRouter(ReplicaRouter):
+    """Réplica cujo atraso medido é definido pelo teste (uma exceção simula a réplica fora do ar)."""
+    lag = 0.0
+    measurements = 0
+
+    async def measure_lag(self):
+        self.measurements += 1
+        if isinstance(self.lag, Exception):
+            raise self.lag
+        return self.lag
+
+
+def test_router_measures_lag_once_per_interval_and_falls_back_to_primary():
+    clock = FakeClock()
+    router = FakeLagRouter(object(), session_factory='replica', check_interval_seconds=5, clock=clock)
+
+    async def route(max_lag_seconds):
+        return await router.session_factory_for(max_lag_seconds)
+
+    assert [asyncio.run(route(max_lag)) for max_lag in (30, 2)] == ['replica', 'replica']
+    router.lag = 10.0
+    assert asyncio.run(route(2)) == 'replica'  # Medição de 0s ainda vale
+    clock.now = 5
+    assert [asyncio.run(route(max_lag)) for max_lag in (30, 2)] == ['replica', None]
+    router.lag = RuntimeError('connection refused')
+    clock.now = 10
+    assert asyncio.run(route(30)) is None
+    assert router.measurements == 3
+    stats = router.stats()
+    assert (stats['replica_reads'], stats['primary_reads'], stats['lag_fallbacks'], stats['replica_errors']) == (4, 2, 1, 1)
+    assert stats['lag_seconds'] is None and stats['enabled'] is True
+    assert asyncio.run(ReplicaRouter(None).session_factory_for(30)) is None
+
+
+def make_database(path, contact_name, message_count):
+    engine = create_test_database(path)
+    with sessionmaker(bind=engine)() as db:
+        conversation_id = add_conversation(db, '5511911110001', [f"mensagem {index}" for index in range(message_count)],
+                                           contact_name=contact_name)
+    engine.dispose()
+    return create_test_async_engine(path), conversation_id
+
+
+def test_dashboard_reads_go_to_the_replica_only_within_the_tolerated_lag(tmp_path, monkeypatch, dashboard_client_for):
+    # A réplica é uma cópia atrasada do primário: ainda não recebeu a segunda mensagem
+    primary_engine, conversation_id = make_database(tmp_path / 'primary.db', 'Primário', 2)
+    replica_engine, _ = make_database(tmp_path / 'replica.db', 'Réplica', 1)
+    router = FakeLagRouter(replica_engine, make_async_sessionmaker(replica_engine), check_interval_seconds=0)
+    monkeypatch.setattr(database_session, 'read_router', router)
+
+    def read(client):
+        listing = client.get("/dashboard/api/conversations").json()['conversations'][0]['contact_name']
+        messages = client.get(f"/dashboard/api/conversation/{conversation_id}/messages").json()['messages']
+        return listing, len(messages)
+
+    with dashboard_client_for(primary_engine) as client:
+        assert read(client) == ('Réplica', 1)
+        router.lag = 10.0  # Tolerável para a lista, não para as mensagens
+        assert read(client) == ('Réplica', 2)
+        router.lag = RuntimeError('connection refused')
+        assert read(client) == ('Primário', 2)
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import Session
+
+import routes.webhook as webhook
+from conftest import add_conversation, create_test_database
+from models import Conversation, Message, SilentMode
+from services.silent_mode import SilentModeRegistry
+
+NOW = datetime(2024, 1, 1, 12, 0, 0)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = NOW
+        self.monotonic = 0.0
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+        self.monotonic += seconds
+
+
+def make_registry(clock, refresh_seconds=60):
+    return SilentModeRegistry(refresh_seconds=refresh_seconds, clock=lambda: clock.now, monotonic=lambda: clock.monotonic)
+
+
+def test_windows_expire_in_order_and_reenable_replaces_the_old_expiry():
+    clock = FakeClock()
+    registry = make_registry(clock)
+    registry.enable(1, NOW + timedelta(seconds=10))
+    registry.enable(2, NOW + timedelta(seconds=30))
+    registry.enable(1, NOW + timedelta(seconds=60))  # Reativada: a entrada antiga do heap não pode removê-la
+    registry.enable(3, NOW + timedelta(seconds=20))
+    registry.disable(3)
+
+    clock.advance(15)
+    assert (registry.is_silent(1), registry.is_silent(2), registry.is_silent(3)) == (True, True, False)
+    clock.advance(20)
+    assert (registry.is_silent(1), registry.is_silent(2)) == (True, False)
+    clock.advance(30)
+    assert not registry.is_silent(1)
+    stats = registry.stats()
+    assert (stats['active'], stats['expirations'], stats['disables'], stats['silenced']) == (0, 2, 1, 3)
+
+
+def test_load_keeps_only_active_windows_and_refreshes_after_the_interval(tmp_path):
+    test_engine = create_test_database(tmp_path / 'silent.db')
+    db = Session(bind=test_engine)
+    first, second, third = (add_conversation(db, f"551191111000{index}") for index in range(3))
+    db.add_all([
+        SilentMode(conversation_id=first, enabled_by='admin', expires_at=NOW + timedelta(hours=1)),
+        SilentMode(conversation_id=first, enabled_by='admin', expires_at=NOW + timedelta(hours=5), is_active=False),
+        SilentMode(conversation_id=second, enabled_by='admin', expires_at=NOW - timedelta(hours=1)),
+        SilentMode(conversation_id=third, enabled_by='admin', expires_at=NOW + timedelta(minutes=1)),
+    ])
+    db.commit()
+
+    clock = FakeClock()
+    registry = make_registry(clock)
+    assert registry.needs_refresh()
+    registry.load(db)
+    assert not registry.needs_refresh()
+    assert [registry.is_silent(conversation_id) for conversation_id in (first, second, third)] == [True, False, True]
+
+    clock.advance(61)
+    assert registry.needs_refresh()
+    assert [registry.is_silent(conversation_id) for conversation_id in (first, second, third)] == [True, False, False]
+    db.close()
+    test_engine.dispose()
+
+
+def test_silenced_conversations_are_recorded_without_an_ai_turn(db_session, monkeypatch):
+    conversation = Conversation(user_phone='5511999999999')
+    db_session.add(conversation)
+    db_session.commit()
+    clock = FakeClock()
+    registry = make_registry(clock)
+    registry.replace([(conversation.id, NOW + timedelta(hours=1))])
+    monkeypatch.setattr(webhook, 'silent_mode_registry', registry)
+    turns = []
+    monkeypatch.setattr(webhook, 'respond_to_turn', lambda db, turn: turns.append(turn))
+
+    payload = {
+        "key": {"id": "silent_msg", "remoteJid": "5511999999999@s.whatsapp.net"},
+        "messageTimestamp": 1678886400,
+        "messageType": "conversation",
+        "message": {"conversation": "Alguém aí?"}
+    }
+    webhook.process_message_batch([(payload, {})], db_session)
+    assert turns == []
+    assert db_session.query(Message).filter_by(whatsapp_message_id='silent_msg').one().content == 'Alguém aí?'
+
+    registry.disable(conversation.id)
+    webhook.process_message_batch([({**payload, "key": {**payload["key"], "id": "after_silent_msg"}}, {})], db_session)
+    assert len(turns) == 1
@@ -0,0 +1,50 @@
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from services.traffic_recorder import TrafficRecorder, TrafficRecorderMiddleware, read_capture, redact_payload
+
+
+def make_payload(message_id):
+    return {
+        'event': 'messages.upsert',
+        'apikey': 'secret-key',
+        'data': {'key': {'id': message_id}, 'message': {'imageMessage': {'url': 'https://mmg/x', 'jpegThumbnail': 'QUJD' * 100}}},
+    }
+
+
+def test_redaction_removes_secrets_and_media_blobs():
+    redacted = redact_payload(make_payload('A1'))
+    assert redacted['apikey'] == '<redacted>'
+    assert redacted['data']['message']['imageMessage']['jpegThumbnail'] == '<redacted 400 chars>'
+    assert redacted['data']['message']['imageMessage']['url'] == 'https://mmg/x'
+
+    captured = redact_payload(make_payload('A1'), capture_media=True)
+    assert captured['apikey'] == '<redacted>'
+    assert captured['data']['message']['imageMessage']['jpegThumbnail'] == 'QUJD' * 100
+
+
+def test_middleware_records_webhook_posts_without_consuming_body(tmp_path):
+    capture_path = tmp_path / 'capture.jsonl.gz'
+    recorder = TrafficRecorder(str(capture_path), capture_media=False)
+    app = FastAPI()
+    app.add_middleware(TrafficRecorderMiddleware, recorder=recorder)
+
+    @app.post("/webhook/whatsapp")
+    async def webhook(request: Request):
+        return {'id': (await request.json())['data']['key']['id']}
+
+    @app.post("/other")
+    async def other():
+        return {}
+
+    with TestClient(app) as client:
+        assert client.post("/webhook/whatsapp", json=make_payload('A1')).json() == {'id': 'A1'}
+        client.post("/other", json=make_payload('A2'))
+        client.post("/webhook/whatsapp", json=make_payload('A3'))
+    recorder.close()
+
+    records = list(read_capture(str(capture_path)))
+    assert [record['payload']['data']['key']['id'] for record in records] == ['A1', 'A3']
+    assert records[0]['path'] == '/webhook/whatsapp'
+    assert records[0]['t'] <= records[1]['t']
+    assert records[0]['payload']['apikey'] == '<redacted>'
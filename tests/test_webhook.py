@@ -50,4 +50,51 @@ def test_verify_webhook_failure(client: TestClient):
 #         assert message.content == "Hello, bot!"
 #         ai_response = db_session.query(AIResponse).filter_by(message_id=message.id).first()
 #         assert ai_response is not None
-#         assert ai_response.response_content == "AI response" 
\ No newline at end of file
+#         assert ai_response.response_content == "AI response" 
+
+
+def test_claim_message_reserves_each_whatsapp_id_once(db_session: Session):
+    from models import Conversation, Message
+    from routes.webhook import claim_message
+
+    conversation = Conversation(user_phone="5511911110001")
+    db_session.add(conversation)
+
+    message = claim_message(db_session, conversation, "wamid.1", "5511911110001", "text")
+    assert message is not None and message.id is not None
+    assert message.conversation is conversation
+
+    # Uma reentrega da mesma mensagem não insere nada
+    assert claim_message(db_session, conversation, "wamid.1", "5511911110001", "text") is None
+    db_session.commit()
+    assert db_session.query(Message).count() == 1
+
+def test_handle_webhook_persists_jobs_through_async_session(client: TestClient, db_session: Session):
+    from unittest.mock import patch
+    from models import IngestJob
+    import routes.webhook as webhook
+
+    payload = {
+        "event": "messages.upsert",
+        "apikey": "test_api_key",
+        "data": {
+            "key": {"id": "async_session_msg", "remoteJid": "5511999999999@s.whatsapp.net"},
+            "messageTimestamp": 1678886400,
+            "messageType": "conversation",
+            "message": {"conversation": "Hello, bot!"}
+        }
+    }
+    with patch('config.Config.EVOLUTION_API_KEY', 'test_api_key'), \
+         patch('config.Config.ENABLE_ASYNC_PROCESSING', True), \
+         patch.object(webhook.ingest_queue, '_offer_jobs') as mock_offer_jobs, \
+         patch.object(webhook, 'parse_inbound_message', wraps=webhook.parse_inbound_message) as parse:
+        response = client.post("/webhook/whatsapp", json=payload)
+
+    assert response.status_code == 200
+    assert response.json() == {"status": "success"}
+    job = db_session.query(IngestJob).one()
+    assert job.conversation_key == "5511999999999" and job.is_text
+    # Um único parse na requisição: telefone e is_text vão para o job
+    assert parse.call_count == 1
+    mock_offer_jobs.assert_called_once()
+    assert mock_offer_jobs.call_args.args[1] == [job.id]
@@ -0,0 +1,34 @@
+from services.webhook_filter import WebhookFilter
+
+
+def make_message(message_id, remote_jid='5511911110001@s.whatsapp.net', from_me=False):
+    return {'key': {'id': message_id, 'remoteJid': remote_jid, 'fromMe': from_me}, 'messageType': 'conversation'}
+
+
+def test_non_message_events_are_ignored():
+    webhook_filter = WebhookFilter(max_seen_ids=10, ignore_numbers=[])
+    assert webhook_filter.is_message_event({'event': 'messages.upsert'})
+    assert webhook_filter.is_message_event({'entry': []})
+    assert not webhook_filter.is_message_event({'event': 'presence.update'})
+    assert webhook_filter.stats()['unknown_event'] == 1
+
+
+def test_rejection_reasons():
+    webhook_filter = WebhookFilter(max_seen_ids=10, ignore_numbers=['5511999998888'])
+    assert webhook_filter.rejection_reason(make_message('A1', from_me=True)) == 'from_me'
+    assert webhook_filter.rejection_reason(make_message('A2', remote_jid='status@broadcast')) == 'status'
+    assert webhook_filter.rejection_reason(make_message('A3', remote_jid='5511999998888@s.whatsapp.net')) == 'ignored_number'
+    assert webhook_filter.rejection_reason({'key': {}}) == 'malformed'
+    assert webhook_filter.rejection_reason({'id': 'B1', 'from': '5511911110001', 'type': 'text'}) is None
+
+
+def test_redelivery_is_rejected_only_after_remember():
+    webhook_filter = WebhookFilter(max_seen_ids=2, ignore_numbers=[])
+    assert webhook_filter.rejection_reason(make_message('A1')) is None
+    webhook_filter.remember(['A1'])
+    assert webhook_filter.rejection_reason(make_message('A1')) == 'duplicate'
+
+    # O cache é limitado: IDs mais antigos são esquecidos
+    webhook_filter.remember(['A2', 'A3'])
+    assert webhook_filter.rejection_reason(make_message('A1')) is None
+    assert webhook_filter.stats()['seen_ids_cached'] == 2